@@ -10,6 +10,7 @@ import torch
 from colorama import init, Fore, Style
 from audiocraft.models import MusicGen
 from TTS.api import TTS
+from music_server import MusicGenServer, ServerBusy
 
 # ==== ИНИЦИАЛИЗАЦИЯ ====
 init(autoreset=True)
@@ -29,10 +30,25 @@ VOICE_DIR = Path("Leon_voice")
 VOICE_DIR.mkdir(parents=True, exist_ok=True)
 
 # ==== МОДЕЛИ ====
+# Устройства для воркеров MusicGen через запятую, например LEON_DEVICES=cuda:0,cuda:1.
+# По умолчанию по одному воркеру на каждую видеокарту, либо один на CPU.
+if os.environ.get("LEON_DEVICES"):
+    DEVICES = os.environ["LEON_DEVICES"].split(",")
+elif torch.cuda.is_available():
+    DEVICES = [f"cuda:{i}" for i in range(torch.cuda.device_count())]
+else:
+    DEVICES = ["cpu"]
+MAX_BATCH_SIZE = int(os.environ.get("LEON_MAX_BATCH_SIZE", 4))  # треков в одном вызове generate
+MAX_QUEUE_SIZE = int(os.environ.get("LEON_MAX_QUEUE_SIZE", 32))  # дальше новые запросы отклоняются
+REQUEST_TIMEOUT = float(os.environ.get("LEON_REQUEST_TIMEOUT", 600))  # макс. ожидание в очереди, сек.
+
 start_time = time.time()
 try:
     log("Загружаю модель MusicGen (facebook/musicgen-small)...", Fore.YELLOW)
-    musicgen = MusicGen.get_pretrained("facebook/musicgen-small")
+    music_server = MusicGenServer(
+        lambda device: MusicGen.get_pretrained("facebook/musicgen-small", device=device),
+        devices=DEVICES, max_batch_size=MAX_BATCH_SIZE, max_queue_size=MAX_QUEUE_SIZE, timeout=REQUEST_TIMEOUT)
+    music_server.start()
     log("Модель MusicGen загружена. Готово.", Fore.GREEN)
 except Exception as e:
     log(f"ОШИБКА MusicGen: {e}", Fore.RED)
@@ -87,18 +103,33 @@ except ImportError:
         return x, "ffmpeg_utils не найден, обработка не производится"
 
 # ==== MusicGen Генерация ====
+def generate_music(prompt: str, duration: int, progress, start: float = 0.0, end: float = 1.0, step: str = ""):
+    """
+    Генерирует трек через очередь сервера, показывая настоящий прогресс генерации
+    в диапазоне [start, end] полосы прогресса Gradio.
+    """
+    def on_progress(request):
+        if request.status == "в очереди":
+            desc = f"{step}В очереди (запросов: {music_server.num_outstanding})..."
+        else:
+            desc = f"{step}Генерация музыки: {request.status}..."
+        progress(start + (end - start) * request.progress, desc=desc)
+
+    try:
+        return music_server.generate(prompt, int(duration), on_progress=on_progress)
+    except ServerBusy as e:
+        raise gr.Error(f"Сервер перегружен: {e}")
+    except TimeoutError:
+        raise gr.Error("Сервер перегружен: запрос слишком долго ждал в очереди, попробуйте позже.")
+
 def generate_music_workflow(prompt: str, duration: int, track_name: str, process_audio: bool, progress=gr.Progress(track_tqdm=True)):
     start = time.time()
     try:
-        musicgen.set_generation_params(duration=int(duration))
-        num_steps = 30
-        for i in progress.tqdm(range(num_steps), desc="Шаг 1/2: Генерация музыки..."):
-            time.sleep(max(0.1, duration / num_steps / 2))  # чтобы всегда была анимация
-        wavs = musicgen.generate([prompt])
+        wav = generate_music(prompt, duration, progress, end=0.9, step="Шаг 1/2: ")
         progress(0.9, desc="Шаг 2/2: Сохранение и обработка...")
         safe_name = create_safe_filename(track_name)
         wav_path = OUTPUT_DIR / f"{safe_name}.wav"
-        audio_write(str(wav_path), wavs[0].cpu(), musicgen.sample_rate)
+        audio_write(str(wav_path), wav, music_server.sample_rate)
         if process_audio:
             processed_path, _ = process_existing_audio(str(wav_path))
             result = processed_path or str(wav_path)
@@ -107,6 +138,8 @@ def generate_music_workflow(prompt: str, duration: int, track_name: str, process
         elapsed = time.time() - start
         log(f"[MusicGen] Трек '{track_name}' создан за {elapsed:.1f} сек.", Fore.CYAN)
         return result
+    except gr.Error:
+        raise
     except Exception as e:
         log(f"[MusicGen] Ошибка: {e}", Fore.RED)
         raise gr.Error(f"Критическая ошибка: {e}")
@@ -143,17 +176,15 @@ def generate_song_with_voice(lyrics, genre, duration, voice_sample_path, progres
             file_path=str(vocal_path),
         )
         # 2. Генерируем музыку под жанр
-        progress(0.5, desc="Генерация музыки (MusicGen)...")
-        musicgen.set_generation_params(duration=int(duration))
         prompt = f"{genre} instrumental"
-        music = musicgen.generate([prompt])
+        music = generate_music(prompt, duration, progress, start=0.5, end=0.8)
         music_path = OUTPUT_DIR / "music.wav"
-        audio_np = music[0].cpu().numpy()
+        audio_np = music.numpy()
         if audio_np.ndim > 1: audio_np = audio_np[0]
         audio_int16 = (audio_np * 32767).astype(np.int16)
         AudioSegment(
             audio_int16.tobytes(),
-            frame_rate=musicgen.sample_rate,
+            frame_rate=music_server.sample_rate,
             sample_width=2,
             channels=1
         ).export(music_path, format="wav")
@@ -168,6 +199,8 @@ def generate_song_with_voice(lyrics, genre, duration, voice_sample_path, progres
         elapsed = time.time() - t0
         log(f"[TTS+MusicGen] Песня с вашим голосом готова за {elapsed:.1f} сек.", Fore.CYAN)
         return str(out_path)
+    except gr.Error:
+        raise
     except Exception as e:
         log(f"[TTS+MusicGen] Ошибка: {e}", Fore.RED)
         raise gr.Error(f"Ошибка генерации песни: {e}")
@@ -251,4 +284,6 @@ with gr.Blocks(theme=gr.themes.Soft(primary_hue=gr.themes.colors.purple, seconda
 
 if __name__ == "__main__":
     log("===> Интерфейс загружен, можно заходить по адресу ниже", Fore.GREEN)
+    # обработчики выполняются параллельно, а очередь MusicGen объединяет их запросы в батчи.
+    demo.queue(default_concurrency_limit=MAX_QUEUE_SIZE)
     demo.launch()
\ No newline at end of file
@@ -0,0 +1,256 @@
+import asyncio
+import concurrent.futures
+import threading
+import time
+import typing as tp
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+
+import torch
+from colorama import Fore, Style
+
+
+def log(msg, color=Fore.RESET):
+    print(color + msg + Style.RESET_ALL)
+
+
+class ServerBusy(RuntimeError):
+    """Очередь переполнена, запрос отклонён (backpressure)."""
+
+
+@dataclass(eq=False)
+class GenerationRequest:
+    """
+    Запрос на генерацию одного трека. Воркер обновляет `progress` (от 0 до 1) и `status`,
+    результат (тензор [C, T] на CPU) или ошибка приходят через `future`.
+    """
+    prompt: str
+    duration: int
+    deadline: float
+    future: concurrent.futures.Future = field(default_factory=concurrent.futures.Future)
+    progress: float = 0.0
+    status: str = "в очереди"
+
+
+class _Worker:
+    """Модель MusicGen на своём устройстве и свой поток, в котором она генерирует."""
+
+    def __init__(self, device: str, model):
+        self.device = device
+        self.model = model
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"musicgen-{device}")
+
+    def generate(self, batch: tp.List[GenerationRequest]) -> tp.List[torch.Tensor]:
+        def _on_progress(generated: int, total: int):
+            for request in batch:
+                request.progress = min(generated / max(total, 1), 1.0)
+
+        self.model.set_custom_progress_callback(_on_progress)
+        self.model.set_generation_params(duration=batch[0].duration)
+        wavs = self.model.generate([request.prompt for request in batch], progress=True)
+        return [wav.cpu() for wav in wavs]
+
+
+class MusicGenServer:
+    """
+    Асинхронная очередь запросов перед одной или несколькими моделями MusicGen (по одной на устройство).
+
+    Запросы складываются в asyncio-очередь, которая крутится в отдельном потоке. Как только освобождается
+    воркер, диспетчер собирает в один батч до `max_batch_size` запросов с той же длительностью, что и самый
+    старый запрос, и отправляет их одним вызовом `generate`. Под нагрузкой батчи растут сами собой,
+    пока все воркеры заняты, а без нагрузки запрос ждёт соседей не дольше `batch_wait` секунд.
+
+    Если в работе уже `max_queue_size` запросов, новые отклоняются с `ServerBusy`. Запросы, не дождавшиеся
+    воркера за `timeout` секунд, завершаются с `TimeoutError`: очередь проверяется каждые `sweep_interval`
+    секунд, даже если все воркеры заняты.
+
+    Воркеры — это потоки: PyTorch отпускает GIL во время вычислений, так что модели на разных GPU
+    работают параллельно, и не нужно передавать тензоры между процессами.
+    """
+
+    def __init__(self, model_factory: tp.Callable[[str], tp.Any], devices: tp.Sequence[str],
+                 max_batch_size: int = 4, max_queue_size: int = 32, batch_wait: float = 0.1,
+                 timeout: float = 600.0, sweep_interval: float = 1.0):
+        self.model_factory = model_factory
+        self.devices = list(devices)
+        self.max_batch_size = max_batch_size
+        self.max_queue_size = max_queue_size
+        self.batch_wait = batch_wait
+        self.timeout = timeout
+        self.sweep_interval = sweep_interval
+        self._workers: tp.List[_Worker] = []
+        # запросы в очереди, ещё не отправленные воркеру, от самого старого к самому новому.
+        self._pending: tp.List[GenerationRequest] = []
+        # ошибка, из-за которой остановился диспетчер: после неё новые запросы не принимаются.
+        self._error: tp.Optional[BaseException] = None
+        self._outstanding = 0
+        self._lock = threading.Lock()
+        self._loop = asyncio.new_event_loop()
+        self._ready = threading.Event()
+        self._thread = threading.Thread(target=self._run_loop, name="musicgen-server", daemon=True)
+
+    @property
+    def sample_rate(self) -> int:
+        return self._workers[0].model.sample_rate
+
+    @property
+    def num_outstanding(self) -> int:
+        """Число запросов в очереди и в работе."""
+        return self._outstanding
+
+    def start(self):
+        """Загружает модели на все устройства и запускает диспетчер."""
+        for device in self.devices:
+            log(f"Загружаю MusicGen на {device}...", Fore.YELLOW)
+            self._workers.append(_Worker(device, self.model_factory(device)))
+        self._thread.start()
+        self._ready.wait()
+        log(f"Сервер MusicGen запущен: {len(self._workers)} воркер(ов), батч до {self.max_batch_size}.", Fore.GREEN)
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self._loop)
+        self._wakeup = asyncio.Event()
+        self._dispatch_task = self._loop.create_task(self._dispatch())
+        self._dispatch_task.add_done_callback(self._on_dispatch_done)
+        self._loop.create_task(self._sweep())
+        self._ready.set()
+        self._loop.run_forever()
+
+    def submit(self, prompt: str, duration: int, timeout: tp.Optional[float] = None) -> GenerationRequest:
+        """Ставит запрос в очередь и сразу возвращает его, не дожидаясь генерации."""
+        with self._lock:
+            if self._error is not None:
+                raise RuntimeError(f"Сервер MusicGen остановлен из-за ошибки: {self._error}")
+            if self._outstanding >= self.max_queue_size:
+                raise ServerBusy(f"В очереди уже {self._outstanding} запросов, попробуйте позже.")
+            self._outstanding += 1
+        request = GenerationRequest(prompt, int(duration), time.monotonic() + (timeout or self.timeout))
+        request.future.add_done_callback(self._on_done)
+        self._loop.call_soon_threadsafe(self._enqueue, request)
+        return request
+
+    def _enqueue(self, request: GenerationRequest):
+        if self._error is not None:
+            self._set_result(request, error=RuntimeError(f"Сервер MusicGen остановлен из-за ошибки: {self._error}"))
+            return
+        self._pending.append(request)
+        self._wakeup.set()
+
+    def _on_done(self, future: concurrent.futures.Future):
+        with self._lock:
+            self._outstanding -= 1
+
+    def generate(self, prompt: str, duration: int,
+                 on_progress: tp.Optional[tp.Callable[[GenerationRequest], None]] = None,
+                 timeout: tp.Optional[float] = None, poll_interval: float = 0.25) -> torch.Tensor:
+        """
+        Блокирующая генерация для синхронных обработчиков (например, Gradio): ставит запрос в очередь
+        и ждёт результата, вызывая `on_progress(request)` каждые `poll_interval` секунд.
+        """
+        request = self.submit(prompt, duration, timeout)
+        while True:
+            done, _ = concurrent.futures.wait([request.future], timeout=poll_interval)
+            if done:
+                return request.future.result()
+            if on_progress is not None:
+                on_progress(request)
+
+    async def agenerate(self, prompt: str, duration: int, timeout: tp.Optional[float] = None) -> torch.Tensor:
+        """То же, что `generate`, для асинхронного кода."""
+        request = self.submit(prompt, duration, timeout)
+        return await asyncio.wrap_future(request.future)
+
+    @staticmethod
+    def _set_result(request: GenerationRequest, result: tp.Any = None,
+                    error: tp.Optional[BaseException] = None):
+        """Завершает запрос, если его ещё не отменили или не завершили с другой стороны."""
+        if request.future.done():
+            return
+        try:
+            if error is not None:
+                request.future.set_exception(error)
+            else:
+                request.future.set_result(result)
+        except concurrent.futures.InvalidStateError:
+            pass  # future отменили одновременно с нами (например, через `agenerate`).
+
+    def _collect(self):
+        """Убирает из очереди отменённые запросы и завершает просроченные."""
+        now = time.monotonic()
+        live = []
+        for request in self._pending:
+            if request.future.done():
+                continue
+            if now > request.deadline:
+                self._set_result(request, error=TimeoutError("Запрос не дождался свободной модели."))
+                continue
+            live.append(request)
+        self._pending = live
+
+    async def _sweep(self):
+        # сроки проверяются и тогда, когда все воркеры заняты и диспетчер ждёт.
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            self._collect()
+
+    def _on_dispatch_done(self, task: asyncio.Task):
+        if task.cancelled() or task.exception() is None:
+            return
+        error = task.exception()
+        log(f"[MusicGen] Диспетчер очереди упал: {error!r}", Fore.RED)
+        with self._lock:
+            self._error = error
+        self._collect()
+        for request in self._pending:
+            self._set_result(request, error=RuntimeError(f"Сервер MusicGen остановлен из-за ошибки: {error}"))
+        self._pending = []
+
+    async def _dispatch(self):
+        idle: asyncio.Queue = asyncio.Queue()
+        for worker in self._workers:
+            idle.put_nowait(worker)
+        while True:
+            while not self._pending:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                self._collect()
+            worker = await idle.get()
+            self._collect()
+            # пока все воркеры были заняты, запросы копились, иначе чуть ждём соседей для батча.
+            if self._pending:
+                duration = self._pending[0].duration
+                same_duration = [request for request in self._pending if request.duration == duration]
+                if len(same_duration) < self.max_batch_size:
+                    await asyncio.sleep(self.batch_wait)
+                    self._collect()
+            if not self._pending:
+                idle.put_nowait(worker)
+                continue
+            # батч из самого старого запроса и следующих с той же длительностью.
+            duration = self._pending[0].duration
+            batch = [request for request in self._pending if request.duration == duration][:self.max_batch_size]
+            self._pending = [request for request in self._pending if request not in batch]
+            batch = [request for request in batch if request.future.set_running_or_notify_cancel()]
+            if not batch:
+                idle.put_nowait(worker)
+                continue
+            self._loop.create_task(self._run_batch(worker, batch, idle))
+
+    async def _run_batch(self, worker: _Worker, batch: tp.List[GenerationRequest], idle: asyncio.Queue):
+        for request in batch:
+            request.status = f"генерация на {worker.device} (батч из {len(batch)})"
+        begin = time.monotonic()
+        try:
+            wavs = await self._loop.run_in_executor(worker.executor, worker.generate, batch)
+        except Exception as e:
+            log(f"[MusicGen] Ошибка генерации батча: {e}", Fore.RED)
+            for request in batch:
+                self._set_result(request, error=e)
+        else:
+            log(f"[MusicGen] Батч из {len(batch)} треков по {batch[0].duration} сек. на {worker.device} "
+                f"за {time.monotonic() - begin:.1f} сек.", Fore.CYAN)
+            for request, wav in zip(batch, wavs):
+                request.progress = 1.0
+                self._set_result(request, wav)
+        finally:
+            idle.put_nowait(worker)
@@ -23,6 +23,22 @@ At the moment we provide the training code for:
 """
 
 # flake8: noqa
-from . import data, modules, models
+import importlib
+import typing as tp
 
 __version__ = '1.4.0a2'
+
+# The submodules are imported on first access, so that `import audiocraft` or the import of
+# a lightweight submodule (e.g. `audiocraft.data.audio`) does not pull in all the model families
+# and their third party dependencies. `audiocraft.models` etc. keep working as before.
+_LAZY_SUBMODULES = ('data', 'modules', 'models')
+
+
+def __getattr__(name: str) -> tp.Any:
+    if name in _LAZY_SUBMODULES:
+        return importlib.import_module(f'.{name}', __name__)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__() -> tp.List[str]:
+    return sorted(list(globals()) + list(_LAZY_SUBMODULES))
@@ -7,4 +7,23 @@
 or also including some metadata."""
 
 # flake8: noqa
-from . import audio, audio_dataset, info_audio_dataset, music_dataset, sound_dataset, jasco_dataset
+import importlib
+import typing as tp
+
+# The datasets with metadata depend on the conditioners, and through them on most of the modules,
+# the submodules are thus only imported on first access.
+_LAZY_SUBMODULES = ('audio', 'audio_dataset', 'info_audio_dataset', 'music_dataset', 'sound_dataset', 'jasco_dataset')
+
+if tp.TYPE_CHECKING:
+    # static analysis still sees the submodules as attributes of the package.
+    from . import audio, audio_dataset, info_audio_dataset, music_dataset, sound_dataset, jasco_dataset
+
+
+def __getattr__(name: str) -> tp.Any:
+    if name in _LAZY_SUBMODULES:
+        return importlib.import_module(f'.{name}', __name__)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__() -> tp.List[str]:
+    return sorted(list(globals()) + list(_LAZY_SUBMODULES))
@@ -7,17 +7,44 @@
 Models for EnCodec, AudioGen, MusicGen, as well as the generic LMModel.
 """
 # flake8: noqa
-from . import builders, loaders
-from .encodec import (
-    CompressionModel, EncodecModel, DAC,
-    HFEncodecModel, HFEncodecCompressionModel)
-from .audiogen import AudioGen
-from .lm import LMModel
-from .lm_magnet import MagnetLMModel
-from .flow_matching import FlowMatchingModel
-from .multibanddiffusion import MultiBandDiffusion
-from .musicgen import MusicGen
-from .magnet import MAGNeT
-from .unet import DiffusionUnet
-from .watermark import WMModel
-from .jasco import JASCO
+import importlib
+import typing as tp
+
+# Each public name maps to the submodule defining it. The submodules are only imported on first
+# access, as importing all the model families at once pulls in heavy third party dependencies
+# (transformers, spacy, demucs, ...). `from audiocraft.models import MusicGen` works as before.
+_LAZY_ATTRIBUTES = {
+    'CompressionModel': 'encodec',
+    'EncodecModel': 'encodec',
+    'DAC': 'encodec',
+    'HFEncodecModel': 'encodec',
+    'HFEncodecCompressionModel': 'encodec',
+    'AudioGen': 'audiogen',
+    'LMModel': 'lm',
+    'MagnetLMModel': 'lm_magnet',
+    'FlowMatchingModel': 'flow_matching',
+    'MultiBandDiffusion': 'multibanddiffusion',
+    'MusicGen': 'musicgen',
+    'MAGNeT': 'magnet',
+    'DiffusionUnet': 'unet',
+    'WMModel': 'watermark',
+    'JASCO': 'jasco',
+}
+_LAZY_SUBMODULES = ('builders', 'loaders')
+
+__all__ = list(_LAZY_SUBMODULES) + list(_LAZY_ATTRIBUTES)
+
+
+def __getattr__(name: str) -> tp.Any:
+    if name in _LAZY_SUBMODULES:
+        return importlib.import_module(f'.{name}', __name__)
+    if name in _LAZY_ATTRIBUTES:
+        module = importlib.import_module(f'.{_LAZY_ATTRIBUTES[name]}', __name__)
+        value = getattr(module, name)
+        globals()[name] = value  # cache it, next accesses won't go through `__getattr__`.
+        return value
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__() -> tp.List[str]:
+    return sorted(set(globals()) | set(__all__))
@@ -9,6 +9,7 @@ All the functions to build the relevant models and modules
 from the Hydra config.
 """
 
+import contextlib
 import typing as tp
 
 import omegaconf
@@ -67,26 +68,28 @@ def get_encodec_autoencoder(encoder_name: str, cfg: omegaconf.DictConfig):
         raise KeyError(f"Unexpected compression model {cfg.compression_model}")
 
 
-def get_compression_model(cfg: omegaconf.DictConfig) -> CompressionModel:
-    """Instantiate a compression model."""
+def get_compression_model(cfg: omegaconf.DictConfig, empty_init: bool = False) -> CompressionModel:
+    """Instantiate a compression model, on the meta device if `empty_init`, see `get_lm_model`."""
     if cfg.compression_model == "encodec":
         kwargs = dict_from_config(getattr(cfg, "encodec"))
         encoder_name = kwargs.pop("autoencoder")
         quantizer_name = kwargs.pop("quantizer")
-        encoder, decoder = get_encodec_autoencoder(encoder_name, cfg)
-        quantizer = get_quantizer(quantizer_name, cfg, encoder.dimension)
+        with torch.device("meta") if empty_init else contextlib.nullcontext():
+            encoder, decoder = get_encodec_autoencoder(encoder_name, cfg)
+            quantizer = get_quantizer(quantizer_name, cfg, encoder.dimension)
         frame_rate = kwargs["sample_rate"] // encoder.hop_length
         renormalize = kwargs.pop("renormalize", False)
         # deprecated params
         kwargs.pop("renorm", None)
-        return EncodecModel(
+        model = EncodecModel(
             encoder,
             decoder,
             quantizer,
             frame_rate=frame_rate,
             renormalize=renormalize,
             **kwargs,
-        ).to(cfg.device)
+        )
+        return model if empty_init else model.to(cfg.device)
     else:
         raise KeyError(f"Unexpected compression model {cfg.compression_model}")
 
@@ -113,7 +116,8 @@ def get_jasco_model(cfg: omegaconf.DictConfig,
     condition_provider = JascoConditioningProvider(device=condition_provider.device,
                                                    conditioners=condition_provider.conditioners,
                                                    chords_card=chords_card,
-                                                   sequence_length=seq_len)
+                                                   sequence_length=seq_len,
+                                                   length_buckets=condition_provider.length_buckets)
 
     if len(fuser.fuse2cond["cross"]) > 0:  # enforce cross-att programmatically
         kwargs["cross_attention"] = True
@@ -133,8 +137,15 @@ def get_jasco_model(cfg: omegaconf.DictConfig,
     ).to(cfg.device)
 
 
-def get_lm_model(cfg: omegaconf.DictConfig) -> LMModel:
-    """Instantiate a transformer LM."""
+def get_lm_model(cfg: omegaconf.DictConfig, empty_init: bool = False) -> LMModel:
+    """Instantiate a transformer LM.
+
+    Args:
+        cfg (omegaconf.DictConfig): Config of the LM.
+        empty_init (bool): If True, the LM parameters are created on the meta device, without allocating nor
+            initializing them, and must then be loaded from a state dict, see `loaders.load_state_dict_into_empty`.
+            The condition provider is still built on `cfg.device`, as some conditioners load pretrained models.
+    """
     if cfg.lm_model in ["transformer_lm", "transformer_lm_magnet"]:
         kwargs = dict_from_config(getattr(cfg, "transformer_lm"))
         n_q = kwargs["n_q"]
@@ -160,17 +171,19 @@ def get_lm_model(cfg: omegaconf.DictConfig) -> LMModel:
 
         pattern_provider = get_codebooks_pattern_provider(n_q, codebooks_pattern_cfg)
         lm_class = MagnetLMModel if cfg.lm_model == "transformer_lm_magnet" else LMModel
-        return lm_class(
-            pattern_provider=pattern_provider,
-            condition_provider=condition_provider,
-            fuser=fuser,
-            cfg_dropout=cfg_prob,
-            cfg_coef=cfg_coef,
-            attribute_dropout=attribute_dropout,
-            dtype=getattr(torch, cfg.dtype),
-            device=cfg.device,
-            **kwargs,
-        ).to(cfg.device)
+        with torch.device("meta") if empty_init else contextlib.nullcontext():
+            lm = lm_class(
+                pattern_provider=pattern_provider,
+                condition_provider=condition_provider,
+                fuser=fuser,
+                cfg_dropout=cfg_prob,
+                cfg_coef=cfg_coef,
+                attribute_dropout=attribute_dropout,
+                dtype=getattr(torch, cfg.dtype),
+                device="meta" if empty_init else cfg.device,
+                **kwargs,
+            )
+        return lm if empty_init else lm.to(cfg.device)
     else:
         raise KeyError(f"Unexpected LM model {cfg.lm_model}")
 
@@ -306,8 +319,8 @@ def get_processor(cfg, sample_rate: int = 24000):
     return sample_processor
 
 
-def get_debug_lm_model(device="cpu"):
-    """Instantiate a debug LM to be used for unit tests."""
+def get_debug_lm_model(device="cpu", empty_init: bool = False):
+    """Instantiate a debug LM to be used for unit tests, see `get_lm_model` for `empty_init`."""
     pattern = DelayedPatternProvider(n_q=4)
     dim = 16
     providers = {
@@ -319,7 +332,38 @@ def get_debug_lm_model(device="cpu"):
     fuser = ConditionFuser(
         {"cross": ["description"], "prepend": [], "sum": [], "input_interpolate": []}
     )
-    lm = LMModel(
+    condition_provider = condition_provider.to(device)
+    with torch.device("meta") if empty_init else contextlib.nullcontext():
+        lm = LMModel(
+            pattern,
+            condition_provider,
+            fuser,
+            n_q=4,
+            card=400,
+            dim=dim,
+            num_heads=4,
+            custom=True,
+            num_layers=2,
+            cross_attention=True,
+            causal=True,
+        )
+    return lm.eval() if empty_init else lm.to(device).eval()
+
+
+def get_debug_magnet_lm_model(device="cpu"):
+    """Instantiate a debug MAGNeT LM to be used for unit tests, matching the debug compression model."""
+    pattern = ParallelPatternProvider(n_q=4)
+    dim = 16
+    providers = {
+        "description": LUTConditioner(
+            n_bins=128, dim=dim, output_dim=dim, tokenizer="whitespace"
+        ),
+    }
+    condition_provider = ConditioningProvider(providers)
+    fuser = ConditionFuser(
+        {"cross": ["description"], "prepend": [], "sum": [], "input_interpolate": []}
+    )
+    lm = MagnetLMModel(
         pattern,
         condition_provider,
         fuser,
@@ -330,7 +374,11 @@ def get_debug_lm_model(device="cpu"):
         custom=True,
         num_layers=2,
         cross_attention=True,
-        causal=True,
+        causal=False,
+        subcodes_context=5,
+        compression_model_framerate=25,
+        segment_duration=2,
+        span_len=3,
     )
     return lm.to(device).eval()
 
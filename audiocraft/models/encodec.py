@@ -17,14 +17,26 @@ from einops import rearrange
 import numpy as np
 import torch
 from torch import nn
-from transformers import EncodecModel as HFEncodecModel
 
 from .. import quantization as qt
+from ..modules.conv import remove_parametrization_norm
+from ..utils.utils import chunked_overlap_add
+
+if tp.TYPE_CHECKING:
+    from transformers import EncodecModel as HFEncodecModel
 
 
 logger = logging.getLogger()
 
 
+def __getattr__(name: str) -> tp.Any:
+    # transformers is slow to import, so `HFEncodecModel` is only imported when first accessed.
+    if name == 'HFEncodecModel':
+        from transformers import EncodecModel as HFEncodecModel
+        return HFEncodecModel
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
 class CompressionModel(ABC, nn.Module):
     """Base API for all compression models that aim at being used as audio tokenizers
     with a language model.
@@ -49,6 +61,55 @@ class CompressionModel(ABC, nn.Module):
         """Decode from the discrete codes to continuous latent space."""
         ...
 
+    def decode_chunked(self, codes: torch.Tensor, scale: tp.Optional[torch.Tensor] = None,
+                       chunk_duration: float = 10., chunk_overlap: float = 0.5, offload: bool = False):
+        """Decode long sequences of codes by overlapping chunks cross-faded together, so that the peak
+        activation memory of the decoder does not depend on the sequence length.
+        The output only differs from `decode` around the chunk boundaries, where each chunk lacks the context
+        beyond its edges, hence the overlap should cover the receptive field of the decoder.
+
+        Args:
+            codes (torch.Tensor): Int tensor of shape [B, K, T].
+            scale (torch.Tensor, optional): Float tensor containing the scale value.
+            chunk_duration (float): Duration of the chunks in seconds.
+            chunk_overlap (float): Overlap in seconds between consecutive chunks, reduced to half of
+                `chunk_duration` if longer.
+            offload (bool): If True, the decoded chunks are moved to the CPU as soon as they are ready,
+                and the audio is returned on CPU.
+        Returns:
+            out (torch.Tensor): Float tensor of shape [B, C, T'], the reconstructed audio.
+        """
+        chunk_frames = max(int(chunk_duration * self.frame_rate), 1)
+        if chunk_frames >= codes.shape[-1]:
+            out = self.decode(codes, scale)
+            return out.cpu() if offload else out
+        overlap_frames = min(int(chunk_overlap * self.frame_rate), chunk_frames // 2)
+        upsampling = round(self.sample_rate / self.frame_rate)
+        return chunked_overlap_add(lambda chunk, _: self.decode(chunk, scale), codes,
+                                   chunk_frames, overlap_frames, upsampling, offload=offload)
+
+    def set_inference_dtype(self, dtype: tp.Optional[torch.dtype] = None, fold_norms: bool = True):
+        """Run the encoder and decoder in the given dtype for inference, see `EncodecModel.set_inference_dtype`.
+        The models without support for reduced precision, e.g. DAC or the Hugging Face EnCodec models,
+        are left unchanged in float32.
+        """
+        if dtype is not None:
+            logger.warning("%s does not support reduced precision inference, keeping it in float32.",
+                           self.__class__.__name__)
+
+    def fuse_for_inference(self) -> int:
+        """Fold the weight normalization of the convolutions into plain weights, so that the normalized
+        weights are not recomputed on each forward. The outputs are unchanged but the model can no longer
+        be trained, and its state dict no longer matches the one of the training checkpoints.
+
+        Returns:
+            int: Number of folded normalizations.
+        """
+        assert not self.training, "Fusing is only meant for inference, call `.eval()` first."
+        num_folded = remove_parametrization_norm(self)
+        logger.debug("Folded %d weight normalizations in %s.", num_folded, self.__class__.__name__)
+        return num_folded
+
     @property
     @abstractmethod
     def channels(self) -> int:
@@ -86,13 +147,15 @@ class CompressionModel(ABC, nn.Module):
 
     @staticmethod
     def get_pretrained(
-            name: str, device: tp.Union[torch.device, str] = 'cpu'
+            name: str, device: tp.Union[torch.device, str] = 'cpu', fuse: bool = True
             ) -> 'CompressionModel':
         """Instantiate a CompressionModel from a given pretrained model.
 
         Args:
             name (Path or str): name of the pretrained model. See after.
             device (torch.device or str): Device on which the model is loaded.
+            fuse (bool): Whether to fold the weight normalization of an exported checkpoint into plain weights,
+                see `fuse_for_inference`. Disable it to keep training the model.
 
         Pretrained models:
             - dac_44khz (https://github.com/descriptinc/descript-audio-codec)
@@ -114,9 +177,10 @@ class CompressionModel(ABC, nn.Module):
         elif Path(name).exists():
             # We assume here if the path exists that it is in fact an AC checkpoint
             # that was exported using `audiocraft.utils.export` functions.
-            model = loaders.load_compression_model(name, device=device)
+            model = loaders.load_compression_model(name, device=device, fuse=fuse)
         else:
             logger.info("Getting pretrained compression model from HF %s", name)
+            from transformers import EncodecModel as HFEncodecModel
             hf_model = HFEncodecModel.from_pretrained(name)
             model = HFEncodecCompressionModel(hf_model).to(device)
         return model.to(device).eval()
@@ -159,11 +223,28 @@ class EncodecModel(CompressionModel):
         self.channels = channels
         self.renormalize = renormalize
         self.causal = causal
+        self.inference_dtype: tp.Optional[torch.dtype] = None
         if self.causal:
             # we force disabling here to avoid handling linear overlap of segments
             # as supported in original EnCodec codebase.
             assert not self.renormalize, 'Causal model does not support renormalize'
 
+    def set_inference_dtype(self, dtype: tp.Optional[torch.dtype] = None, fold_norms: bool = True):
+        """Run the encoder and decoder in the given dtype for inference, e.g. `torch.float16` or `torch.bfloat16`
+        on GPU, while the inputs, the quantizer and the outputs remain in float32. Only `encode` and `decode`
+        support reduced precision, the model should not be trained afterwards.
+
+        Args:
+            dtype (torch.dtype, optional): Dtype of the encoder and decoder, None to go back to float32.
+            fold_norms (bool): Whether to first fold the weight normalization of the convolutions into
+                plain weights, in float32, see `fuse_for_inference`.
+        """
+        if fold_norms:
+            self.fuse_for_inference()
+        self.inference_dtype = dtype
+        self.encoder.to(torch.float32 if dtype is None else dtype)
+        self.decoder.to(torch.float32 if dtype is None else dtype)
+
     @property
     def total_codebooks(self):
         """Total number of quantizer codebooks available."""
@@ -233,7 +314,10 @@ class EncodecModel(CompressionModel):
         """
         assert x.dim() == 3
         x, scale = self.preprocess(x)
-        emb = self.encoder(x)
+        if self.inference_dtype is not None:
+            emb = self.encoder(x.to(self.inference_dtype)).float()
+        else:
+            emb = self.encoder(x)
         codes = self.quantizer.encode(emb)
         return codes, scale
 
@@ -249,7 +333,10 @@ class EncodecModel(CompressionModel):
             out (torch.Tensor): Float tensor of shape [B, C, T], the reconstructed audio.
         """
         emb = self.decode_latent(codes)
-        out = self.decoder(emb)
+        if self.inference_dtype is not None:
+            out = self.decoder(emb.to(self.inference_dtype)).float()
+        else:
+            out = self.decoder(emb)
         out = self.postprocess(out, scale)
         # out contains extra padding added by the encoder and decoder
         return out
@@ -323,7 +410,7 @@ class DAC(CompressionModel):
 class HFEncodecCompressionModel(CompressionModel):
     """Wrapper around HuggingFace Encodec.
     """
-    def __init__(self, model: HFEncodecModel):
+    def __init__(self, model: 'HFEncodecModel'):
         super().__init__()
         self.model = model
         bws = self.model.config.target_bandwidths
@@ -432,6 +519,10 @@ class InterleaveStereoCompressionModel(CompressionModel):
         """
         self.model.set_num_codebooks(n)
 
+    def set_inference_dtype(self, dtype: tp.Optional[torch.dtype] = None, fold_norms: bool = True):
+        """Set the inference dtype of the wrapped model."""
+        self.model.set_inference_dtype(dtype, fold_norms=fold_norms)
+
     @property
     def num_virtual_steps(self) -> float:
         """Return the number of virtual steps, e.g. one real step
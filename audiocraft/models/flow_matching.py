@@ -13,7 +13,8 @@ import torch
 from torch import nn
 from torchdiffeq import odeint  # type: ignore
 from ..modules.streaming import StreamingModule
-from ..modules.transformer import create_norm_fn, StreamingTransformerLayer
+from ..utils.profiler import trace_count, trace_span
+from ..modules.transformer import create_norm_fn, cross_attention_kv_cache, StreamingTransformerLayer
 from ..modules.unet_transformer import UnetTransformer
 from ..modules.conditioners import (
     ConditionFuser,
@@ -30,6 +31,62 @@ from .lm import ConditionTensors, init_layer
 
 logger = logging.getLogger(__name__)
 
+# Fixed-step ODE solvers, with their number of function evaluations (NFE) per step.
+FIXED_STEP_SOLVERS = {
+    'euler': 1,
+    'midpoint': 2,
+    'heun': 2,
+    'rk4': 4,
+    'ab2': 1,
+}
+
+
+def fixed_step_odeint(func: tp.Callable[[torch.Tensor, torch.Tensor], torch.Tensor], z_0: torch.Tensor,
+                      solver: str = 'heun', nfe: int = 32, t_0: float = 0., t_1: float = 1.) -> torch.Tensor:
+    """Integrate dz/dt = func(t, z) from t_0 to t_1 with a fixed budget of function evaluations.
+
+    The interval is split in uniform steps, as many as allowed by the NFE budget for the given solver:
+    'euler' (1st order), 'midpoint' and 'heun' (2nd order, 2 NFE per step), 'rk4' (4th order, 4 NFE per step)
+    and 'ab2', a 2nd order multistep (Adams-Bashforth) solver in the spirit of DPM-Solver++(2M),
+    which reuses the previous evaluation to reach 2nd order with a single NFE per step.
+
+    Args:
+        func (Callable): Vector field, taking the time as a tensor of shape [1] and the current state.
+        z_0 (torch.Tensor): Initial state.
+        solver (str): Name of the solver, one of `FIXED_STEP_SOLVERS`.
+        nfe (int): Maximal number of function evaluations.
+        t_0 (float): Initial time.
+        t_1 (float): Final time.
+    Returns:
+        torch.Tensor: State at time t_1.
+    """
+    if solver not in FIXED_STEP_SOLVERS:
+        raise ValueError(f"Unknown ODE solver {solver}, expected one of {list(FIXED_STEP_SOLVERS)}.")
+    num_steps = max(1, nfe // FIXED_STEP_SOLVERS[solver])
+    ts = torch.linspace(t_0, t_1, num_steps + 1, device=z_0.device)
+    z = z_0
+    prev_v: tp.Optional[torch.Tensor] = None
+    for step in range(num_steps):
+        t, t_next = ts[step:step + 1], ts[step + 1:step + 2]
+        dt = t_next - t
+        v = func(t, z)
+        if solver == 'euler':
+            z = z + dt * v
+        elif solver == 'midpoint':
+            z = z + dt * func(t + dt / 2, z + dt / 2 * v)
+        elif solver == 'heun':
+            v_next = func(t_next, z + dt * v)
+            z = z + dt / 2 * (v + v_next)
+        elif solver == 'rk4':
+            k2 = func(t + dt / 2, z + dt / 2 * v)
+            k3 = func(t + dt / 2, z + dt / 2 * k2)
+            k4 = func(t_next, z + dt * k3)
+            z = z + dt / 6 * (v + 2 * k2 + 2 * k3 + k4)
+        else:  # ab2, the first step falls back to Euler as there is no previous evaluation.
+            z = z + dt * (v if prev_v is None else 1.5 * v - 0.5 * prev_v)
+            prev_v = v
+    return z
+
 
 @dataclass
 class FMOutput:
@@ -37,6 +94,16 @@ class FMOutput:
     mask: torch.Tensor  # [B, T]
 
 
+@dataclass
+class FMConditionInputs:
+    """Inputs of the transformer derived from the conditions only, which are computed once and reused
+    for all the function evaluations of the ODE solver, see `FlowMatchingModel.prepare_condition_inputs`."""
+    temporal_emb: tp.Optional[torch.Tensor]  # [B, T, dim], projection of the temporal conditions
+    fused_conditions: ConditionTensors  # conditions fused to the transformer input (sum, prepend...)
+    cross_attention_input: tp.Optional[torch.Tensor]  # [B, S, dim]
+    cross_attention_mask: tp.Optional[torch.Tensor]  # [B, S]
+
+
 class CFGTerm:
     """
     Base class for Multi Source Classifier-Free Guidance (CFG) terms. This class represents a term in the CFG process,
@@ -286,11 +353,44 @@ class FlowMatchingModel(StreamingModule):
 
         return cond
 
+    def prepare_condition_inputs(self, condition_tensors: ConditionTensors, seq_len: int) -> FMConditionInputs:
+        """Compute the parts of the transformer inputs that only depend on the conditions: the projection
+        of the temporal conditions, and the cross attention source with its padding bias.
+
+        Args:
+            condition_tensors (dict[str, ConditionType]): Pre-computed conditioning tensors.
+            seq_len (int): Length of the latents sequence.
+        Returns:
+            FMConditionInputs: Inputs to pass to `forward` for any latents of length `seq_len`.
+        """
+        # temporal conditions are concatenated after the latents on the feature dimension.
+        temporal_conds = [self._align_seq_length(condition_tensors[cond][0], seq_len=seq_len)
+                          for cond in JascoCondConst.ALL.value if cond in condition_tensors]
+        temporal_emb: tp.Optional[torch.Tensor] = None
+        if temporal_conds:
+            temporal_emb = nn.functional.linear(torch.cat(temporal_conds, dim=-1),
+                                                self.emb.weight[:, self.flow_dim:])
+        cross_conditions = {name: cond for name, cond in condition_tensors.items()
+                            if self.fuser.cond2fuse[name] == 'cross'}
+        fused_conditions = {name: cond for name, cond in condition_tensors.items()
+                            if name not in cross_conditions}
+        cross_attention_input: tp.Optional[torch.Tensor] = None
+        if cross_conditions:
+            # the fuser only concatenates the cross conditions, the (empty) input is left untouched.
+            first_cond = next(iter(cross_conditions.values()))[0]
+            _, cross_attention_input = self.fuser(first_cond[:, :0], cross_conditions)
+        return FMConditionInputs(
+            temporal_emb=temporal_emb,
+            fused_conditions=fused_conditions,
+            cross_attention_input=cross_attention_input,
+            cross_attention_mask=self.fuser.cross_attention_padding_bias(condition_tensors))
+
     def forward(self,
                 latents: torch.Tensor,
                 t: torch.Tensor,
                 conditions: tp.List[ConditioningAttributes],
-                condition_tensors: tp.Optional[ConditionTensors] = None) -> torch.Tensor:
+                condition_tensors: tp.Optional[ConditionTensors] = None,
+                condition_inputs: tp.Optional[FMConditionInputs] = None) -> torch.Tensor:
         """Apply flow matching forward pass on latents and conditions.
         Given a tensor of noisy latents of shape [B, T, D] with D the flow dim and T the sequence steps,
         and a time parameter tensor t, return the vector field with shape [B, T, D].
@@ -302,35 +402,35 @@ class FlowMatchingModel(StreamingModule):
                 you should pre-compute those and pass them as `condition_tensors`.
             condition_tensors (dict[str, ConditionType], optional): Pre-computed conditioning
                 tensors, see `conditions`.
+            condition_inputs (FMConditionInputs, optional): Transformer inputs pre-computed from the
+                `condition_tensors` with `prepare_condition_inputs`, used instead of them.
         Returns:
             torch.Tensor: estimated vector field v_theta.
         """
-        assert condition_tensors is not None, "FlowMatchingModel require pre-calculation of condition tensors"
         assert not conditions, "Shouldn't pass unprocessed conditions to FlowMatchingModel."
-
         B, T, D = latents.shape
-        x = latents
-
-        # concat temporal conditions on the feature dimension
-        temporal_conds = JascoCondConst.ALL.value
-        for cond in temporal_conds:
-            if cond not in condition_tensors:
-                continue
-            c = self._align_seq_length(condition_tensors[cond][0], seq_len=T)
-            x = torch.concat((x, c), dim=-1)
+        if condition_inputs is None:
+            assert condition_tensors is not None, "FlowMatchingModel require pre-calculation of condition tensors"
+            condition_inputs = self.prepare_condition_inputs(condition_tensors, T)
 
-        # project to transformer dimension
-        input_ = self.emb(x)
+        # project to transformer dimension, the temporal conditions being concatenated
+        # to the latents on the feature dimension before the projection.
+        input_ = nn.functional.linear(latents, self.emb.weight[:, :self.flow_dim])
+        if condition_inputs.temporal_emb is not None:
+            input_ = input_ + condition_inputs.temporal_emb
 
-        input_, cross_attention_input = self.fuser(input_, condition_tensors)
+        input_, _ = self.fuser(input_, condition_inputs.fused_conditions)
 
         # embed time parameter
         t_embs = self._embed_time_parameter(t)
 
         # add it to cross_attention_input
-        cross_attention_input = cross_attention_input + self.temb_proj(t_embs[:, None, :])
+        assert condition_inputs.cross_attention_input is not None
+        cross_attention_shift = self.temb_proj(t_embs[:, None, :])
 
-        out = self.transformer(input_, cross_attention_src=cross_attention_input)
+        out = self.transformer(input_, cross_attention_src=condition_inputs.cross_attention_input,
+                               cross_attention_mask=condition_inputs.cross_attention_mask,
+                               cross_attention_shift=cross_attention_shift)
 
         if self.out_norm:
             out = self.out_norm(out)
@@ -370,10 +470,8 @@ class FlowMatchingModel(StreamingModule):
             # add null term
             cfg_terms.append(NullCFGTerm(conditions=conditions, weight=1 - sum([ct.weight for ct in cfg_terms])))
 
-            # remove terms with negligible weight
-            for ct in cfg_terms:
-                if abs(ct.weight) < min_weight:
-                    cfg_terms.remove(ct)
+            # remove terms with negligible weight, their conditions are then neither computed nor evaluated.
+            cfg_terms = [ct for ct in cfg_terms if abs(ct.weight) >= min_weight]
 
             conds: tp.List[ConditioningAttributes] = sum([ct.conditions for ct in cfg_terms], [])
             tokenized = self.condition_provider.tokenize(conds)
@@ -383,21 +481,24 @@ class FlowMatchingModel(StreamingModule):
 
         return condition_tensors, cfg_terms
 
-    def estimated_vector_field(self, z, t, condition_tensors=None, cfg_terms=[]):
+    def estimated_vector_field(self, z, t, condition_tensors=None, cfg_terms=[], condition_inputs=None):
         """
         Estimates the vector field for the given latent variables and time parameter,
-        conditioned on the provided conditions.
+        conditioned on the provided conditions. All the CFG terms are evaluated in a single batched pass.
         Args:
             z (Tensor): The latent variables.
             t (float): The time variable.
             condition_tensors (ConditionTensors, optional): The condition tensors. Defaults to None.
             cfg_terms (list, optional): The list of CFG terms. Defaults to an empty list.
+            condition_inputs (FMConditionInputs, optional): Transformer inputs pre-computed from
+                the condition tensors, see `prepare_condition_inputs`. Defaults to None.
         Returns:
             Tensor: The estimated vector field.
         """
         if len(cfg_terms) > 1:
             z = z.repeat(len(cfg_terms), 1, 1)  # duplicate noisy latents for multi-source CFG
-        v_thetas = self(latents=z, t=t, conditions=[], condition_tensors=condition_tensors)
+        v_thetas = self(latents=z, t=t, conditions=[], condition_tensors=condition_tensors,
+                        condition_inputs=condition_inputs)
         return self._multi_source_cfg_postprocess(v_thetas, cfg_terms)
 
     def _multi_source_cfg_postprocess(self, v_thetas, cfg_terms):
@@ -428,9 +529,12 @@ class FlowMatchingModel(StreamingModule):
                  euler_steps: int = 100,
                  ode_rtol: float = 1e-5,
                  ode_atol: float = 1e-5,
+                 ode_solver: str = 'dopri5',
+                 nfe: int = 32,
                  ) -> torch.Tensor:
         """
-        Generate audio latents given a prompt or unconditionally. This method supports both Euler integration
+        Generate audio latents given a prompt or unconditionally. This method supports both fixed-step
+        ODE solvers (Euler, midpoint, Heun, RK4, AB2) with a fixed number of function evaluations
         and adaptive ODE solving to generate sequences based on the specified conditions and configuration coefficients.
 
         Args:
@@ -442,10 +546,13 @@ class FlowMatchingModel(StreamingModule):
             callback (Callable[[int, int], None], optional): Callback function to monitor the generation process.
             cfg_coef_all (float): Coefficient for the fully conditional CFG term.
             cfg_coef_txt (float): Coefficient for text CFG term.
-            euler (bool): If True, use Euler integration, otherwise use adaptive ODE solver.
+            euler (bool): If True, use Euler integration, otherwise use `ode_solver`.
             euler_steps (int): Number of Euler steps to perform if Euler integration is used.
-            ode_rtol (float): ODE solver rtol threshold.
-            ode_atol (float): ODE solver atol threshold.
+            ode_rtol (float): Adaptive ODE solver rtol threshold.
+            ode_atol (float): Adaptive ODE solver atol threshold.
+            ode_solver (str): Either 'dopri5' for the adaptive ODE solver, with an unbounded number of
+                function evaluations, or one of the fixed-step solvers of `FIXED_STEP_SOLVERS`.
+            nfe (int): Number of function evaluations (transformer passes) of the fixed-step solvers.
 
         Returns:
             torch.Tensor: Generated latents, shaped as (num_samples, max_gen_len, feature_dim).
@@ -468,7 +575,8 @@ class FlowMatchingModel(StreamingModule):
         assert [x == possible_num_samples[0] for x in possible_num_samples], "Inconsistent inputs shapes"
         num_samples = possible_num_samples[0]
 
-        condition_tensors, cfg_terms = self._multi_source_cfg_preprocess(conditions, cfg_coef_all, cfg_coef_txt)
+        with trace_span('conditioning', batch_size=len(conditions)):
+            condition_tensors, cfg_terms = self._multi_source_cfg_preprocess(conditions, cfg_coef_all, cfg_coef_txt)
 
         # flow matching inference
         B, T, D = num_samples, max_gen_len, self.flow_dim
@@ -476,41 +584,47 @@ class FlowMatchingModel(StreamingModule):
         z_0 = torch.randn((B, T, D), device=device)
 
         if euler:
-            # vanilla Euler intergration
-            dt = (1 / euler_steps)
-            z = z_0
-            t = torch.zeros((1, ), device=device)
-            for _ in range(euler_steps):
-                v_theta = self.estimated_vector_field(z, t,
-                                                      condition_tensors=condition_tensors,
-                                                      cfg_terms=cfg_terms)
-                z = z + dt * v_theta
-                t = t + dt
-            z_1 = z
+            ode_solver, nfe = 'euler', euler_steps
+
+        num_evals = 0
+        if ode_solver in FIXED_STEP_SOLVERS:
+            evals_per_step = FIXED_STEP_SOLVERS[ode_solver]
+            total_evals = max(1, nfe // evals_per_step) * evals_per_step
         else:
-            # solve with dynamic ode integrator (dopri5)
-            t = torch.tensor([0, 1.0 - 1e-5], device=device)
-            num_evals = 0
-
-            # define ode vector field function
-            def inner_ode_func(t, z):
-                nonlocal num_evals
-                num_evals += 1
-                if callback is not None:
-                    ESTIMATED_ODE_SOLVER_STEPS = 300
-                    callback(num_evals, ESTIMATED_ODE_SOLVER_STEPS)
+            ESTIMATED_ODE_SOLVER_STEPS = 300
+            total_evals = ESTIMATED_ODE_SOLVER_STEPS
+
+        # define ode vector field function
+        def inner_ode_func(t, z):
+            nonlocal num_evals
+            num_evals += 1
+            if callback is not None:
+                callback(num_evals, total_evals)
+            trace_count('function_evals')
+            with trace_span('lm.step'):
                 return self.estimated_vector_field(z, t,
-                                                   condition_tensors=condition_tensors,
-                                                   cfg_terms=cfg_terms)
-
-            ode_opts: dict = {"options": {}}
-            z = odeint(
-                inner_ode_func,
-                z_0,
-                t,
-                **{"atol": ode_atol, "rtol": ode_rtol, **ode_opts},
-            )
-            logger.info("Generated in %d steps", num_evals)
-            z_1 = z[-1]
+                                                   cfg_terms=cfg_terms,
+                                                   condition_inputs=condition_inputs)
+
+        # the condition projections and the cross attention keys and values are computed once
+        # and reused for all the function evaluations.
+        condition_inputs = self.prepare_condition_inputs(condition_tensors, T)
+        with cross_attention_kv_cache(self.transformer):
+            if ode_solver in FIXED_STEP_SOLVERS:
+                z_1 = fixed_step_odeint(inner_ode_func, z_0, solver=ode_solver, nfe=nfe)
+            elif ode_solver == 'dopri5':
+                # solve with dynamic ode integrator (dopri5)
+                t = torch.tensor([0, 1.0 - 1e-5], device=device)
+                ode_opts: dict = {"options": {}}
+                z = odeint(
+                    inner_ode_func,
+                    z_0,
+                    t,
+                    **{"atol": ode_atol, "rtol": ode_rtol, **ode_opts},
+                )
+                z_1 = z[-1]
+            else:
+                raise ValueError(f"Unknown ODE solver {ode_solver}.")
+        logger.info("Generated in %d steps", num_evals)
 
         return z_1
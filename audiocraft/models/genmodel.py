@@ -18,11 +18,13 @@ import omegaconf
 import torch
 
 from .encodec import CompressionModel
-from .lm import LMModel
+from .lm import CFGConditions, LMModel, get_cfg_conditions_batch_size
 from .builders import get_wrapped_compression_model
 from ..data.audio_utils import convert_audio
 from ..modules.conditioners import ConditioningAttributes
+from ..modules.kv_cache import KVBlockPool
 from ..utils.autocast import TorchAutocast
+from ..utils.profiler import Tracer, trace_span, traced
 
 
 class BaseGenModel(ABC):
@@ -71,6 +73,8 @@ class BaseGenModel(ABC):
         self.device = next(iter(lm.parameters())).device
         self.generation_params: dict = {}
         self._progress_callback: tp.Optional[tp.Callable[[int, int], None]] = None
+        # if set, the generation is recorded by this tracer, see `set_tracer`.
+        self.tracer: tp.Optional[Tracer] = None
         if self.device.type == 'cpu':
             self.autocast = TorchAutocast(enabled=False)
         else:
@@ -96,6 +100,35 @@ class BaseGenModel(ABC):
         """Override the default progress callback."""
         self._progress_callback = progress_callback
 
+    def set_compression_dtype(self, dtype: tp.Optional[torch.dtype], fold_norms: bool = True):
+        """Run the compression model encoder and decoder in reduced precision, which speeds up
+        the decoding of the generated tokens and the encoding of the audio prompts, e.g. `torch.float16`
+        on GPU or `torch.bfloat16` on CPU, where float16 convolutions are slow or unsupported.
+        See `EncodecModel.set_inference_dtype`, use None to go back to float32.
+        """
+        self.compression_model.set_inference_dtype(dtype, fold_norms=fold_norms)
+
+    def quantize_lm(self, bits: int = 8, group_size: tp.Optional[int] = None) -> int:
+        """Weight-only quantization of the language model, which reduces its memory footprint
+        and speeds up the generation on CPU. See `LMModel.quantize_weights`.
+        """
+        return self.lm.quantize_weights(bits, group_size)
+
+    def set_tracer(self, tracer: tp.Optional[Tracer]):
+        """Record the stages of the following generations with the given tracer, e.g. the conditioning,
+        each decoding step of the language model and the audio decoding, along with counters
+        such as the number of generated tokens. See `audiocraft.utils.profiler.Tracer`.
+        Use `None` to disable the tracing.
+        """
+        self.tracer = tracer
+
+    def set_kv_pool(self, pool: tp.Optional[KVBlockPool]):
+        """Store the keys and values of the language model during the generation in blocks of the given pool,
+        which can be shared with other models in the same process, e.g. the replicas of a server.
+        See `audiocraft.modules.kv_cache`. Use `None` to go back to the default cache.
+        """
+        self.lm.kv_pool = pool
+
     @abstractmethod
     def set_generation_params(self, *args, **kwargs):
         """Set the generation parameters."""
@@ -107,6 +140,7 @@ class BaseGenModel(ABC):
         raise NotImplementedError("No base implementation for getting pretrained model")
 
     @torch.no_grad()
+    @traced('prepare_inputs')
     def _prepare_tokens_and_attributes(
             self,
             descriptions: tp.Sequence[tp.Optional[str]],
@@ -126,12 +160,14 @@ class BaseGenModel(ABC):
             if descriptions is not None:
                 assert len(descriptions) == len(prompt), "Prompt and nb. descriptions doesn't match"
             prompt = prompt.to(self.device)
-            prompt_tokens, scale = self.compression_model.encode(prompt)
+            with trace_span('encode_prompt'):
+                prompt_tokens, scale = self.compression_model.encode(prompt)
             assert scale is None
         else:
             prompt_tokens = None
         return attributes, prompt_tokens
 
+    @traced('generate')
     def generate_unconditional(self, num_samples: int, progress: bool = False,
                                return_tokens: bool = False) -> tp.Union[torch.Tensor,
                                                                         tp.Tuple[torch.Tensor, torch.Tensor]]:
@@ -148,21 +184,51 @@ class BaseGenModel(ABC):
             return self.generate_audio(tokens), tokens
         return self.generate_audio(tokens)
 
-    def generate(self, descriptions: tp.List[str], progress: bool = False, return_tokens: bool = False) \
+    @torch.no_grad()
+    @traced('compute_cfg_conditions')
+    def compute_cfg_conditions(self, descriptions: tp.Sequence[tp.Optional[str]]) -> CFGConditions:
+        """Compute the condition tensors for the given text descriptions, including the null conditions
+        used for classifier free guidance, according to the current generation params.
+        They can be passed to `generate` with the `cfg_conditions` argument to skip the conditioning
+        on repeated calls, or saved with `audiocraft.models.lm.save_cfg_conditions` and loaded
+        in other processes with `audiocraft.models.lm.load_cfg_conditions`.
+
+        Args:
+            descriptions (list of str): A list of strings used as text conditioning.
+        """
+        attributes, _ = self._prepare_tokens_and_attributes(descriptions, None)
+        with self.autocast:
+            return self.lm.prepare_cfg_conditions(
+                attributes, cfg_coef_beta=self.generation_params.get('cfg_coef_beta'),
+                two_step_cfg=self.generation_params.get('two_step_cfg'))
+
+    @traced('generate')
+    def generate(self, descriptions: tp.List[str], progress: bool = False, return_tokens: bool = False,
+                 cfg_conditions: tp.Optional[CFGConditions] = None) \
             -> tp.Union[torch.Tensor, tp.Tuple[torch.Tensor, torch.Tensor]]:
         """Generate samples conditioned on text.
 
         Args:
             descriptions (list of str): A list of strings used as text conditioning.
             progress (bool, optional): Flag to display progress of the generation process. Defaults to False.
+            cfg_conditions (CFGConditions, optional): Pre-computed conditions from `compute_cfg_conditions`,
+                in which case the descriptions are only used to get the number of samples. Defaults to None.
         """
-        attributes, prompt_tokens = self._prepare_tokens_and_attributes(descriptions, None)
-        assert prompt_tokens is None
-        tokens = self._generate_tokens(attributes, prompt_tokens, progress)
+        if cfg_conditions is not None:
+            assert len(descriptions) == get_cfg_conditions_batch_size(
+                cfg_conditions, self.generation_params.get('cfg_coef_beta')), \
+                "Pre-computed conditions and nb. descriptions doesn't match"
+            tokens = self._generate_tokens([], None, progress, cfg_conditions=cfg_conditions,
+                                           num_samples=len(descriptions))
+        else:
+            attributes, prompt_tokens = self._prepare_tokens_and_attributes(descriptions, None)
+            assert prompt_tokens is None
+            tokens = self._generate_tokens(attributes, prompt_tokens, progress)
         if return_tokens:
             return self.generate_audio(tokens), tokens
         return self.generate_audio(tokens)
 
+    @traced('generate')
     def generate_continuation(self, prompt: torch.Tensor, prompt_sample_rate: int,
                               descriptions: tp.Optional[tp.List[tp.Optional[str]]] = None,
                               progress: bool = False, return_tokens: bool = False) \
@@ -190,14 +256,20 @@ class BaseGenModel(ABC):
             return self.generate_audio(tokens), tokens
         return self.generate_audio(tokens)
 
+    @traced('generate_tokens')
     def _generate_tokens(self, attributes: tp.List[ConditioningAttributes],
-                         prompt_tokens: tp.Optional[torch.Tensor], progress: bool = False) -> torch.Tensor:
+                         prompt_tokens: tp.Optional[torch.Tensor], progress: bool = False,
+                         cfg_conditions: tp.Optional[CFGConditions] = None,
+                         num_samples: tp.Optional[int] = None, **kwargs) -> torch.Tensor:
         """Generate discrete audio tokens given audio prompt and/or conditions.
 
         Args:
             attributes (list of ConditioningAttributes): Conditions used for generation (here text).
             prompt_tokens (torch.Tensor, optional): Audio prompt used for continuation.
             progress (bool, optional): Flag to display progress of the generation process. Defaults to False.
+            cfg_conditions (CFGConditions, optional): Pre-computed conditions used instead of `attributes`.
+            num_samples (int, optional): Number of samples, required along with `cfg_conditions`.
+            **kwargs: Additional arguments for the generate method of the language model.
         Returns:
             torch.Tensor: Generated audio, of shape [B, C, T], T is defined by the generation params.
         """
@@ -222,12 +294,16 @@ class BaseGenModel(ABC):
         if progress:
             callback = _progress_callback
 
+        lm_kwargs: dict = dict(self.generation_params, **kwargs)
+        if cfg_conditions is not None:
+            lm_kwargs.update(cfg_conditions=cfg_conditions, num_samples=num_samples)
+
         if self.duration <= self.max_duration:
             # generate by sampling from LM, simple case.
             with self.autocast:
                 gen_tokens = self.lm.generate(
                     prompt_tokens, attributes,
-                    callback=callback, max_gen_len=total_gen_len, **self.generation_params)
+                    callback=callback, max_gen_len=total_gen_len, **lm_kwargs)
 
         else:
             assert self.extend_stride is not None, "Stride should be defined to generate beyond max_duration"
@@ -247,7 +323,7 @@ class BaseGenModel(ABC):
                 with self.autocast:
                     gen_tokens = self.lm.generate(
                         prompt_tokens, attributes,
-                        callback=callback, max_gen_len=max_gen_len, **self.generation_params)
+                        callback=callback, max_gen_len=max_gen_len, **lm_kwargs)
                 if prompt_tokens is None:
                     all_tokens.append(gen_tokens)
                 else:
@@ -259,6 +335,7 @@ class BaseGenModel(ABC):
             gen_tokens = torch.cat(all_tokens, dim=-1)
         return gen_tokens
 
+    @traced('decode')
     def generate_audio(self, gen_tokens: torch.Tensor) -> torch.Tensor:
         """Generate Audio from tokens."""
         assert gen_tokens.dim() == 3
@@ -19,6 +19,7 @@ from .genmodel import BaseGenModel
 from .loaders import load_compression_model, load_jasco_model
 from ..data.audio_utils import convert_audio
 from ..modules.conditioners import WavCondition, ConditioningAttributes, SymbolicCondition, JascoCondConst
+from ..utils.profiler import traced
 
 
 class JASCO(BaseGenModel):
@@ -74,7 +75,8 @@ class JASCO(BaseGenModel):
                                             all conditions term. Defaults to 5.0.
             cfg_coef_txt (float, optional): Coefficient used in multi-source classifier free guidance -
                                             text condition term. Defaults to 0.0.
-
+            **kwargs: Additional parameters of `FlowMatchingModel.generate`, e.g. `ode_solver='heun'`
+                      and `nfe=32` to use a fixed-step ODE solver with a fixed number of function evaluations.
         """
         self.generation_params = {
             'cfg_coef_all': cfg_coef_all,
@@ -88,6 +90,7 @@ class JASCO(BaseGenModel):
         scaled = latents * self.cfg.compression_model_latent_std
         return scaled + self.cfg.compression_model_latent_mean
 
+    @traced('decode')
     def generate_audio(self, gen_latents: torch.Tensor) -> torch.Tensor:
         """Decode audio from generated latents"""
         assert gen_latents.dim() == 3  # [B, T, C]
@@ -96,6 +99,7 @@ class JASCO(BaseGenModel):
         gen_latents = self._unnormalized_latents(gen_latents)
         return self.compression_model.model.decoder(gen_latents.permute(0, 2, 1))
 
+    @traced('generate_tokens')
     def _generate_tokens(self, attributes: tp.List[ConditioningAttributes],
                          prompt_tokens: tp.Optional[torch.Tensor], progress: bool = False) -> torch.Tensor:
         """Generate continuous audio latents given conditions.
@@ -111,10 +115,9 @@ class JASCO(BaseGenModel):
         max_prompt_len = int(min(self.duration, self.max_duration) * self.frame_rate)
 
         def _progress_callback(ode_steps: int, max_ode_steps: int):
-            ode_steps += 1
+            # ode_steps counts the function evaluations from 1, and max_ode_steps is only
+            # an estimate with the adaptive ODE solver.
             if self._progress_callback is not None:
-                # Note that total_gen_len might be quite wrong depending on the
-                # codebook pattern used, but with delay it is almost accurate.
                 self._progress_callback(ode_steps, max_ode_steps)
             else:
                 print(f'{ode_steps: 6d} / {max_ode_steps: 6d}', end='\r')
@@ -266,6 +269,7 @@ class JASCO(BaseGenModel):
         return attributes
 
     @torch.no_grad()
+    @traced('generate')
     def generate_music(
         self, descriptions: tp.List[str],
         drums_wav: tp.Optional[torch.Tensor] = None,
@@ -4,18 +4,22 @@
 # This source code is licensed under the license found in the
 # LICENSE file in the root directory of this source tree.
 
+import contextlib
 from dataclasses import dataclass
 from functools import partial
 import logging
 import math
+from pathlib import Path
 import typing as tp
 
 import torch
 from torch import nn
 
 from ..utils import utils
+from ..utils.profiler import trace_count, trace_span
 from ..modules.streaming import StreamingModule, State
-from ..modules.transformer import StreamingTransformer, create_norm_fn
+from ..modules.kv_cache import KVBlockPool
+from ..modules.transformer import StreamingTransformer, create_norm_fn, paged_kv_cache
 from ..modules.conditioners import (
     ConditionFuser,
     ClassifierFreeGuidanceDropout,
@@ -27,11 +31,63 @@ from ..modules.conditioners import (
 )
 from ..modules.codebooks_patterns import CodebooksPatternProvider
 from ..modules.activations import get_activation_fn
+from ..modules.parallel import shard_transformer_
+from ..modules.weight_quantization import QuantizedEmbedding, quantize_linears_
 
 
 logger = logging.getLogger(__name__)
 ConditionTensors = tp.Dict[str, ConditionType]
 CFGConditions = tp.Union[ConditionTensors, tp.Tuple[ConditionTensors, ConditionTensors]]
+CFG_CONDITIONS_VERSION = 1
+
+
+def get_cfg_conditions_batch_size(cfg_conditions: CFGConditions, cfg_coef_beta: tp.Optional[float] = None) -> int:
+    """Return the number of samples that pre-computed CFG conditions were prepared for,
+    see `LMModel.prepare_cfg_conditions`.
+    """
+    if isinstance(cfg_conditions, tuple):
+        cfg_conditions = cfg_conditions[0]
+        num_branches = 1
+    else:
+        num_branches = 2 if cfg_coef_beta is None else 3
+    assert cfg_conditions, "Cannot infer the batch size from empty conditions."
+    cond, _ = next(iter(cfg_conditions.values()))
+    assert cond.shape[0] % num_branches == 0, "Conditions do not match the classifier free guidance setup."
+    return cond.shape[0] // num_branches
+
+
+def save_cfg_conditions(cfg_conditions: CFGConditions, path: tp.Union[str, Path]) -> None:
+    """Save pre-computed CFG conditions (see `LMModel.prepare_cfg_conditions`) to disk,
+    so that they can be computed once and reused for generation by other processes.
+
+    Args:
+        cfg_conditions (CFGConditions): Conditions, either a single dict of condition tensors with the
+            null conditions concatenated along the batch dimension, or a tuple of conditional
+            and null condition tensors for two step classifier free guidance.
+        path (str or Path): Destination file.
+    """
+    def _to_cpu(condition_tensors: ConditionTensors) -> ConditionTensors:
+        return {attr: (cond.cpu(), mask.cpu()) for attr, (cond, mask) in condition_tensors.items()}
+
+    two_step_cfg = isinstance(cfg_conditions, tuple)
+    all_conditions = list(cfg_conditions) if isinstance(cfg_conditions, tuple) else [cfg_conditions]
+    pkg = {
+        'version': CFG_CONDITIONS_VERSION,
+        'two_step_cfg': two_step_cfg,
+        'conditions': [_to_cpu(condition_tensors) for condition_tensors in all_conditions],
+    }
+    torch.save(pkg, path)
+
+
+def load_cfg_conditions(path: tp.Union[str, Path], device: tp.Union[torch.device, str] = 'cpu') -> CFGConditions:
+    """Load CFG conditions saved with `save_cfg_conditions` on the given device."""
+    pkg = torch.load(path, map_location=device)
+    assert pkg.get('version') == CFG_CONDITIONS_VERSION, f"Unsupported CFG conditions version in {path}."
+    all_conditions = [{attr: (cond.to(device), mask.to(device)) for attr, (cond, mask) in condition_tensors.items()}
+                      for condition_tensors in pkg['conditions']]
+    if pkg['two_step_cfg']:
+        return tuple(all_conditions)  # type: ignore
+    return all_conditions[0]
 
 
 def get_init_fn(method: str, input_dim: int, init_depth: tp.Optional[int] = None):
@@ -109,6 +165,71 @@ class ScaledEmbedding(nn.Embedding):
         return group
 
 
+def _stack_legacy_keys(state_dict, prefix: str, n_q: int, names: tp.Sequence[str], new_prefix: str):
+    # Checkpoints saved before the fusion of the codebooks embeddings and heads have one module per codebook.
+    for name in names:
+        legacy_keys = [f"{prefix}{k}.{name}" for k in range(n_q)]
+        if all(key in state_dict for key in legacy_keys):
+            state_dict[f"{prefix}{new_prefix}.{name}"] = torch.cat([state_dict.pop(key) for key in legacy_keys])
+
+
+class CodebooksEmbedding(nn.Module):
+    """Sum of the embeddings of the tokens of all the codebooks, looked up in a single table
+    of `n_q * num_embeddings` rows, the rows of codebook `k` starting at `k * num_embeddings`.
+
+    Args:
+        n_q (int): Number of codebooks.
+        num_embeddings (int): Number of embeddings per codebook.
+        dim (int): Dimension of the embeddings.
+        lr (float, optional): Embedding-specific learning rate, see `ScaledEmbedding`.
+    """
+    def __init__(self, n_q: int, num_embeddings: int, dim: int, lr: tp.Optional[float] = None, **kwargs):
+        super().__init__()
+        self.n_q = n_q
+        self.num_embeddings = num_embeddings
+        self.table: nn.Module = ScaledEmbedding(n_q * num_embeddings, dim, lr=lr, **kwargs)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        _stack_legacy_keys(state_dict, prefix, self.n_q, ['weight'], 'table')
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def forward(self, sequence: torch.Tensor) -> torch.Tensor:
+        """Return the summed embeddings of shape [B, S, dim] of the tokens of shape [B, K, S]."""
+        B, K, S = sequence.shape
+        offsets = torch.arange(K, device=sequence.device) * self.num_embeddings
+        indices = sequence + offsets.view(1, K, 1)
+        if isinstance(self.table, nn.Embedding):
+            bags = indices.transpose(1, 2).reshape(B * S, K)
+            return nn.functional.embedding_bag(bags, self.table.weight, mode='sum').view(B, S, -1)
+        # e.g. quantized table, see `LMModel.quantize_weights`.
+        return self.table(indices).sum(dim=1)
+
+
+class CodebooksLinear(nn.Module):
+    """Output heads of all the codebooks, applied with a single matmul.
+
+    Args:
+        n_q (int): Number of codebooks.
+        dim (int): Input dimension.
+        card (int): Cardinality of each codebook.
+        bias (bool): Use bias.
+    """
+    def __init__(self, n_q: int, dim: int, card: int, bias: bool = True, **kwargs):
+        super().__init__()
+        self.n_q = n_q
+        self.card = card
+        self.proj: nn.Module = nn.Linear(dim, n_q * card, bias=bias, **kwargs)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        _stack_legacy_keys(state_dict, prefix, self.n_q, ['weight', 'bias'], 'proj')
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        """Return the logits of shape [B, K, S, card] for the input of shape [B, S, dim]."""
+        B, S, _ = x.shape
+        return self.proj(x).view(B, S, self.n_q, self.card).transpose(1, 2)
+
+
 @dataclass
 class LMOutput:
     # The logits are already re-aligned with the input codes
@@ -162,7 +283,7 @@ class LMModel(StreamingModule):
         self.dim = dim
         self.pattern_provider = pattern_provider
         self.two_step_cfg = two_step_cfg
-        self.emb = nn.ModuleList([ScaledEmbedding(embed_dim, dim, lr=emb_lr) for _ in range(n_q)])
+        self.emb = CodebooksEmbedding(n_q, embed_dim, dim, lr=emb_lr)
         if 'activation' in kwargs:
             kwargs['activation'] = get_activation_fn(kwargs['activation'])
         self.transformer = StreamingTransformer(
@@ -171,10 +292,12 @@ class LMModel(StreamingModule):
         self.out_norm: tp.Optional[nn.Module] = None
         if norm_first:
             self.out_norm = create_norm_fn(norm, dim)
-        self.linears = nn.ModuleList([nn.Linear(dim, self.card, bias=bias_proj) for _ in range(n_q)])
+        self.linears = CodebooksLinear(n_q, dim, self.card, bias=bias_proj)
         self._init_weights(weight_init, depthwise_init, zero_bias_init)
         self._fsdp: tp.Optional[nn.Module]
         self.__dict__['_fsdp'] = None
+        # if set, `generate` stores the keys and values in blocks of this pool, see `audiocraft.modules.kv_cache`.
+        self.kv_pool: tp.Optional[KVBlockPool] = None
 
     def _init_weights(self, weight_init: tp.Optional[str], depthwise_init: tp.Optional[str], zero_bias_init: bool):
         """Initialization of the transformer module weights.
@@ -195,8 +318,7 @@ class LMModel(StreamingModule):
         if weight_init is None:
             return
 
-        for emb_layer in self.emb:
-            init_layer(emb_layer, method=weight_init, init_depth=None, zero_bias_init=zero_bias_init)
+        init_layer(self.emb.table, method=weight_init, init_depth=None, zero_bias_init=zero_bias_init)
 
         for layer_idx, tr_layer in enumerate(self.transformer.layers):
             depth = None
@@ -207,8 +329,7 @@ class LMModel(StreamingModule):
             init_fn = partial(init_layer, method=weight_init, init_depth=depth, zero_bias_init=zero_bias_init)
             tr_layer.apply(init_fn)
 
-        for linear in self.linears:
-            init_layer(linear, method=weight_init, init_depth=None, zero_bias_init=zero_bias_init)
+        init_layer(self.linears.proj, method=weight_init, init_depth=None, zero_bias_init=zero_bias_init)
 
     @property
     def special_token_id(self) -> int:
@@ -218,6 +339,43 @@ class LMModel(StreamingModule):
     def num_codebooks(self) -> int:
         return self.n_q
 
+    def get_stage_attn_mask(self, stage: int) -> tp.Any:
+        """Self-attention mask to use when predicting the given codebook `stage`, see `forward`."""
+        return None
+
+    def quantize_weights(self, bits: int = 8, group_size: tp.Optional[int] = None) -> int:
+        """Weight-only quantization of the transformer linear layers and of the output heads,
+        with the embedding tables quantized to int8, for inference on CPU. This is irreversible, and the model
+        state dict then holds the quantized buffers. The conditioners are left untouched.
+
+        Args:
+            bits (int): Number of bits of the quantized linear weights, 8 or 4.
+            group_size (int, optional): Number of input features sharing a scale, per output channel if None.
+                A group size of 64 or 128 is recommended with 4 bits.
+        Returns:
+            int: Number of quantized layers.
+        """
+        assert not self.training, "Quantization is only supported for inference."
+        count = quantize_linears_(self.transformer, bits, group_size)
+        count += quantize_linears_(self.linears, bits, group_size)
+        if isinstance(self.emb.table, nn.Embedding):
+            self.emb.table = QuantizedEmbedding.from_embedding(self.emb.table)
+            count += 1
+        return count
+
+    def shard_for_inference(self, mode: str, group: tp.Optional[tp.Any] = None):
+        """Shard the transformer over the processes of a `torch.distributed` group, for inference only.
+        The embeddings, output heads and conditioners are replicated on all the processes, which must all run
+        the same generation, with the same seed. See `audiocraft.modules.parallel` for the details.
+
+        Args:
+            mode (str): Either 'tensor' to split the attention heads and feed forward channels of each layer,
+                or 'pipeline' to split the layers in contiguous stages.
+            group (torch.distributed.ProcessGroup, optional): Process group, the default one if None.
+        """
+        assert not self.training, "Sharding is only supported for inference."
+        shard_transformer_(self.transformer, mode, group)
+
     def forward(self, sequence: torch.Tensor,
                 conditions: tp.List[ConditioningAttributes],
                 condition_tensors: tp.Optional[ConditionTensors] = None,
@@ -241,7 +399,7 @@ class LMModel(StreamingModule):
         """
         B, K, S = sequence.shape
         assert K == self.num_codebooks, "Sequence shape must match the specified number of codebooks"
-        input_ = sum([self.emb[k](sequence[:, k]) for k in range(K)])
+        input_ = self.emb(sequence)
         if condition_tensors is None:
             assert not self._is_streaming, "Conditions tensors should be precomputed when streaming."
             # apply dropout modules
@@ -254,12 +412,14 @@ class LMModel(StreamingModule):
             assert not conditions, "Shouldn't pass both conditions and condition_tensors."
 
         input_, cross_attention_input = self.fuser(input_, condition_tensors)
+        cross_attention_mask = self.fuser.cross_attention_padding_bias(condition_tensors)
 
         out = self.transformer(input_, cross_attention_src=cross_attention_input,
-                               src_mask=(self.attn_mask_per_stage[stage] if stage >= 0 else None))  # type: ignore
+                               cross_attention_mask=cross_attention_mask,
+                               src_mask=(self.get_stage_attn_mask(stage) if stage >= 0 else None))
         if self.out_norm:
             out = self.out_norm(out)
-        logits = torch.stack([self.linears[k](out) for k in range(K)], dim=1)  # [B, K, S, card]
+        logits = self.linears(out)  # [B, K, S, card]
 
         # remove the prefix from the model outputs
         if len(self.fuser.fuse2cond['prepend']) > 0:
@@ -366,6 +526,7 @@ class LMModel(StreamingModule):
                 # Preparing for CFG, predicting conditional text and style, conditional style
                 # and unconditional
                 sequence = torch.cat([sequence, sequence, sequence], dim=0)
+                trace_count('cfg_rows', 2 * B)
             all_logits = model(
                 sequence,
                 conditions=[], condition_tensors=condition_tensors)
@@ -378,6 +539,7 @@ class LMModel(StreamingModule):
         elif two_step_cfg and cfg_conditions != {}:
             assert isinstance(cfg_conditions, tuple), type(cfg_conditions)
             condition_tensors, null_condition_tensors = cfg_conditions
+            trace_count('cfg_rows', B)
             cond_logits = model(sequence, conditions=[], condition_tensors=condition_tensors)
             state = self.get_streaming_state()
             self.set_streaming_state(unconditional_state)
@@ -391,6 +553,7 @@ class LMModel(StreamingModule):
             if condition_tensors:
                 # Preparing for CFG, predicting both conditional and unconditional logits.
                 sequence = torch.cat([sequence, sequence], dim=0)
+                trace_count('cfg_rows', B)
             all_logits = model(
                 sequence,
                 conditions=[], condition_tensors=condition_tensors)
@@ -403,20 +566,74 @@ class LMModel(StreamingModule):
         logits = logits.permute(0, 1, 3, 2)  # [B, K, card, T]
         logits = logits[..., -1]  # [B x K x card]
 
-        # Apply softmax for sampling if temp > 0. Else, do greedy sampling to avoid zero division error.
-        if use_sampling and temp > 0.0:
-            probs = torch.softmax(logits / temp, dim=-1)
-            if top_p > 0.0:
-                next_token = utils.sample_top_p(probs, p=top_p)
-            elif top_k > 0:
-                next_token = utils.sample_top_k(probs, k=top_k)
+        with trace_span('lm.sampling'):
+            # Apply softmax for sampling if temp > 0. Else, do greedy sampling to avoid zero division error.
+            if use_sampling and temp > 0.0:
+                probs = torch.softmax(logits / temp, dim=-1)
+                if top_p > 0.0:
+                    next_token = utils.sample_top_p(probs, p=top_p)
+                elif top_k > 0:
+                    next_token = utils.sample_top_k(probs, k=top_k)
+                else:
+                    next_token = utils.multinomial(probs, num_samples=1)
             else:
-                next_token = utils.multinomial(probs, num_samples=1)
-        else:
-            next_token = torch.argmax(logits, dim=-1, keepdim=True)
+                next_token = torch.argmax(logits, dim=-1, keepdim=True)
 
         return next_token
 
+    @torch.no_grad()
+    def prepare_cfg_conditions(self, conditions: tp.List[ConditioningAttributes],
+                               cfg_coef_beta: tp.Optional[float] = None,
+                               two_step_cfg: tp.Optional[bool] = None) -> CFGConditions:
+        """Tokenize and encode the given conditions along with the null conditions used for
+        classifier free guidance, in the format expected by `generate`. The output can be computed once
+        and passed to several `generate` calls with the `cfg_conditions` argument, or saved to disk
+        with `save_cfg_conditions`.
+
+        Args:
+            conditions (list of ConditioningAttributes): List of conditions.
+            cfg_coef_beta (float, optional): If not None, prepare the conditions for double classifier
+                free guidance, see `generate`.
+            two_step_cfg (bool, optional): Whether to prepare the conditions for classifier-free guidance
+                with two steps generation. Defaults to the model `two_step_cfg`.
+        Returns:
+            CFGConditions: Either a dict of condition tensors with the null conditions concatenated
+                along the batch dimension, or a tuple of conditional and null condition tensors
+                when `two_step_cfg` is used. Empty if no conditions are given.
+        """
+        # below we create set of conditions: one conditional and one unconditional
+        # to do that we merge the regular condition together with the null condition
+        # we then do 1 forward pass instead of 2.
+        # the reason for that is two-fold:
+        # 1. it is about x2 faster than doing 2 forward passes
+        # 2. avoid the streaming API treating the 2 passes as part of different time steps
+        # We also support doing two different passes, in particular to ensure that
+        # the padding structure is exactly the same between train and test.
+        # With a batch size of 1, this can be slower though.
+        cfg_conditions: CFGConditions = {}
+        if not conditions:
+            return cfg_conditions
+        with trace_span('conditioning', batch_size=len(conditions)):
+            if cfg_coef_beta is not None:
+                wav_conditions = _drop_description_condition(conditions)
+                null_conditions = ClassifierFreeGuidanceDropout(p=1.0)(conditions)
+                conditions = conditions + wav_conditions + null_conditions
+                tokenized = self.condition_provider.tokenize(conditions)
+                cfg_conditions = self.condition_provider(tokenized)
+            else:
+                two_step_cfg = self.two_step_cfg if two_step_cfg is None else two_step_cfg
+                null_conditions = ClassifierFreeGuidanceDropout(p=1.0)(conditions)
+                if two_step_cfg:
+                    cfg_conditions = (
+                        self.condition_provider(self.condition_provider.tokenize(conditions)),
+                        self.condition_provider(self.condition_provider.tokenize(null_conditions)),
+                    )
+                else:
+                    conditions = conditions + null_conditions
+                    tokenized = self.condition_provider.tokenize(conditions)
+                    cfg_conditions = self.condition_provider(tokenized)
+        return cfg_conditions
+
     @torch.no_grad()
     def generate(self,
                  prompt: tp.Optional[torch.Tensor] = None,
@@ -433,6 +650,7 @@ class LMModel(StreamingModule):
                  remove_prompts: bool = False,
                  check: bool = False,
                  callback: tp.Optional[tp.Callable[[int, int], None]] = None,
+                 cfg_conditions: tp.Optional[CFGConditions] = None,
                  ) -> torch.Tensor:
         """Generate tokens sampling from the model given a prompt or unconditionally. Generation can
         be performed in a greedy fashion or using sampling with top K and top P strategies.
@@ -456,12 +674,19 @@ class LMModel(StreamingModule):
             remove_prompts (bool): Whether to remove prompts from generation or not.
             check (bool): Whether to apply further checks on generated sequence.
             callback (Callback, optional): Callback function to report generation progress.
+            cfg_conditions (CFGConditions, optional): Pre-computed conditions as returned by
+                `prepare_cfg_conditions`, used instead of `conditions` which should then be empty.
+                They must have been prepared with the same `cfg_coef_beta` and `two_step_cfg`.
         Returns:
             torch.Tensor: Generated tokens.
         """
         assert not self.training, "generation shouldn't be used in training mode."
         first_param = next(iter(self.parameters()))
         device = first_param.device
+        if cfg_conditions is not None:
+            assert not conditions, "Shouldn't pass both conditions and cfg_conditions."
+            two_step_cfg = isinstance(cfg_conditions, tuple)
+            trace_count('cfg_conditions_reused')
 
         # Checking all input shapes are consistent.
         possible_num_samples = []
@@ -471,44 +696,15 @@ class LMModel(StreamingModule):
             possible_num_samples.append(prompt.shape[0])
         elif conditions:
             possible_num_samples.append(len(conditions))
+        elif cfg_conditions:
+            possible_num_samples.append(get_cfg_conditions_batch_size(cfg_conditions, cfg_coef_beta))
         else:
             possible_num_samples.append(1)
         assert [x == possible_num_samples[0] for x in possible_num_samples], "Inconsistent inputs shapes"
         num_samples = possible_num_samples[0]
 
-        # below we create set of conditions: one conditional and one unconditional
-        # to do that we merge the regular condition together with the null condition
-        # we then do 1 forward pass instead of 2.
-        # the reason for that is two-fold:
-        # 1. it is about x2 faster than doing 2 forward passes
-        # 2. avoid the streaming API treating the 2 passes as part of different time steps
-        # We also support doing two different passes, in particular to ensure that
-        # the padding structure is exactly the same between train and test.
-        # With a batch size of 1, this can be slower though.
-        cfg_conditions: CFGConditions
-        cfg_conditions = {}
-        if cfg_coef_beta is not None:
-            if conditions:
-                wav_conditions = _drop_description_condition(conditions)
-                null_conditions = ClassifierFreeGuidanceDropout(p=1.0)(conditions)
-                conditions = conditions + wav_conditions + null_conditions
-                tokenized = self.condition_provider.tokenize(conditions)
-                cfg_conditions = self.condition_provider(tokenized)
-        elif conditions:
-            two_step_cfg = self.two_step_cfg if two_step_cfg is None else two_step_cfg
-            if conditions:
-                null_conditions = ClassifierFreeGuidanceDropout(p=1.0)(conditions)
-                if two_step_cfg:
-                    cfg_conditions = (
-                        self.condition_provider(self.condition_provider.tokenize(conditions)),
-                        self.condition_provider(self.condition_provider.tokenize(null_conditions)),
-                    )
-                else:
-                    conditions = conditions + null_conditions
-                    tokenized = self.condition_provider.tokenize(conditions)
-                    cfg_conditions = self.condition_provider(tokenized)
-        else:
-            cfg_conditions = {}
+        if cfg_conditions is None:
+            cfg_conditions = self.prepare_cfg_conditions(conditions, cfg_coef_beta, two_step_cfg)
 
         if prompt is None:
             assert num_samples > 0
@@ -533,7 +729,8 @@ class LMModel(StreamingModule):
         start_offset_sequence = pattern.get_first_step_with_timesteps(start_offset)
         assert start_offset_sequence is not None
 
-        with self.streaming():
+        kv_cache = contextlib.nullcontext() if self.kv_pool is None else paged_kv_cache(self, self.kv_pool)
+        with self.streaming(), kv_cache:
             unconditional_state = self.get_streaming_state()
             prev_offset = 0
             gen_sequence_len = gen_sequence.shape[-1]  # gen_sequence shape is [B, K, S]
@@ -547,9 +744,11 @@ class LMModel(StreamingModule):
                     # should never happen as gen_sequence is filled progressively
                     assert not (curr_sequence == unknown_token).any()
                 # sample next token from the model, next token shape is [B, K, 1]
-                next_token = self._sample_next_token(
-                    curr_sequence, cfg_conditions, unconditional_state, use_sampling, temp, top_k, top_p,
-                    cfg_coef=cfg_coef, cfg_coef_beta=cfg_coef_beta, two_step_cfg=two_step_cfg)
+                with trace_span('lm.prefill' if offset == start_offset_sequence else 'lm.step'):
+                    next_token = self._sample_next_token(
+                        curr_sequence, cfg_conditions, unconditional_state, use_sampling, temp, top_k, top_p,
+                        cfg_coef=cfg_coef, cfg_coef_beta=cfg_coef_beta, two_step_cfg=two_step_cfg)
+                trace_count('tokens', B * K)
                 # ensure the tokens that should be masked are properly set to special_token_id
                 # as the model never output special_token_id
                 valid_mask = mask[..., offset:offset+1].expand(B, -1, -1)
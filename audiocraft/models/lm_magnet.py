@@ -8,15 +8,16 @@ import logging
 import math
 import typing as tp
 import torch
-import numpy as np
+import torch.nn.functional as F
 
 from ..utils import utils
+from ..utils.profiler import trace_count, trace_span
 from ..modules.conditioners import (
-    ClassifierFreeGuidanceDropout,
     ConditioningAttributes,
     ConditionType,
 )
-from .lm import LMModel
+from ..modules.transformer import LocalAttentionMask
+from .lm import LMModel, get_cfg_conditions_batch_size
 
 logger = logging.getLogger(__name__)
 ConditionTensors = tp.Dict[str, ConditionType]
@@ -40,10 +41,14 @@ class MagnetLMModel(LMModel):
         self.causal = kwargs['causal']
         self.subcodes_context = subcodes_context
         self.span_len = span_len
-        self._build_attn_masks(compression_model_framerate=compression_model_framerate,
-                               segment_duration=segment_duration,
-                               num_heads=kwargs['num_heads'],
-                               device=kwargs['device'], dtype=kwargs['dtype'])
+        self.compression_model_framerate = compression_model_framerate
+        self.segment_duration = segment_duration
+        # The local attention of the codebooks > 0 is computed block-wise, without any materialized mask.
+        self.local_attn_mask: tp.Optional[LocalAttentionMask] = None
+        if subcodes_context > -1:
+            self.local_attn_mask = LocalAttentionMask(subcodes_context)
+        # Decoding steps planned and actually run for each stage by the last generation (see early exit).
+        self.decoding_stats: tp.Dict[str, tp.Any] = {}
 
     def restricted_context_attn_mask(self, seq_len: int, device: torch.device, dtype: torch.dtype) -> torch.Tensor:
         """Creates a restricted attention mask (local attention map) where the context
@@ -55,64 +60,19 @@ class MagnetLMModel(LMModel):
         Returns:
             torch.Tensor: The restricted attention mask.
         """
-        # Return a context restricted non-causal att mask
-        queries_pos = torch.arange(seq_len, device=device).view(-1, 1)
-        keys_pos = torch.arange(seq_len, device=device).view(1, -1)
-
-        delta = queries_pos - keys_pos
-        valid = torch.abs(delta) <= self.subcodes_context
-        return torch.where(
-            valid,
-            torch.zeros([], device=device, dtype=dtype),
-            torch.full([], float('-inf'), device=device, dtype=dtype))
-
-    def _stage_attn_mask(self, stage: int, seq_len: int, num_heads: int,
-                         device: torch.device, dtype: torch.dtype) -> tp.Optional[torch.Tensor]:
-        """Creates a restricted attention mask given the stage (codebook index).
+        return LocalAttentionMask(max(self.subcodes_context, 0)).to_dense(seq_len, torch.device(device), dtype)
+
+    def get_stage_attn_mask(self, stage: int) -> tp.Optional[LocalAttentionMask]:
+        """Return the self-attention mask given the stage (codebook index).
         Args:
             stage (int): The codebook index. Takes values in [0, n_q].
-            seq_len (int): Token sequence length.
-            num_heads (int): Num transformer attention heads.
-            device (torch.device): device of the output tensor.
-            dtype (torch.dtype): data type of the output tensor.
         Returns:
-            torch.Tensor: Either a restricted attention mask or None if stage attention is unrestricted.
-        """
-        sa_mask = None
-
-        if stage > 0 and self.subcodes_context > -1:
-            # parallel - non-causal - with restricted subcodes context
-            sa_mask = self.restricted_context_attn_mask(seq_len, device=device, dtype=dtype)
-
-        if sa_mask is not None:
-            # Repeat for each attention head
-            sa_mask = sa_mask.repeat((1, num_heads, 1, 1))
-
-            # align8 to enable memory efficient attention
-            MEMORY_EFFICIENT_ATTN_ALIGN_FACTOR = 8
-            seq_len_aligned = \
-                int(np.ceil(seq_len / MEMORY_EFFICIENT_ATTN_ALIGN_FACTOR)) * MEMORY_EFFICIENT_ATTN_ALIGN_FACTOR
-
-            sa_mask_aligned = torch.zeros((1, num_heads, seq_len_aligned, seq_len_aligned), device=device, dtype=dtype)
-            sa_mask_aligned[..., :seq_len, :seq_len] = sa_mask
-            sa_mask = sa_mask_aligned
-
-        return sa_mask
-
-    def _build_attn_masks(self, compression_model_framerate: int, segment_duration: int, num_heads: int,
-                          device: torch.device, dtype: torch.dtype):
-        """Construct attention mask per stage. For each of the RVQ codebook levels in the [0, n_q] range,
-           either a local attention map or None would be stored as an entry in the self.attn_mask_per_stage list.
-        Args:
-            compression_model_framerate (int): The frame rate of the tokenizer.
-            segment_duration (int): Sample length in seconds.
-            num_heads (int): Num transformer attention heads.
-            device (torch.device): device of the output tensor.
-            dtype (torch.dtype): data type of the output tensor.
+            LocalAttentionMask, optional: Either the restricted local attention or None
+                if stage attention is unrestricted.
         """
-        seq_len = compression_model_framerate * segment_duration
-        self.attn_mask_per_stage = [self._stage_attn_mask(stage, seq_len, num_heads,
-                                                          device, dtype) for stage in range(self.n_q)]
+        if stage > 0:
+            return self.local_attn_mask
+        return None
 
     @torch.no_grad()
     def generate(self,
@@ -130,6 +90,7 @@ class MagnetLMModel(LMModel):
                  remove_prompts: bool = False,
                  check: bool = False,
                  callback: tp.Optional[tp.Callable[[int, int], None]] = None,
+                 cfg_conditions: tp.Optional[CFGConditions] = None,
                  **kwargs) -> torch.Tensor:
 
         assert cfg_coef is None, "Unsupported in MAGNeT. Use max_cfg_coef,min_cfg_coef instead."
@@ -146,7 +107,8 @@ class MagnetLMModel(LMModel):
                                      temp=temp,
                                      top_k=top_k,
                                      top_p=top_p,
-                                     callback=callback, **kwargs)
+                                     callback=callback,
+                                     cfg_conditions=cfg_conditions, **kwargs)
 
     @torch.no_grad()
     def _generate_magnet(self,
@@ -159,12 +121,17 @@ class MagnetLMModel(LMModel):
                          top_k: int = 0,
                          top_p: float = 0.9,
                          callback: tp.Optional[tp.Callable[[int, int], None]] = None,
+                         cfg_conditions: tp.Optional[CFGConditions] = None,
                          max_cfg_coef: float = 10.0,
                          min_cfg_coef: float = 1.0,
                          decoding_steps: tp.List[int] = [20, 10, 10, 10],
                          anneal_temp: bool = True,
                          span_scoring='max',
-                         span_arrangement='nonoverlap') -> torch.Tensor:
+                         span_arrangement='nonoverlap',
+                         prompt_lengths: tp.Optional[tp.Sequence[int]] = None,
+                         early_exit_threshold: float = 0.0,
+                         early_exit_min_steps: int = 2,
+                         early_exit_interval: int = 2) -> torch.Tensor:
         """Generate audio tokens given textual conditions, and optionally given audio prompts,
         by running MAGNeT's iterative decoding algorithm for each of the n_q RVQ levels.
         Args:
@@ -177,6 +144,8 @@ class MagnetLMModel(LMModel):
             top_k (int): k for "top-k" sampling.
             top_p (float): p for "top-p" sampling.
             callback (Callback): Callback function to report generation progress.
+            cfg_conditions (CFGConditions, optional): Pre-computed conditions as returned by
+                `prepare_cfg_conditions`, used instead of `conditions` which should then be empty.
             max_clsfg_coef (float): Initial coefficient used for classifier free guidance.
             min_clsfg_coef (float): Final coefficient used for classifier free guidance.
             decoding_steps (list of n_q ints): The number of iterative decoding steps,
@@ -186,12 +155,26 @@ class MagnetLMModel(LMModel):
                                 or the product of probabilities ('prod').
             span_arrangement (str): Use either non-overlapping spans ('nonoverlap') or overlapping spans ('stride1').
                                                 in the masking scheme.
+            prompt_lengths (list of int, optional): Length of the prompt of each item in the batch, for batches
+                                                    of prompts with different lengths. Each prompt is read from
+                                                    the start of `prompt`, defaults to the full prompt length.
+            early_exit_threshold (float): When positive, a stage is stopped before running all its decoding steps
+                                          as soon as the fraction of generated tokens changed by the last decoding
+                                          step is below this threshold for every item. Defaults to 0 (disabled).
+            early_exit_min_steps (int): Minimal number of decoding steps of each stage with early exit.
+            early_exit_interval (int): The early exit is checked every this many decoding steps, as each check
+                                       synchronizes with the device.
         Returns:
             torch.Tensor: Generated tokens.
         """
         assert not self.training, "generation shouldn't be used in training mode."
         first_param = next(iter(self.parameters()))
         device = first_param.device
+        if cfg_conditions is not None:
+            assert not conditions, "Shouldn't pass both conditions and cfg_conditions."
+            assert not isinstance(cfg_conditions, tuple), \
+                "MAGNeT currently doesn't support two step classifier-free-guidance."
+            trace_count('cfg_conditions_reused')
 
         # Checking all input shapes are consistent.
         possible_num_samples = []
@@ -201,6 +184,8 @@ class MagnetLMModel(LMModel):
             possible_num_samples.append(prompt.shape[0])
         elif conditions:
             possible_num_samples.append(len(conditions))
+        elif cfg_conditions:
+            possible_num_samples.append(get_cfg_conditions_batch_size(cfg_conditions))
         else:
             possible_num_samples.append(1)
         assert [x == possible_num_samples[0] for x in possible_num_samples], "Inconsistent inputs shapes"
@@ -209,20 +194,19 @@ class MagnetLMModel(LMModel):
         # below we create set of conditions: one conditional and one unconditional
         # to do that we merge the regular condition together with the null condition
         # we then do 1 forward pass instead of 2.
-        cfg_conditions: tp.Optional[ConditionTensors]
-        if conditions:
-            null_conditions = ClassifierFreeGuidanceDropout(p=1.0)(conditions)
-            conditions = conditions + null_conditions
-            tokenized = self.condition_provider.tokenize(conditions)
-            cfg_conditions = self.condition_provider(tokenized)
-        else:
-            cfg_conditions = {}
+        if cfg_conditions is None:
+            cfg_conditions = self.prepare_cfg_conditions(conditions, two_step_cfg=False)
 
         if prompt is None:
             assert num_samples > 0
             prompt = torch.zeros((num_samples, self.num_codebooks, 0), dtype=torch.long, device=device)
 
         B, K, prompt_length = prompt.shape
+        if prompt_lengths is None:
+            prompt_lengths = [prompt_length] * B
+        prompt_lengths = [int(length) for length in prompt_lengths]
+        assert len(prompt_lengths) == B, "Expecting one prompt length per item in the batch"
+        assert all(0 <= length <= prompt_length for length in prompt_lengths), "Invalid prompt lengths"
         start_offset = prompt_length
         assert start_offset < max_gen_len
 
@@ -232,42 +216,65 @@ class MagnetLMModel(LMModel):
         shape = (B, K, max_gen_len)
 
         gen_codes = torch.full(shape, mask_id, dtype=torch.long, device=device)
-        # filling the gen_codes with the prompt if needed
-        gen_codes[..., :start_offset] = prompt
+        # filling the gen_codes with the prompt of each item if needed
+        prompt_mask = torch.arange(start_offset, device=device)[None, :] < \
+            torch.tensor(prompt_lengths, device=device)[:, None]
+        gen_codes[..., :start_offset] = torch.where(prompt_mask[:, None, :], prompt, mask_id)
         # create the gen_sequence with proper interleaving from the pattern: [B, K, S]
         gen_sequence = gen_codes
 
         curr_step = 0
+        executed_steps = []
         for stage, n_steps in zip(range(self.n_q), decoding_steps):
-            gen_sequence, curr_step = self._generate_stage(gen_sequence,
-                                                           cfg_conditions,
-                                                           stage=stage,
-                                                           device=device,
-                                                           prompt_length=prompt_length,
-                                                           prompt=prompt,
-                                                           temp=temp,
-                                                           max_cfg_coef=max_cfg_coef,
-                                                           min_cfg_coef=min_cfg_coef,
-                                                           top_k=top_k,
-                                                           top_p=top_p,
-                                                           timesteps=n_steps,
-                                                           anneal_temp=anneal_temp,
-                                                           span_scoring=span_scoring,
-                                                           use_sampling=use_sampling,
-                                                           span_arrangement=span_arrangement,
-                                                           curr_step=curr_step,
-                                                           total_steps=sum(decoding_steps),
-                                                           callback=callback)
-
+            gen_sequence, curr_step, n_executed = self._generate_stage(gen_sequence,
+                                                                       cfg_conditions,
+                                                                       stage=stage,
+                                                                       device=device,
+                                                                       prompt_lengths=prompt_lengths,
+                                                                       prompt=prompt,
+                                                                       temp=temp,
+                                                                       max_cfg_coef=max_cfg_coef,
+                                                                       min_cfg_coef=min_cfg_coef,
+                                                                       top_k=top_k,
+                                                                       top_p=top_p,
+                                                                       timesteps=n_steps,
+                                                                       anneal_temp=anneal_temp,
+                                                                       span_scoring=span_scoring,
+                                                                       use_sampling=use_sampling,
+                                                                       span_arrangement=span_arrangement,
+                                                                       curr_step=curr_step,
+                                                                       total_steps=sum(decoding_steps),
+                                                                       callback=callback,
+                                                                       early_exit_threshold=early_exit_threshold,
+                                                                       early_exit_min_steps=early_exit_min_steps,
+                                                                       early_exit_interval=early_exit_interval)
+            executed_steps.append(n_executed)
+
+        saved = sum(decoding_steps[:len(executed_steps)]) - sum(executed_steps)
+        self.decoding_stats = {
+            'decoding_steps': list(decoding_steps[:len(executed_steps)]),
+            'executed_steps': executed_steps,
+            'saved_forward_passes': saved,
+        }
+        if saved > 0:
+            logger.info("MAGNeT early exit ran %s decoding steps instead of %s, saving %d forward passes.",
+                        executed_steps, self.decoding_stats['decoding_steps'], saved)
         return gen_sequence
 
+    @staticmethod
+    def _masking_schedule(timesteps: int) -> tp.List[float]:
+        """Cosine schedule of the masking rate over the iterative decoding steps, computed on the host."""
+        if timesteps <= 1:
+            return [1.0] * timesteps
+        return [math.cos(step / (timesteps - 1) * math.pi * 0.5) for step in range(timesteps)]
+
     @torch.no_grad()
     def _generate_stage(self,
                         gen_sequence: torch.Tensor,
                         condition_tensors: tp.Optional[ConditionTensors],
                         stage: int,
                         device: torch.device,
-                        prompt_length: int = 0,
+                        prompt_lengths: tp.Sequence[int] = [],
                         prompt: tp.Optional[torch.Tensor] = None,
                         use_sampling: bool = True,
                         temp: float = 3.0,
@@ -281,7 +288,10 @@ class MagnetLMModel(LMModel):
                         span_arrangement: str = 'nonoverlap',
                         curr_step: int = 0,
                         total_steps: int = 0,
-                        callback: tp.Optional[tp.Callable[[int, int], None]] = None) -> tp.Tuple[torch.Tensor, int]:
+                        callback: tp.Optional[tp.Callable[[int, int], None]] = None,
+                        early_exit_threshold: float = 0.0,
+                        early_exit_min_steps: int = 2,
+                        early_exit_interval: int = 2) -> tp.Tuple[torch.Tensor, int, int]:
         """Generate audio tokens of a single RVQ level (stage), given the previously generated stages,
            and the textual conditions.
         Args:
@@ -289,7 +299,7 @@ class MagnetLMModel(LMModel):
             condition_tensors (tp.Optional[ConditionTensors]): pre-computed conditioning tensors.
             stage (int): RVQ level to generate.
             device (torch.device): device of the output tensor.
-            prompt_length (int): Temporal length of the audio prompt.
+            prompt_lengths (list of int): Temporal length of the audio prompt of each item, defaults to no prompt.
             prompt (torch.Tensor): Prompt tokens of shape [B, K, T].
             use_sampling (bool): Whether to use a sampling strategy or not.
             temp (float): Initial sampling temperature.
@@ -306,11 +316,17 @@ class MagnetLMModel(LMModel):
             curr_step (int): Global iterative decoding step counter.
             total_steps (int): Total decoding steps.
             callback (Callback): Callback function to report generation progress.
+            early_exit_threshold (float): Stop the stage once the fraction of generated tokens changed by the last
+                                          decoding step is below this threshold for all the items (0 disables it).
+            early_exit_min_steps (int): Minimal number of decoding steps before an early exit.
+            early_exit_interval (int): Number of decoding steps between the early exit checks.
         Returns:
-            tuple(torch.Tensor, int): Generated tokens and the current decoding step counter.
+            tuple(torch.Tensor, int, int): Generated tokens, the current decoding step counter
+                and the number of decoding steps actually run for the stage.
         """
         B, K, T = gen_sequence.shape
         shape = (B, 1, T)  # generating a single codebook per stage
+        prompt_lengths = list(prompt_lengths) or [0] * B
 
         mask_id = self.special_token_id
         stage_gen_seq = torch.full(shape, mask_id, dtype=torch.long, device=device)
@@ -332,59 +348,77 @@ class MagnetLMModel(LMModel):
                 stage_gen_seq = stage_gen_seq[..., :T]
 
             chunked_shape = (B, 1, n_chunks)
-            n_prompt_chunks = prompt_length // self.span_len
-            scores = torch.zeros(chunked_shape, dtype=torch.float32, device=device)
-            scores[..., :n_prompt_chunks] = DONT_REMASK_ME_SCORE
-            num_chunks_to_gen = n_chunks - n_prompt_chunks
+            n_prompt_chunks = [length // self.span_len for length in prompt_lengths]
+            n_scores = n_chunks
+            num_to_gen = [n_chunks - n for n in n_prompt_chunks]
         else:
             # token-wise scores
-            scores = torch.zeros(shape, dtype=torch.float32, device=device)
-            scores[..., :prompt_length] = DONT_REMASK_ME_SCORE
-            gen_T = T - prompt_length
+            n_prompt_chunks = prompt_lengths
+            n_scores = T
+            num_to_gen = [T - length for length in prompt_lengths]
+        scores = torch.zeros((B, 1, n_scores), dtype=torch.float32, device=device)
+        positions = torch.arange(n_scores, device=device).view(1, 1, -1)
+        scores = scores.masked_fill(
+            positions < torch.tensor(n_prompt_chunks, device=device).view(B, 1, 1), DONT_REMASK_ME_SCORE)
+
+        stage_prompt: tp.Optional[torch.Tensor] = None
+        if prompt is not None and prompt.shape[-1] > 0:
+            prompt_len = min(prompt.shape[-1], T)
+            stage_prompt = torch.full(shape, mask_id, dtype=torch.long, device=device)[..., :T]
+            stage_prompt[..., :prompt_len] = prompt[:, [stage], :prompt_len]
+            prompt_mask = torch.arange(T, device=device).view(1, 1, -1) < \
+                torch.tensor(prompt_lengths, device=device).view(B, 1, 1)
+
+        if early_exit_threshold > 0:
+            # tokens generated in the stage, and their count for each item.
+            gen_mask = torch.arange(T, device=device).view(1, 1, -1) >= \
+                torch.tensor(prompt_lengths, device=device).view(B, 1, 1)
+            num_gen_tokens = gen_mask.sum(dim=-1).clamp(min=1)
+        prev_stage_gen_seq: tp.Optional[torch.Tensor] = None
 
         # run MAGNeT iterative decoding for "timesteps" iterations
-        for timestep, steps_left in zip(torch.linspace(0, 1, timesteps, device=device), reversed(range(timesteps))):
-
-            mask_p = torch.cos(timestep * math.pi * 0.5)
-
-            if chunk_masking:
-                num_masked = max(int((mask_p * num_chunks_to_gen).item()), 1)
-            else:
-                num_masked = max(int((mask_p * gen_T).item()), 1)
+        n_executed = 0
+        for mask_p, steps_left in zip(self._masking_schedule(timesteps), reversed(range(timesteps))):
+            # number of masked tokens (or chunks) of each item, computed on the host to avoid syncs.
+            num_masked_list = [max(int(mask_p * n), 1) for n in num_to_gen]
+            num_masked = torch.tensor(num_masked_list, device=device)
+            trace_count('tokens', sum(num_masked_list) * (self.span_len if chunk_masking else 1))
 
             # masking
             run_lps_masking = (span_arrangement == 'stride1') and self.span_len > 1
             if run_lps_masking:
                 # masking of the k least probable overlapping (stride 1) spans
-                mask = torch.concat((
-                    [self._least_probable_span_masking(scores[[i], :, :], num_masked).to(device)
-                     for i in range(B)]), dim=0)
-                stage_gen_seq[mask] = mask_id
+                mask = self._least_probable_span_masking(scores, num_masked)
+                stage_gen_seq = stage_gen_seq.masked_fill(mask, mask_id)
             else:
-                # masking of the k least probable non-overlapping spans
-                masked = scores.topk(num_masked, dim=-1).indices
+                # masking of the k least probable non-overlapping spans, with a batched top-k
+                max_masked = max(num_masked_list)
+                masked = scores.topk(max_masked, dim=-1).indices
+                keep = torch.arange(max_masked, device=device).view(1, 1, -1) < num_masked.view(B, 1, 1)
                 if chunk_masking:
-                    chunks_mask = torch.full(chunked_shape, False, dtype=torch.bool, device=device)
-                    chunks_mask = chunks_mask.scatter(2, masked, True)
+                    chunks_mask = torch.zeros(chunked_shape, dtype=torch.bool, device=device).scatter(2, masked, keep)
                     mask = torch.repeat_interleave(chunks_mask, self.span_len, dim=-1)
-                    stage_gen_seq[mask] = mask_id
                 else:
-                    stage_gen_seq = stage_gen_seq.scatter(2, masked, mask_id)
+                    mask = torch.zeros(shape, dtype=torch.bool, device=device).scatter(2, masked, keep)
+                stage_gen_seq = stage_gen_seq.masked_fill(mask, mask_id)
 
-            if prompt is not None:
-                stage_gen_seq[..., :prompt_length] = prompt[:, stage, :].unsqueeze(1)
+            if stage_prompt is not None:
+                stage_gen_seq = torch.where(prompt_mask, stage_prompt, stage_gen_seq)
 
             gen_sequence[:, [stage], :] = stage_gen_seq
+            sequence = gen_sequence
             if condition_tensors:
                 # duplicate input for classifier free guidance
                 sequence = torch.cat([gen_sequence, gen_sequence], dim=0)
+                trace_count('cfg_rows', B)
 
-            all_logits = model(sequence, [], condition_tensors, stage=stage)
+            with trace_span('lm.step', stage=stage):
+                all_logits = model(sequence, [], condition_tensors, stage=stage)
 
             if condition_tensors:
                 # classifier free guidance with annealing
                 cond_logits, uncond_logits = all_logits.split(B, dim=0)  # [B, K, T, card]
-                clsfg_coef = float(mask_p) * max_cfg_coef + (1 - float(mask_p)) * min_cfg_coef
+                clsfg_coef = mask_p * max_cfg_coef + (1 - mask_p) * min_cfg_coef
                 logits = uncond_logits + (cond_logits - uncond_logits) * clsfg_coef
             else:
                 logits = all_logits
@@ -394,16 +428,17 @@ class MagnetLMModel(LMModel):
 
             # sampling
             logits = logits[:, stage, :, :].unsqueeze(1)
-            probs = torch.softmax(logits / max(t, 1e-2), dim=-1)
-            if use_sampling:
-                if top_p > 0.0:
-                    sampled_tokens = utils.sample_top_p(probs, p=top_p)
-                elif top_k > 0:
-                    sampled_tokens = utils.sample_top_k(probs, k=top_k)
+            with trace_span('lm.sampling'):
+                probs = torch.softmax(logits / max(t, 1e-2), dim=-1)
+                if use_sampling:
+                    if top_p > 0.0:
+                        sampled_tokens = utils.sample_top_p(probs, p=top_p)
+                    elif top_k > 0:
+                        sampled_tokens = utils.sample_top_k(probs, k=top_k)
+                    else:
+                        sampled_tokens = utils.multinomial(probs, num_samples=1)
                 else:
-                    sampled_tokens = utils.multinomial(probs, num_samples=1)
-            else:
-                sampled_tokens = torch.argmax(logits, dim=-1, keepdim=True)
+                    sampled_tokens = torch.argmax(logits, dim=-1, keepdim=True)
 
             # place mask_id token in each of the masked positions
             mask = stage_gen_seq == mask_id
@@ -433,68 +468,80 @@ class MagnetLMModel(LMModel):
             else:
                 scores = scores.masked_fill(~mask, DONT_REMASK_ME_SCORE)
 
+            n_executed += 1
+            curr_step += 1
             if callback is not None:
-                curr_step += 1
                 callback(curr_step, total_steps)
 
-        return gen_sequence, curr_step
-
-    def _construct_spans_mask(self, span_starts: torch.Tensor, T: int, device: torch.device) -> torch.Tensor:
-        """Build a [1x1xT] boolean mask consists of overlapping spans of True values, where
+            if early_exit_threshold > 0 and steps_left > 0:
+                # all positions hold a token at this point, so the stage can be stopped after any step.
+                # the check syncs with the device, so it only runs every `early_exit_interval` steps.
+                check = n_executed >= early_exit_min_steps and n_executed % early_exit_interval == 0
+                if prev_stage_gen_seq is not None and check:
+                    changed = ((stage_gen_seq != prev_stage_gen_seq) & gen_mask).sum(dim=-1) / num_gen_tokens
+                    if changed.max().item() < early_exit_threshold:
+                        curr_step += steps_left
+                        if callback is not None:
+                            callback(curr_step, total_steps)
+                        break
+                prev_stage_gen_seq = stage_gen_seq
+
+        return gen_sequence, curr_step, n_executed
+
+    def _construct_spans_mask(self, span_starts: torch.Tensor, T: int) -> torch.Tensor:
+        """Build a [B, T] boolean mask consisting of overlapping spans of True values, where
            span_starts defines the initial index of each span, and the span length is
            defined by self.span_len.
         Args:
-            span_starts (torch.Tensor): Boolean mask determines the temporal location of each span start.
+            span_starts (torch.Tensor): Boolean mask of shape [B, T - span_len + 1],
+                determining the temporal location of each span start.
             T (int): Sequence length.
-            device (torch.device): device of the output tensor.
         Returns:
-            torch.Tensor: Spans mask of shape [1x1xT]
+            torch.Tensor: Spans mask of shape [B, T]
         """
-        mask = torch.full((1, 1, T), False, device=device)
-        mask[:, :, span_starts] = True
-        shifted_mask = mask.clone()
-        for _ in range(self.span_len - 1):
-            shifted_mask = torch.concat((torch.full((1, 1, 1), False, device=device), shifted_mask[:, :, :-1]), dim=-1)
-            mask = torch.logical_or(mask, shifted_mask)
-        return mask
-
-    def _least_probable_span_masking(self, scores: torch.Tensor, num_masked_trg: int) -> torch.Tensor:
-        """Construct a [1x1xT] boolean mask, consists of the u least probable spans,
+        # position t is masked if a span starts in [t - span_len + 1, t].
+        padded = F.pad(span_starts.float(), (self.span_len - 1, T - span_starts.shape[-1]))
+        return padded.unfold(-1, self.span_len, 1).amax(dim=-1) > 0
+
+    def _least_probable_span_masking(self, scores: torch.Tensor, num_masked_trg: torch.Tensor) -> torch.Tensor:
+        """Construct a [B, 1, T] boolean mask, consisting of the u least probable spans of each item,
            where the token probability is determined by -scores, and the total
            number of masked tokens is as closest as possible to num_masked_trg.
-           Find u using binary search.
+           Find u using a binary search, run in parallel for all the items.
         Args:
-            scores (torch.Tensor): Per token score [-log(prob)]
-            num_masked_trg: int: The desired amount of tokens to be masked.
+            scores (torch.Tensor): Per token score [-log(prob)] of shape [B, 1, T].
+            num_masked_trg: torch.Tensor: The desired amount of tokens to be masked for each item, of shape [B].
         Returns:
-            torch.Tensor: Spans mask of shape [1x1xT]
+            torch.Tensor: Spans mask of shape [B, 1, T]
         """
         T = scores.shape[-1]
-        device = scores.device
-        scores_unfolded = scores.unfold(2, self.span_len, 1)
+        scores_unfolded = scores[:, 0].unfold(1, self.span_len, 1)
         # Span score is the product of probs (sum in log space)
         span_scores = scores_unfolded.sum(dim=-1)
-        spans_by_scores = torch.argsort(span_scores[0, 0], descending=True)
+        num_spans = span_scores.shape[-1]
+        spans_by_scores = torch.argsort(span_scores, dim=-1, descending=True)
+        # rank of each span once sorted by score, so that the u first spans are given by `span_ranks < u`.
+        span_ranks = torch.empty_like(spans_by_scores).scatter_(
+            1, spans_by_scores, torch.arange(num_spans, device=scores.device).expand_as(spans_by_scores).contiguous())
 
-        num_masked_trg = max(num_masked_trg, self.span_len)
+        num_masked_trg = num_masked_trg.clamp(min=self.span_len)
 
         # Binary search for u - the number least probable overlapping masked spans s.t.
         # the total masking rate is the closest to num_masked_trg / T.
+        # `torch.round` rounds half to even, as the builtin `round`.
         min_u = num_masked_trg // self.span_len
         max_u = num_masked_trg - self.span_len + 1
-        mid = round(0.5 * (min_u + max_u))
-
-        if mid == min_u or mid == max_u:
-            return self._construct_spans_mask(spans_by_scores[:mid], T, device)
-
-        while mid > min_u and mid < max_u:
-            mask = self._construct_spans_mask(spans_by_scores[:mid], T, device)
-            n_masked = mask.sum()
-            if n_masked > num_masked_trg:
-                max_u = mid
-                mid = round(0.5 * (min_u + max_u))
-            else:
-                min_u = mid
-                mid = round(0.5 * (min_u + max_u))
-
-        return mask
+        mid = torch.round(0.5 * (min_u + max_u)).long()
+        u = mid
+        active = (mid > min_u) & (mid < max_u)
+        # the search interval is halved at each iteration, a fixed number of iterations avoids any sync.
+        for _ in range(math.ceil(math.log2(num_spans + 1)) + 1):
+            n_masked = self._construct_spans_mask(span_ranks < mid[:, None], T).sum(dim=-1)
+            too_many = n_masked > num_masked_trg
+            max_u = torch.where(active & too_many, mid, max_u)
+            min_u = torch.where(active & ~too_many, mid, min_u)
+            u = torch.where(active, mid, u)
+            mid = torch.where(active, torch.round(0.5 * (min_u + max_u)).long(), mid)
+            active = active & (mid > min_u) & (mid < max_u)
+
+        return self._construct_spans_mask(span_ranks < u[:, None], T)[:, None]
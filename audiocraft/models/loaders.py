@@ -19,6 +19,9 @@ They also support overriding some parameters, in particular the device and dtype
 of the returned model.
 """
 
+import itertools
+import json
+import logging
 from pathlib import Path
 from huggingface_hub import hf_hub_download
 import typing as tp
@@ -26,6 +29,7 @@ import os
 
 from omegaconf import OmegaConf, DictConfig
 import torch
+from torch import nn
 
 import audiocraft
 
@@ -33,15 +37,29 @@ from . import builders
 from .encodec import CompressionModel
 
 
+logger = logging.getLogger(__name__)
+
+
 def get_audiocraft_cache_dir() -> tp.Optional[str]:
     return os.environ.get('AUDIOCRAFT_CACHE_DIR', None)
 
 
+def _torch_load(file: tp.Union[Path, str], device='cpu', mmap: bool = False):
+    if mmap:
+        try:
+            # tensors are backed by the file and only read when accessed, without an extra copy in RAM.
+            return torch.load(file, map_location=device, mmap=True)
+        except RuntimeError:
+            logger.warning("Could not memory map %s, saved with the legacy format, loading it in RAM.", file)
+    return torch.load(file, map_location=device)
+
+
 def _get_state_dict(
     file_or_url_or_id: tp.Union[Path, str],
     filename: tp.Optional[str] = None,
     device='cpu',
     cache_dir: tp.Optional[str] = None,
+    mmap: bool = False,
 ):
     if cache_dir is None:
         cache_dir = get_audiocraft_cache_dir()
@@ -50,11 +68,11 @@ def _get_state_dict(
     assert isinstance(file_or_url_or_id, str)
 
     if os.path.isfile(file_or_url_or_id):
-        return torch.load(file_or_url_or_id, map_location=device)
+        return _torch_load(file_or_url_or_id, device=device, mmap=mmap)
 
     if os.path.isdir(file_or_url_or_id):
         file = f"{file_or_url_or_id}/{filename}"
-        return torch.load(file, map_location=device)
+        return _torch_load(file, device=device, mmap=mmap)
 
     elif file_or_url_or_id.startswith('https://'):
         return torch.hub.load_state_dict_from_url(file_or_url_or_id, map_location=device, check_hash=True)
@@ -68,7 +86,7 @@ def _get_state_dict(
             library_name="audiocraft",
             library_version=audiocraft.__version__,
         )
-        return torch.load(file, map_location=device)
+        return _torch_load(file, device=device, mmap=mmap)
 
 
 def load_compression_model_ckpt(file_or_url_or_id: tp.Union[Path, str], cache_dir: tp.Optional[str] = None):
@@ -79,20 +97,59 @@ def load_compression_model(
     file_or_url_or_id: tp.Union[Path, str],
     device="cpu",
     cache_dir: tp.Optional[str] = None,
+    fuse: bool = True,
 ):
+    """Load a compression model in eval mode. With `fuse`, its weight normalization is folded
+    into plain weights, see `CompressionModel.fuse_for_inference`.
+    """
     pkg = load_compression_model_ckpt(file_or_url_or_id, cache_dir=cache_dir)
     if 'pretrained' in pkg:
-        return CompressionModel.get_pretrained(pkg['pretrained'], device=device)
-    cfg = OmegaConf.create(pkg['xp.cfg'])
-    cfg.device = str(device)
-    model = builders.get_compression_model(cfg)
-    model.load_state_dict(pkg["best_state"])
-    model.eval()
+        model = CompressionModel.get_pretrained(pkg['pretrained'], device=device, fuse=fuse)
+    else:
+        cfg = OmegaConf.create(pkg['xp.cfg'])
+        cfg.device = str(device)
+        model = builders.get_compression_model(cfg)
+        model.load_state_dict(pkg["best_state"])
+        model.eval()
+    if fuse:
+        model.fuse_for_inference()
     return model
 
 
-def load_lm_model_ckpt(file_or_url_or_id: tp.Union[Path, str], cache_dir: tp.Optional[str] = None):
-    return _get_state_dict(file_or_url_or_id, filename="state_dict.bin", cache_dir=cache_dir)
+def load_lm_model_ckpt(file_or_url_or_id: tp.Union[Path, str], cache_dir: tp.Optional[str] = None,
+                       mmap: bool = False):
+    return _get_state_dict(file_or_url_or_id, filename="state_dict.bin", cache_dir=cache_dir, mmap=mmap)
+
+
+def load_state_dict_into_empty(model: nn.Module, state_dict: tp.Dict[str, torch.Tensor],
+                               device: tp.Union[torch.device, str] = 'cpu'):
+    """Load a state dict into a model whose parameters were created on the meta device (or already exist),
+    materializing them directly from the state dict tensors on `device`. Each parameter and buffer keeps
+    the dtype it was created with, as `load_state_dict` would, but without an intermediate copy,
+    so that tensors memory mapped on CPU stay shared with the page cache.
+
+    Args:
+        model (nn.Module): Model to load the state into, in place.
+        state_dict (dict): State dict, with the same keys as the model one.
+        device (torch.device or str): Device of the materialized parameters.
+    """
+    named_tensors = itertools.chain(model.named_parameters(remove_duplicate=False),
+                                    model.named_buffers(remove_duplicate=False))
+    dtypes = {name: tensor.dtype for name, tensor in named_tensors}
+    model.load_state_dict(state_dict, assign=True)
+    materialized: tp.Dict[int, torch.Tensor] = {}
+    for module_name, module in model.named_modules(remove_duplicate=False):
+        prefix = f"{module_name}." if module_name else ""
+        for tensors in [module._parameters, module._buffers]:
+            for key, tensor in tensors.items():
+                if tensor is None:
+                    continue
+                if id(tensor) not in materialized:
+                    new_tensor = tensor.detach().to(device=device, dtype=dtypes[prefix + key])
+                    if isinstance(tensor, nn.Parameter):
+                        new_tensor = nn.Parameter(new_tensor, requires_grad=tensor.requires_grad)
+                    materialized[id(tensor)] = new_tensor
+                tensors[key] = materialized[id(tensor)]
 
 
 def _delete_param(cfg: DictConfig, full_name: str):
@@ -108,8 +165,14 @@ def _delete_param(cfg: DictConfig, full_name: str):
     OmegaConf.set_struct(cfg, True)
 
 
-def load_lm_model(file_or_url_or_id: tp.Union[Path, str], device='cpu', cache_dir: tp.Optional[str] = None):
-    pkg = load_lm_model_ckpt(file_or_url_or_id, cache_dir=cache_dir)
+def load_lm_model(file_or_url_or_id: tp.Union[Path, str], device='cpu', cache_dir: tp.Optional[str] = None,
+                  empty_init: bool = True, weight_bits: tp.Optional[int] = None,
+                  group_size: tp.Optional[int] = None):
+    """Load a LM from a checkpoint. With `empty_init`, the LM is built on the meta device, without
+    initializing its weights, and the memory mapped checkpoint tensors are materialized directly on `device`.
+    With `weight_bits` (8 or 4), the LM weights are quantized once loaded, see `LMModel.quantize_weights`.
+    """
+    pkg = load_lm_model_ckpt(file_or_url_or_id, cache_dir=cache_dir, mmap=empty_init)
     cfg = OmegaConf.create(pkg['xp.cfg'])
     cfg.device = str(device)
     if cfg.device == 'cpu':
@@ -119,16 +182,22 @@ def load_lm_model(file_or_url_or_id: tp.Union[Path, str], device='cpu', cache_di
     _delete_param(cfg, 'conditioners.self_wav.chroma_stem.cache_path')
     _delete_param(cfg, 'conditioners.args.merge_text_conditions_p')
     _delete_param(cfg, 'conditioners.args.drop_desc_p')
-    model = builders.get_lm_model(cfg)
-    model.load_state_dict(pkg['best_state'])
+    model = builders.get_lm_model(cfg, empty_init=empty_init)
+    if empty_init:
+        load_state_dict_into_empty(model, pkg['best_state'], device=device)
+    else:
+        model.load_state_dict(pkg['best_state'])
     model.eval()
+    if weight_bits is not None:
+        model.quantize_weights(weight_bits, group_size)
     model.cfg = cfg
     return model
 
 
 def load_lm_model_magnet(file_or_url_or_id: tp.Union[Path, str], compression_model_frame_rate: int,
-                         device='cpu', cache_dir: tp.Optional[str] = None):
-    pkg = load_lm_model_ckpt(file_or_url_or_id, cache_dir=cache_dir)
+                         device='cpu', cache_dir: tp.Optional[str] = None, empty_init: bool = True):
+    """Load a MAGNeT LM from a checkpoint, see `load_lm_model` for `empty_init`."""
+    pkg = load_lm_model_ckpt(file_or_url_or_id, cache_dir=cache_dir, mmap=empty_init)
     cfg = OmegaConf.create(pkg['xp.cfg'])
     cfg.device = str(device)
     if cfg.device == 'cpu':
@@ -148,13 +217,66 @@ def load_lm_model_magnet(file_or_url_or_id: tp.Union[Path, str], compression_mod
     if cfg.transformer_lm.memory_efficient:
         set_efficient_attention_backend("xformers")
 
-    model = builders.get_lm_model(cfg)
-    model.load_state_dict(pkg['best_state'])
+    model = builders.get_lm_model(cfg, empty_init=empty_init)
+    if empty_init:
+        load_state_dict_into_empty(model, pkg['best_state'], device=device)
+    else:
+        model.load_state_dict(pkg['best_state'])
     model.eval()
     model.cfg = cfg
     return model
 
 
+def load_snapshot(path: tp.Union[Path, str], device: tp.Optional[str] = None):
+    """Load a MusicGen, AudioGen or MAGNeT model from a snapshot exported with
+    `audiocraft.utils.export.export_snapshot`. The models are built on the meta device and the
+    weights are memory mapped, so that workers on the same host share the page cache,
+    and the T5 conditioners are loaded from the snapshot rather than from the Hugging Face hub.
+
+    Args:
+        path (Path or str): Snapshot directory.
+        device (str, optional): Device of the model, defaults to cuda if available.
+    Returns:
+        BaseGenModel: The loaded model.
+    """
+    from .. import models
+
+    path = Path(path)
+    if device is None:
+        device = 'cuda' if torch.cuda.device_count() else 'cpu'
+    with open(path / 'snapshot.json') as f:
+        metadata = json.load(f)
+
+    pkg = _torch_load(path / 'state_dict.bin', mmap=True)
+    cfg = OmegaConf.create(pkg['xp.cfg'])
+    cfg.device = str(device)
+    cfg.dtype = 'float32' if cfg.device == 'cpu' else 'float16'
+    for name, conditioner_cfg in (cfg.conditioners or {}).items():
+        if isinstance(conditioner_cfg, DictConfig) and conditioner_cfg.get('model') == 't5':
+            OmegaConf.set_struct(conditioner_cfg, False)
+            conditioner_cfg.t5.path = str(path / 't5' / name)
+            OmegaConf.set_struct(conditioner_cfg, True)
+    if cfg.lm_model == 'transformer_lm_magnet' and cfg.transformer_lm.memory_efficient:
+        from audiocraft.modules.transformer import set_efficient_attention_backend
+        set_efficient_attention_backend("xformers")
+    lm = builders.get_lm_model(cfg, empty_init=True)
+    load_state_dict_into_empty(lm, pkg['best_state'], device=device)
+    lm.eval()
+    lm.cfg = cfg
+    for key, value in metadata.get('self_wav', {}).items():
+        setattr(lm.condition_provider.conditioners['self_wav'], key, value)
+
+    compression_pkg = _torch_load(path / 'compression_state_dict.bin', mmap=True)
+    compression_cfg = OmegaConf.create(compression_pkg['xp.cfg'])
+    compression_cfg.device = str(device)
+    compression_model = builders.get_compression_model(compression_cfg, empty_init=True).eval()
+    compression_model.fuse_for_inference()
+    load_state_dict_into_empty(compression_model, compression_pkg['best_state'], device=device)
+
+    model_class = getattr(models, metadata['model_class'])
+    return model_class(name=metadata['name'], compression_model=compression_model, lm=lm)
+
+
 def load_jasco_model(file_or_url_or_id: tp.Union[Path, str],
                      compression_model: CompressionModel,
                      device='cpu', cache_dir: tp.Optional[str] = None):
@@ -12,7 +12,10 @@ import typing as tp
 import torch
 
 from .genmodel import BaseGenModel
+from .builders import get_debug_compression_model, get_debug_magnet_lm_model
 from .loaders import load_compression_model, load_lm_model_magnet
+from ..data.audio_utils import convert_audio
+from ..utils.profiler import traced
 
 
 class MAGNeT(BaseGenModel):
@@ -23,7 +26,7 @@ class MAGNeT(BaseGenModel):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         # MAGNeT operates over a fixed sequence length defined in it's config.
-        self.duration = self.lm.cfg.dataset.segment_duration
+        self.duration = self.max_duration
         self.set_generation_params()
 
     @staticmethod
@@ -48,6 +51,12 @@ class MAGNeT(BaseGenModel):
             else:
                 device = 'cpu'
 
+        if name == 'debug':
+            # used only for unit tests
+            compression_model = get_debug_compression_model(device)
+            lm = get_debug_magnet_lm_model(device)
+            return MAGNeT(name=name, compression_model=compression_model, lm=lm, max_duration=lm.segment_duration)
+
         compression_model = load_compression_model(name, device=device)
         lm = load_lm_model_magnet(name, compression_model_frame_rate=int(compression_model.frame_rate), device=device)
 
@@ -61,7 +70,9 @@ class MAGNeT(BaseGenModel):
                               top_p: float = 0.9, temperature: float = 3.0,
                               max_cfg_coef: float = 10.0, min_cfg_coef: float = 1.0,
                               decoding_steps: tp.List[int] = [20, 10, 10, 10],
-                              span_arrangement: str = 'nonoverlap'):
+                              span_arrangement: str = 'nonoverlap',
+                              early_exit_threshold: float = 0.0, early_exit_min_steps: int = 2,
+                              early_exit_interval: int = 2):
         """Set the generation parameters for MAGNeT.
 
         Args:
@@ -75,6 +86,13 @@ class MAGNeT(BaseGenModel):
                                                          for each of the n_q RVQ codebooks.
             span_arrangement (str, optional): Use either non-overlapping spans ('nonoverlap')
                                               or overlapping spans ('stride1') in the masking scheme.
+            early_exit_threshold (float, optional): When positive, each stage stops as soon as the fraction of
+                                                    tokens changed by a decoding step falls below this value,
+                                                    instead of running all its decoding steps. Defaults to 0.0.
+            early_exit_min_steps (int, optional): Minimal number of decoding steps per stage with early exit.
+                                                  Defaults to 2.
+            early_exit_interval (int, optional): Number of decoding steps between the early exit checks,
+                                                 each of which synchronizes with the device. Defaults to 2.
         """
         self.generation_params = {
             'use_sampling': use_sampling,
@@ -84,5 +102,51 @@ class MAGNeT(BaseGenModel):
             'max_cfg_coef': max_cfg_coef,
             'min_cfg_coef': min_cfg_coef,
             'decoding_steps': [int(s) for s in decoding_steps],
-            'span_arrangement': span_arrangement
+            'span_arrangement': span_arrangement,
+            'early_exit_threshold': early_exit_threshold,
+            'early_exit_min_steps': early_exit_min_steps,
+            'early_exit_interval': early_exit_interval,
         }
+
+    @property
+    def decoding_stats(self) -> tp.Dict[str, tp.Any]:
+        """Decoding steps planned and run for each stage by the last generation, along with
+        the number of forward passes saved by the early exit."""
+        return self.lm.decoding_stats
+
+    @traced('generate')
+    def generate_continuation(self, prompt: torch.Tensor, prompt_sample_rate: int,
+                              descriptions: tp.Optional[tp.List[tp.Optional[str]]] = None,
+                              progress: bool = False, return_tokens: bool = False,
+                              prompt_lengths: tp.Optional[tp.Sequence[int]] = None) \
+            -> tp.Union[torch.Tensor, tp.Tuple[torch.Tensor, torch.Tensor]]:
+        """Generate samples conditioned on audio prompts and an optional text description.
+
+        Args:
+            prompt (torch.Tensor): A batch of waveforms used for continuation.
+                Prompt should be [B, C, T], or [C, T] if only one sample is generated.
+            prompt_sample_rate (int): Sampling rate of the given audio waveforms.
+            descriptions (list of str, optional): A list of strings used as text conditioning. Defaults to None.
+            progress (bool, optional): Flag to display progress of the generation process. Defaults to False.
+            prompt_lengths (list of int, optional): Length in samples of each prompt, for batches of right padded
+                prompts with different lengths. Defaults to the full prompt for every item.
+        """
+        if prompt_lengths is None:
+            return super().generate_continuation(prompt, prompt_sample_rate, descriptions, progress, return_tokens)
+        if prompt.dim() == 2:
+            prompt = prompt[None]
+        if prompt.dim() != 3:
+            raise ValueError("prompt should have 3 dimensions: [B, C, T] (C = 1).")
+        assert len(prompt_lengths) == len(prompt), "Expecting one prompt length per prompt"
+        prompt = convert_audio(prompt, prompt_sample_rate, self.sample_rate, self.audio_channels)
+        if descriptions is None:
+            descriptions = [None] * len(prompt)
+        attributes, prompt_tokens = self._prepare_tokens_and_attributes(descriptions, prompt)
+        assert prompt_tokens is not None
+        # only the frames fully covered by each prompt are kept.
+        token_lengths = [min(int(length * self.frame_rate / prompt_sample_rate), prompt_tokens.shape[-1])
+                         for length in prompt_lengths]
+        tokens = self._generate_tokens(attributes, prompt_tokens, progress, prompt_lengths=token_lengths)
+        if return_tokens:
+            return self.generate_audio(tokens), tokens
+        return self.generate_audio(tokens)
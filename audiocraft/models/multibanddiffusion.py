@@ -10,6 +10,7 @@ Multi Band Diffusion models as described in
 (paper link).
 """
 
+import contextlib
 import typing as tp
 
 import torch
@@ -19,6 +20,7 @@ from .unet import DiffusionUnet
 from ..modules.diffusion_schedule import NoiseSchedule
 from .encodec import CompressionModel
 from ..solvers.compression import CompressionSolver
+from ..utils.utils import chunked_overlap_add
 from .loaders import load_compression_model, load_diffusion_models
 
 
@@ -34,15 +36,17 @@ class DiffusionProcess:
         self.schedule = noise_schedule
 
     def generate(self, condition: torch.Tensor, initial_noise: torch.Tensor,
-                 step_list: tp.Optional[tp.List[int]] = None):
+                 step_list: tp.Optional[tp.List[int]] = None, sampler: str = 'ddpm'):
         """Perform one diffusion process to generate one of the bands.
 
         Args:
             condition (torch.Tensor): The embeddings from the compression model.
             initial_noise (torch.Tensor): The initial noise to start the process.
+            step_list (list[int], optional): list of Markov chain steps.
+            sampler (str): Sampler of the reverse process, see `NoiseSchedule.SAMPLERS`.
         """
         return self.schedule.generate_subsampled(model=self.model, initial=initial_noise, step_list=step_list,
-                                                 condition=condition)
+                                                 condition=condition, sampler=sampler)
 
 
 class MultiBandDiffusion:
@@ -56,6 +60,22 @@ class MultiBandDiffusion:
         self.DPs = DPs
         self.codec_model = codec_model
         self.device = next(self.codec_model.parameters()).device
+        self._split_bands: tp.Dict[int, julius.SplitBands] = {}
+        self.set_sampling_params()
+
+    def set_sampling_params(self, sampler: str = 'ddpm', num_steps: tp.Optional[int] = None):
+        """Set the sampling parameters of the diffusion processes.
+
+        Args:
+            sampler (str): 'ddpm' for the ancestral sampling the models were evaluated with, or one of the
+                deterministic few-step samplers 'ddim' and 'dpmpp_2m' (DPM-Solver++(2M)).
+                See `NoiseSchedule.SAMPLERS`.
+            num_steps (int, optional): Number of denoising steps, linearly spaced over the Markov chain.
+                Defaults to one step out of 50 (i.e. 20 steps), 4 to 8 steps are enough for the few-step samplers.
+        """
+        assert sampler in NoiseSchedule.SAMPLERS, f"Unknown sampler {sampler}."
+        self.sampler = sampler
+        self.num_sampling_steps = num_steps
 
     @property
     def sample_rate(self) -> int:
@@ -130,23 +150,88 @@ class MultiBandDiffusion:
         emb = self.codec_model.decode_latent(codes)
         return emb
 
+    def _generate_bands(self, emb: torch.Tensor, size: torch.Size,
+                        step_list: tp.Optional[tp.List[int]] = None) -> torch.Tensor:
+        """Run the diffusion processes of all the bands in lockstep, one denoising step of each band after
+        the other. On CUDA, each band runs on its own stream so that the kernels of the different U-Nets,
+        which are too small to fill the device on their own, are executed concurrently.
+        """
+        noises = [torch.randn(size, device=self.device) for _ in self.DPs]
+        chains = [DP.schedule.iter_subsampled(
+                      DP.model, initial=noise, condition=emb, sampler=self.sampler,
+                      step_list=step_list or DP.schedule.get_step_list(self.num_sampling_steps))
+                  for DP, noise in zip(self.DPs, noises)]
+        use_streams = self.device.type == 'cuda' and len(self.DPs) > 1
+        if use_streams:
+            main_stream = torch.cuda.current_stream(self.device)
+            streams = [torch.cuda.Stream(self.device) for _ in self.DPs]
+            for stream in streams:
+                stream.wait_stream(main_stream)
+        states: tp.List[torch.Tensor] = [noise * DP.schedule.noise_scale for DP, noise in zip(self.DPs, noises)]
+        bands_out: tp.List[tp.Optional[torch.Tensor]] = [None] * len(self.DPs)
+        while any(band is None for band in bands_out):
+            for idx, chain in enumerate(chains):
+                if bands_out[idx] is not None:
+                    continue
+                with torch.cuda.stream(streams[idx]) if use_streams else contextlib.nullcontext():
+                    state = next(chain, None)
+                    if state is None:
+                        bands_out[idx] = self.DPs[idx].schedule.sample_processor.return_sample(states[idx])
+                    else:
+                        states[idx] = state
+        bands = [band for band in bands_out if band is not None]
+        out = torch.zeros(size, device=self.device)
+        if use_streams:
+            for stream in streams:
+                main_stream.wait_stream(stream)
+            for band in bands:
+                band.record_stream(main_stream)
+        for band in bands:
+            out += band
+        return out
+
     def generate(self, emb: torch.Tensor, size: tp.Optional[torch.Size] = None,
-                 step_list: tp.Optional[tp.List[int]] = None):
+                 step_list: tp.Optional[tp.List[int]] = None, chunk_duration: tp.Optional[float] = None,
+                 chunk_overlap: float = 0.5, offload: bool = False):
         """Generate waveform audio from the latent embeddings of the compression model.
         Args:
             emb (torch.Tensor): Conditioning embeddings
             size (None, torch.Size): Size of the output
                 if None this is computed from the typical upsampling of the model.
-            step_list (list[int], optional): list of Markov chain steps, defaults to 50 linearly spaced step.
+            step_list (list[int], optional): list of Markov chain steps, defaults to the steps set with
+                `set_sampling_params`, i.e. 20 linearly spaced steps.
+            chunk_duration (float, optional): If given, long audio is generated by chunks of this duration
+                in seconds, cross-faded over `chunk_overlap` seconds, so that the memory stays bounded.
+            chunk_overlap (float): Overlap in seconds between consecutive chunks, reduced to half of
+                `chunk_duration` if longer.
+            offload (bool): If True, the generated chunks are moved to the CPU as soon as they are ready,
+                and the audio is returned on CPU.
         """
+        upsampling = int(self.codec_model.sample_rate / self.codec_model.frame_rate)
         if size is None:
-            upsampling = int(self.codec_model.sample_rate / self.codec_model.frame_rate)
             size = torch.Size([emb.size(0), self.codec_model.channels, emb.size(-1) * upsampling])
         assert size[0] == emb.size(0)
-        out = torch.zeros(size).to(self.device)
-        for DP in self.DPs:
-            out += DP.generate(condition=emb, step_list=step_list, initial_noise=torch.randn_like(out))
-        return out
+        num_frames = emb.size(-1)
+        chunk_frames = num_frames
+        if chunk_duration is not None:
+            chunk_frames = max(int(chunk_duration * self.codec_model.frame_rate), 1)
+        if chunk_frames >= num_frames:
+            out = self._generate_bands(emb, size, step_list)
+            return out.cpu() if offload else out
+
+        def _generate_chunk(chunk_emb: torch.Tensor, length: int) -> torch.Tensor:
+            return self._generate_bands(chunk_emb, torch.Size([*size[:-1], length]), step_list)
+
+        overlap_frames = min(int(chunk_overlap * self.codec_model.frame_rate), chunk_frames // 2)
+        return chunked_overlap_add(_generate_chunk, emb, chunk_frames, overlap_frames, upsampling,
+                                   length=size[-1], offload=offload)
+
+    def _get_split_bands(self, n_bands: int, device: torch.device) -> julius.SplitBands:
+        if n_bands not in self._split_bands:
+            self._split_bands[n_bands] = julius.SplitBands(n_bands=n_bands, sample_rate=self.codec_model.sample_rate)
+        split = self._split_bands[n_bands].to(device)
+        self._split_bands[n_bands] = split
+        return split
 
     def re_eq(self, wav: torch.Tensor, ref: torch.Tensor, n_bands: int = 32, strictness: float = 1):
         """Match the eq to the encodec output by matching the standard deviation of some frequency bands.
@@ -156,36 +241,48 @@ class MultiBandDiffusion:
             n_bands (int): Number of bands of the eq.
             strictness (float): How strict the matching. 0 is no matching, 1 is exact matching.
         """
-        split = julius.SplitBands(n_bands=n_bands, sample_rate=self.codec_model.sample_rate).to(wav.device)
-        bands = split(wav)
+        split = self._get_split_bands(n_bands, wav.device)
+        bands = split(wav)  # [n_bands, B, C, T]
         bands_ref = split(ref)
-        out = torch.zeros_like(ref)
-        for i in range(n_bands):
-            out += bands[i] * (bands_ref[i].std() / bands[i].std()) ** strictness
-        return out
+        gains = (bands_ref.flatten(1).std(dim=1) / bands.flatten(1).std(dim=1)) ** strictness
+        return (bands * gains.view(-1, 1, 1, 1)).sum(dim=0)
 
-    def regenerate(self, wav: torch.Tensor, sample_rate: int):
+    def regenerate(self, wav: torch.Tensor, sample_rate: int, chunk_duration: tp.Optional[float] = None):
         """Regenerate a waveform through compression and diffusion regeneration.
         Args:
             wav (torch.Tensor): Original 'ground truth' audio.
             sample_rate (int): Sample rate of the input (and output) wav.
+            chunk_duration (float, optional): Duration of the chunks for long audio, see `generate`.
         """
         if sample_rate != self.codec_model.sample_rate:
             wav = julius.resample_frac(wav, sample_rate, self.codec_model.sample_rate)
         emb = self.get_condition(wav, sample_rate=self.codec_model.sample_rate)
         size = wav.size()
-        out = self.generate(emb, size=size)
+        out = self.generate(emb, size=size, chunk_duration=chunk_duration)
         if sample_rate != self.codec_model.sample_rate:
             out = julius.resample_frac(out, self.codec_model.sample_rate, sample_rate)
         return out
 
-    def tokens_to_wav(self, tokens: torch.Tensor, n_bands: int = 32):
+    def tokens_to_wav(self, tokens: torch.Tensor, n_bands: int = 32, chunk_duration: tp.Optional[float] = None,
+                      chunk_overlap: float = 0.5, offload: bool = False):
         """Generate Waveform audio with diffusion from the discrete codes.
         Args:
             tokens (torch.Tensor): Discrete codes.
             n_bands (int): Bands for the eq matching.
+            chunk_duration (float, optional): Duration of the chunks for long audio, used both for
+                the compression model decoding and the diffusion, see `generate`.
+            chunk_overlap (float): Overlap in seconds between consecutive chunks, reduced to half of
+                `chunk_duration` if longer.
+            offload (bool): If True, the decoded chunks are moved to the CPU as soon as they are ready,
+                and the eq matching runs on CPU.
         """
-        wav_encodec = self.codec_model.decode(tokens)
+        if chunk_duration is None:
+            wav_encodec = self.codec_model.decode(tokens)
+            wav_encodec = wav_encodec.cpu() if offload else wav_encodec
+        else:
+            wav_encodec = self.codec_model.decode_chunked(tokens, chunk_duration=chunk_duration,
+                                                          chunk_overlap=chunk_overlap, offload=offload)
         condition = self.get_emb(tokens)
-        wav_diffusion = self.generate(emb=condition, size=wav_encodec.size())
+        wav_diffusion = self.generate(emb=condition, size=wav_encodec.size(), chunk_duration=chunk_duration,
+                                      chunk_overlap=chunk_overlap, offload=offload)
         return self.re_eq(wav=wav_diffusion, ref=wav_encodec, n_bands=n_bands)
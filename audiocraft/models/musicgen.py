@@ -16,11 +16,12 @@ import torch
 
 from .encodec import CompressionModel
 from .genmodel import BaseGenModel
-from .lm import LMModel
+from .lm import CFGConditions, LMModel
 from .builders import get_debug_compression_model, get_debug_lm_model
 from .loaders import load_compression_model, load_lm_model
 from ..data.audio_utils import convert_audio
 from ..modules.conditioners import ConditioningAttributes, WavCondition, StyleConditioner
+from ..utils.profiler import trace_span, traced
 
 
 MelodyList = tp.List[tp.Optional[torch.Tensor]]
@@ -152,6 +153,7 @@ class MusicGen(BaseGenModel):
                                                                     ds_factor=ds_factor,
                                                                     encodec_n_q=encodec_n_q)
 
+    @traced('generate')
     def generate_with_chroma(self, descriptions: tp.List[str], melody_wavs: MelodyType,
                              melody_sample_rate: int, progress: bool = False,
                              return_tokens: bool = False) -> tp.Union[torch.Tensor,
@@ -191,6 +193,7 @@ class MusicGen(BaseGenModel):
         return self.generate_audio(tokens)
 
     @torch.no_grad()
+    @traced('prepare_inputs')
     def _prepare_tokens_and_attributes(
             self,
             descriptions: tp.Sequence[tp.Optional[str]],
@@ -242,20 +245,27 @@ class MusicGen(BaseGenModel):
             if descriptions is not None:
                 assert len(descriptions) == len(prompt), "Prompt and nb. descriptions doesn't match"
             prompt = prompt.to(self.device)
-            prompt_tokens, scale = self.compression_model.encode(prompt)
+            with trace_span('encode_prompt'):
+                prompt_tokens, scale = self.compression_model.encode(prompt)
             assert scale is None
         else:
             prompt_tokens = None
         return attributes, prompt_tokens
 
+    @traced('generate_tokens')
     def _generate_tokens(self, attributes: tp.List[ConditioningAttributes],
-                         prompt_tokens: tp.Optional[torch.Tensor], progress: bool = False) -> torch.Tensor:
+                         prompt_tokens: tp.Optional[torch.Tensor], progress: bool = False,
+                         cfg_conditions: tp.Optional[CFGConditions] = None,
+                         num_samples: tp.Optional[int] = None) -> torch.Tensor:
         """Generate discrete audio tokens given audio prompt and/or conditions.
 
         Args:
             attributes (list of ConditioningAttributes): Conditions used for generation (text/melody).
             prompt_tokens (torch.Tensor, optional): Audio prompt used for continuation.
             progress (bool, optional): Flag to display progress of the generation process. Defaults to False.
+            cfg_conditions (CFGConditions, optional): Pre-computed conditions used instead of `attributes`.
+                They are reused as is for every chunk of an extended generation.
+            num_samples (int, optional): Number of samples, required along with `cfg_conditions`.
         Returns:
             torch.Tensor: Generated audio, of shape [B, C, T], T is defined by the generation params.
         """
@@ -280,12 +290,16 @@ class MusicGen(BaseGenModel):
         if progress:
             callback = _progress_callback
 
+        lm_kwargs: dict = dict(self.generation_params)
+        if cfg_conditions is not None:
+            lm_kwargs.update(cfg_conditions=cfg_conditions, num_samples=num_samples)
+
         if self.duration <= self.max_duration:
             # generate by sampling from LM, simple case.
             with self.autocast:
                 gen_tokens = self.lm.generate(
                     prompt_tokens, attributes,
-                    callback=callback, max_gen_len=total_gen_len, **self.generation_params)
+                    callback=callback, max_gen_len=total_gen_len, **lm_kwargs)
 
         else:
             # now this gets a bit messier, we need to handle prompts,
@@ -325,7 +339,7 @@ class MusicGen(BaseGenModel):
                 with self.autocast:
                     gen_tokens = self.lm.generate(
                         prompt_tokens, attributes,
-                        callback=callback, max_gen_len=max_gen_len, **self.generation_params)
+                        callback=callback, max_gen_len=max_gen_len, **lm_kwargs)
                 if prompt_tokens is None:
                     all_tokens.append(gen_tokens)
                 else:
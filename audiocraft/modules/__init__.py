@@ -6,6 +6,8 @@
 """Modules used for building the models."""
 
 # flake8: noqa
+import typing as tp
+
 from .conv import (
     NormConv1d,
     NormConv2d,
@@ -15,8 +17,16 @@ from .conv import (
     StreamableConvTranspose1d,
     pad_for_conv1d,
     pad1d,
+    remove_parametrization_norm,
     unpad1d,
 )
 from .lstm import StreamableLSTM
 from .seanet import SEANetEncoder, SEANetDecoder
-from .transformer import StreamingTransformer
\ No newline at end of file
+
+
+def __getattr__(name: str) -> tp.Any:
+    # the transformer depends on xformers, which is slow to import and not needed by the codecs.
+    if name == 'StreamingTransformer':
+        from .transformer import StreamingTransformer
+        return StreamingTransformer
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
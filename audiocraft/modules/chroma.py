@@ -6,7 +6,6 @@
 import typing as tp
 
 from einops import rearrange
-from librosa import filters
 import torch
 from torch import nn
 import torch.nn.functional as F
@@ -37,6 +36,7 @@ class ChromaExtractor(nn.Module):
         self.n_chroma = n_chroma
         self.norm = norm
         self.argmax = argmax
+        from librosa import filters  # librosa is slow to import, defer it to the first extractor.
         self.register_buffer('fbanks', torch.from_numpy(filters.chroma(sr=sample_rate, n_fft=self.nfft, tuning=0,
                                                                        n_chroma=self.n_chroma)), persistent=False)
         self.spec = torchaudio.transforms.Spectrogram(n_fft=self.nfft, win_length=self.winlen,
@@ -0,0 +1,171 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+"""Shared CLAP embedding service, used by the `CLAPEmbeddingConditioner`
+and the `CLAPTextConsistencyMetric` so that a single CLAP model is loaded per device.
+"""
+
+from collections import OrderedDict
+import logging
+from pathlib import Path
+import typing as tp
+
+import torch
+
+from ..data.audio_utils import convert_audio
+from ..environment import AudioCraftEnvironment
+from ..utils.utils import load_clap_state_dict
+
+
+logger = logging.getLogger(__name__)
+
+
+def _canonical_device(device: tp.Union[str, torch.device]) -> torch.device:
+    device = torch.device(device)
+    if device.type == 'cuda' and device.index is None:
+        device = torch.device('cuda', torch.cuda.current_device())
+    return device
+
+
+class CLAPEmbeddingService:
+    """Wrapper around a pre-trained CLAP model computing audio and text embeddings in batch.
+    Instances should be obtained through `CLAPEmbeddingService.get_shared` so that every user of the
+    same checkpoint on the same device shares a single model. Text embeddings are memoized in a LRU
+    cache as the same descriptions are typically encoded over and over at evaluation.
+
+    Args:
+        checkpoint (str or Path): Path to CLAP checkpoint.
+        model_arch (str): CLAP model architecture.
+        enable_fusion (bool): Enable fusion for CLAP model.
+        device (str or torch.device): Device for the CLAP model.
+        text_cache_size (int): Maximum number of text embeddings kept in the LRU cache.
+    """
+    SAMPLE_RATE = 48_000
+    _shared: tp.Dict[tp.Tuple[str, str, bool, str], 'CLAPEmbeddingService'] = {}
+
+    def __init__(self, checkpoint: tp.Union[str, Path], model_arch: str = 'HTSAT-tiny',
+                 enable_fusion: bool = False, device: tp.Union[str, torch.device] = 'cpu',
+                 text_cache_size: int = 1024):
+        try:
+            import laion_clap  # type: ignore
+        except ImportError:
+            raise ImportError("Please install CLAP to compute CLAP embeddings: 'pip install laion_clap'")
+        from transformers import RobertaTokenizer  # type: ignore
+        checkpoint = AudioCraftEnvironment.resolve_reference_path(checkpoint)
+        self.checkpoint = checkpoint
+        self.model_arch = model_arch
+        self.enable_fusion = enable_fusion
+        self.device = _canonical_device(device)
+        self.tokenize = RobertaTokenizer.from_pretrained('roberta-base')
+        self.model = laion_clap.CLAP_Module(enable_fusion=enable_fusion, amodel=model_arch)
+        load_clap_state_dict(self.model, checkpoint)
+        self.model.eval()
+        self.model.to(self.device)
+        self.text_cache_size = text_cache_size
+        self._text_cache: tp.OrderedDict[str, torch.Tensor] = OrderedDict()
+
+    @classmethod
+    def get_shared(cls, checkpoint: tp.Union[str, Path], model_arch: str = 'HTSAT-tiny',
+                   enable_fusion: bool = False, device: tp.Union[str, torch.device] = 'cpu',
+                   **kwargs) -> 'CLAPEmbeddingService':
+        """Return the CLAP service for the given model and device, loading it only on first use.
+        If a later caller asks for a larger `text_cache_size`, the text cache of the shared service grows to it.
+        """
+        checkpoint = AudioCraftEnvironment.resolve_reference_path(checkpoint)
+        key = (str(checkpoint), model_arch, enable_fusion, str(_canonical_device(device)))
+        if key not in cls._shared:
+            logger.info("Loading shared CLAP model %s (%s) on %s", checkpoint, model_arch, key[-1])
+            cls._shared[key] = cls(checkpoint, model_arch, enable_fusion, device, **kwargs)
+            return cls._shared[key]
+        service = cls._shared[key]
+        text_cache_size = kwargs.get('text_cache_size')
+        if text_cache_size is not None and text_cache_size != service.text_cache_size:
+            logger.warning("Shared CLAP model %s on %s requested with a text cache of %d entries, but it has %d, "
+                           "keeping the largest.", checkpoint, key[-1], text_cache_size, service.text_cache_size)
+            service.text_cache_size = max(service.text_cache_size, text_cache_size)
+        return service
+
+    @classmethod
+    def clear_shared(cls) -> None:
+        """Release all the shared CLAP models."""
+        cls._shared.clear()
+
+    def _tokenizer(self, texts: tp.Union[str, tp.List[str]]) -> dict:
+        # we use the default params from CLAP module here as well
+        return self.tokenize(texts, padding="max_length", truncation=True, max_length=77, return_tensors="pt")
+
+    def preprocess_wav(self, wav: torch.Tensor, sample_rates: tp.Sequence[int],
+                       sample_rate: tp.Optional[int] = None) -> torch.Tensor:
+        """Convert a batch of audio to the monophonic audio expected by the CLAP model.
+        Items sharing the same sample rate are resampled together.
+
+        Args:
+            wav (torch.Tensor): Audio wav, of shape [B, C, T].
+            sample_rates (list[int]): Sample rates for each sample in the batch.
+            sample_rate (int, optional): Target sample rate, defaults to the CLAP sample rate.
+        Returns:
+            torch.Tensor: Audio wav of shape [B, T].
+        """
+        assert wav.dim() == 3, "Expecting wav to be [B, C, T]"
+        assert len(sample_rates) == len(wav), "Expecting one sample rate per item in the batch"
+        to_rate = sample_rate or self.SAMPLE_RATE
+        unique_rates = set(int(sr) for sr in sample_rates)
+        if len(unique_rates) == 1:
+            return convert_audio(wav, from_rate=unique_rates.pop(), to_rate=to_rate, to_channels=1).mean(dim=1)
+        groups: tp.Dict[int, tp.List[int]] = {}
+        for idx, sr in enumerate(sample_rates):
+            groups.setdefault(int(sr), []).append(idx)
+        converted: tp.List[tp.Optional[torch.Tensor]] = [None] * len(wav)
+        for sr, indices in groups.items():
+            out = convert_audio(wav[indices], from_rate=sr, to_rate=to_rate, to_channels=1)
+            for idx, audio in zip(indices, out):
+                converted[idx] = audio
+        return torch.stack(converted, dim=0).mean(dim=1)  # type: ignore
+
+    @torch.no_grad()
+    def get_audio_embedding(self, wav: torch.Tensor, batch_size: tp.Optional[int] = None) -> torch.Tensor:
+        """Compute CLAP audio embeddings.
+
+        Args:
+            wav (torch.Tensor): Preprocessed audio of shape [N, T], at the CLAP sample rate.
+            batch_size (int, optional): Maximum number of items going through the model at once,
+                defaults to the full batch.
+        Returns:
+            torch.Tensor: Audio embedding of shape [N, D].
+        """
+        batch_size = batch_size or wav.size(0)
+        embeds = []
+        for i in range(0, wav.size(0), batch_size):
+            embeds.append(self.model.get_audio_embedding_from_data(wav[i:i + batch_size], use_tensor=True))
+        return torch.cat(embeds, dim=0)
+
+    @torch.no_grad()
+    def get_text_embedding(self, texts: tp.List[str]) -> torch.Tensor:
+        """Compute CLAP text embeddings, reusing the cached embeddings of texts already seen.
+        Only the missing texts, deduplicated, are encoded in a single batch.
+
+        Args:
+            texts (list[str]): List of B texts.
+        Returns:
+            torch.Tensor: Text embedding of shape [B, D].
+        """
+        found: tp.Dict[str, torch.Tensor] = {}
+        missing: tp.List[str] = []
+        for text in texts:
+            if text in self._text_cache:
+                self._text_cache.move_to_end(text)
+                found[text] = self._text_cache[text]
+            elif text not in found and text not in missing:
+                missing.append(text)
+        if missing:
+            embed = self.model.get_text_embedding(missing, tokenizer=self._tokenizer, use_tensor=True)
+            embed = embed.view(len(missing), -1)
+            for text, text_embed in zip(missing, embed):
+                found[text] = text_embed
+                if self.text_cache_size > 0:
+                    self._text_cache[text] = text_embed
+            while len(self._text_cache) > self.text_cache_size:
+                self._text_cache.popitem(last=False)
+        return torch.stack([found[text] for text in texts], dim=0)
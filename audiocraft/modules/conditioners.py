@@ -4,9 +4,10 @@
 # This source code is licensed under the license found in the
 # LICENSE file in the root directory of this source tree.
 
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 from copy import deepcopy
 from dataclasses import dataclass, field
+from hashlib import sha1
 from itertools import chain
 import logging
 import math
@@ -18,24 +19,23 @@ import warnings
 import einops
 import flashy
 from num2words import num2words
-import spacy
-from transformers import RobertaTokenizer, T5EncoderModel, T5Tokenizer  # type: ignore
 import torch
 from torch import nn
 import torch.nn.functional as F
 from torch.nn.utils.rnn import pad_sequence
 from enum import Enum
 from .chroma import ChromaExtractor
+from .clap import CLAPEmbeddingService
 from .streaming import StreamingModule
 from .transformer import create_sin_embedding, StreamingTransformer
 from ..data.audio import audio_read
 from ..data.audio_dataset import SegmentInfo
 from ..data.audio_utils import convert_audio
-from ..environment import AudioCraftEnvironment
 from ..quantization import ResidualVectorQuantizer
 from ..utils.autocast import TorchAutocast
 from ..utils.cache import EmbeddingCache
-from ..utils.utils import collate, hash_trick, length_to_mask, load_clap_state_dict, warn_once
+from ..utils.profiler import trace_count
+from ..utils.utils import collate, hash_trick, length_to_mask, warn_once
 
 
 logger = logging.getLogger(__name__)
@@ -74,6 +74,13 @@ class SymbolicCondition(tp.NamedTuple):
     melody: tp.Optional[torch.Tensor] = None
 
 
+class LengthBuckets(tp.NamedTuple):
+    """Tokenized inputs of a conditioner split in length buckets, see `ConditioningProvider`."""
+    indices: tp.List[torch.Tensor]  # indices in the batch of the items of each bucket
+    inputs: tp.List[tp.Any]  # tokenized inputs of each bucket
+    batch_size: int
+
+
 @dataclass
 class ConditioningAttributes:
     text: tp.Dict[str, tp.Optional[str]] = field(default_factory=dict)
@@ -259,6 +266,7 @@ class WhiteSpaceTokenizer(Tokenizer):
         self.pad_idx = pad_idx
         self.lemma = lemma
         self.stopwords = stopwords
+        import spacy  # slow to import, only needed by this tokenizer.
         try:
             self.nlp = spacy.load(language)
         except IOError:
@@ -359,6 +367,14 @@ class BaseConditioner(nn.Module):
         if self.output_dim > -1:  # omit projection when output_dim <= 0
             self.output_proj = nn.Linear(dim, output_dim)
 
+    @property
+    def supports_length_bucketing(self) -> bool:
+        """Whether the conditioner output for a given sample is independent of the padding
+        of the rest of the batch, so that the batch can be split in length buckets,
+        see `ConditioningProvider`.
+        """
+        return False
+
     def tokenize(self, *args, **kwargs) -> tp.Any:
         """Should be any part of the processing that will lead to a synchronization
         point, e.g. BPE tokenization with transfer to the GPU.
@@ -381,7 +397,9 @@ class BaseConditioner(nn.Module):
 
 
 class TextConditioner(BaseConditioner):
-    ...
+    @property
+    def supports_length_bucketing(self) -> bool:
+        return True
 
 
 class LUTConditioner(TextConditioner):
@@ -430,6 +448,8 @@ class T5Conditioner(TextConditioner):
         autocast_dtype (tp.Optional[str], optional): Autocast dtype.
         word_dropout (float, optional): Word dropout probability.
         normalize_text (bool, optional): Whether to apply text normalization.
+        path (str, optional): Local directory holding the tokenizer and weights of the `name` model,
+            saved with `save_pretrained`, to load them from instead of the Hugging Face hub.
     """
     MODELS = ["t5-small", "t5-base", "t5-large", "t5-3b", "t5-11b",
               "google/flan-t5-small", "google/flan-t5-base", "google/flan-t5-large",
@@ -449,7 +469,7 @@ class T5Conditioner(TextConditioner):
 
     def __init__(self, name: str, output_dim: int, finetune: bool, device: str,
                  autocast_dtype: tp.Optional[str] = 'float32', word_dropout: float = 0.,
-                 normalize_text: bool = False):
+                 normalize_text: bool = False, path: tp.Optional[str] = None):
         assert name in self.MODELS, f"Unrecognized t5 model name (should in {self.MODELS})"
         super().__init__(self.MODELS_DIMS[name], output_dim)
         self.device = device
@@ -472,8 +492,9 @@ class T5Conditioner(TextConditioner):
         with warnings.catch_warnings():
             warnings.simplefilter("ignore")
             try:
-                self.t5_tokenizer = T5Tokenizer.from_pretrained(name)
-                t5 = T5EncoderModel.from_pretrained(name).train(mode=finetune)
+                from transformers import T5EncoderModel, T5Tokenizer  # type: ignore
+                self.t5_tokenizer = T5Tokenizer.from_pretrained(path or name)
+                t5 = T5EncoderModel.from_pretrained(path or name).train(mode=finetune)
             finally:
                 logging.disable(previous_level)
         if finetune:
@@ -587,13 +608,17 @@ class ChromaStemConditioner(WaveformConditioner):
             conditions during eval (for cases where we don't want to leak test conditions like MusicCaps).
             Defaults to None.
         n_eval_wavs (int, optional): limits the number of waveforms used for conditioning. Defaults to 0.
+        cache_path (str or Path, optional): path to the pre-computed full chroma cache, that can be
+            filled ahead of time with `scripts/precompute_chroma_stem_cache.py`. Defaults to None.
+        memo_size (int, optional): number of stemmed chromas memoized in memory by waveform hash
+            at inference, so that repeated melody prompts skip the source separation. Defaults to 32.
         device (tp.Union[torch.device, str], optional): Device for the conditioner.
         **kwargs: Additional parameters for the chroma extractor.
     """
     def __init__(self, output_dim: int, sample_rate: int, n_chroma: int, radix2_exp: int,
                  duration: float, match_len_on_eval: bool = True, eval_wavs: tp.Optional[str] = None,
                  n_eval_wavs: int = 0, cache_path: tp.Optional[tp.Union[str, Path]] = None,
-                 device: tp.Union[torch.device, str] = 'cpu', **kwargs):
+                 memo_size: int = 32, device: tp.Union[torch.device, str] = 'cpu', **kwargs):
         from demucs import pretrained
         super().__init__(dim=n_chroma, output_dim=output_dim, device=device)
         self.autocast = TorchAutocast(enabled=device != 'cpu', device_type=self.device, dtype=torch.float32)
@@ -614,6 +639,8 @@ class ChromaStemConditioner(WaveformConditioner):
             self.cache = EmbeddingCache(Path(cache_path) / 'wav', self.device,
                                         compute_embed_fn=self._get_full_chroma_for_cache,
                                         extract_embed_fn=self._extract_chroma_chunk)
+        self.memo_size = memo_size
+        self._chroma_memo: tp.OrderedDict[str, torch.Tensor] = OrderedDict()
 
     def _downsampling_factor(self) -> int:
         return self.chroma.winhop
@@ -690,6 +717,44 @@ class ChromaStemConditioner(WaveformConditioner):
         chroma = self._extract_chroma(stems)
         return chroma
 
+    @staticmethod
+    def _wav_signature(wav: torch.Tensor, sample_rate: int) -> str:
+        """Content hash of a single waveform, used as key for the stemmed chroma memo."""
+        sig = sha1(wav.detach().to('cpu', torch.float32).contiguous().numpy().tobytes())
+        sig.update(f"{sample_rate}:{tuple(wav.shape)}".encode())
+        return sig.hexdigest()
+
+    @torch.no_grad()
+    def _compute_wav_embedding_memoized(self, wav: torch.Tensor, sample_rate: int) -> torch.Tensor:
+        """Compute wav embedding, reusing the memoized stemmed chroma of waveforms already seen.
+        Only the waveforms missing from the memo (deduplicated within the batch) go through
+        the source separation, the memo keeps the `memo_size` most recently used entries.
+        """
+        if self.memo_size <= 0 or wav.shape[-1] == 1:
+            return self._compute_wav_embedding(wav, sample_rate)
+        sigs = [self._wav_signature(w, sample_rate) for w in wav]
+        found: tp.Dict[str, torch.Tensor] = {}
+        missing: tp.Dict[str, int] = {}
+        for idx, sig in enumerate(sigs):
+            if sig in self._chroma_memo:
+                self._chroma_memo.move_to_end(sig)
+                found[sig] = self._chroma_memo[sig]
+                trace_count('chroma_memo_hits')
+            elif sig not in missing:
+                missing[sig] = idx
+        if missing:
+            chroma = self._compute_wav_embedding(wav[list(missing.values())], sample_rate)
+            for sig, embed in zip(missing.keys(), chroma):
+                found[sig] = embed
+                self._chroma_memo[sig] = embed
+            while len(self._chroma_memo) > self.memo_size:
+                self._chroma_memo.popitem(last=False)
+        return torch.stack([found[sig] for sig in sigs], dim=0)
+
+    def clear_memo(self) -> None:
+        """Drop all the memoized stemmed chromas."""
+        self._chroma_memo.clear()
+
     @torch.no_grad()
     def _get_full_chroma_for_cache(self, path: tp.Union[str, Path], x: WavCondition, idx: int) -> torch.Tensor:
         """Extract chroma from the whole audio waveform at the given path."""
@@ -734,7 +799,10 @@ class ChromaStemConditioner(WaveformConditioner):
             chroma = self.cache.get_embed_from_cache(paths, x)
         else:
             assert all(sr == x.sample_rate[0] for sr in x.sample_rate), "All sample rates in batch should be equal."
-            chroma = self._compute_wav_embedding(x.wav, x.sample_rate[0])
+            if self.training:
+                chroma = self._compute_wav_embedding(x.wav, x.sample_rate[0])
+            else:
+                chroma = self._compute_wav_embedding_memoized(x.wav, x.sample_rate[0])
 
         if self.match_len_on_eval:
             B, T, C = chroma.shape
@@ -749,6 +817,12 @@ class ChromaStemConditioner(WaveformConditioner):
 
         return chroma
 
+    @property
+    def supports_length_bucketing(self) -> bool:
+        # Without masking, the chroma is completed by periodicity and the padding of the batch leaks
+        # into the embedding of shorter samples. The embedding cache is populated for the full batch at once.
+        return self._use_masking and self.cache is None and self.eval_wavs is None
+
     def tokenize(self, x: WavCondition) -> WavCondition:
         """Apply WavConditioner tokenization and populate cache if needed."""
         x = super().tokenize(x)
@@ -1086,44 +1160,37 @@ class CLAPEmbeddingConditioner(JointEmbeddingConditioner):
         audio_stride (float): Stride to use for getting a CLAP embedding on the full sequence.
         normalize (bool): Whether to normalize the CLAP embedding.
         text_p (float): Probability of using text representation instead of audio at train time.
-        batch_size (Optional[int]): Batch size for CLAP embedding computation.
+        batch_size (Optional[int]): Batch size for CLAP embedding computation, defaults to the full batch.
         autocast_dtype (str): Autocast for the conditioner.
         cache_path (Optional[str]): Path for pre-computed embeddings caching.
+        text_cache_size (int): Number of text embeddings kept in memory by the shared CLAP service.
         kwargs: Additional parameters for residual vector quantizer.
     """
     def __init__(self, dim: int, output_dim: int, device: str, attribute: str,
                  quantize: bool, n_q: int, bins: int, checkpoint: tp.Union[str, Path], model_arch: str,
                  enable_fusion: bool, sample_rate: int, max_audio_length: int, audio_stride: int,
                  normalize: bool, text_p: bool, batch_size: tp.Optional[int] = None,
-                 autocast_dtype: tp.Optional[str] = 'float32', cache_path: tp.Optional[str] = None, **kwargs):
-        try:
-            import laion_clap  # type: ignore
-        except ImportError:
-            raise ImportError("Please install CLAP to use the CLAPEmbeddingConditioner: 'pip install laion_clap'")
+                 autocast_dtype: tp.Optional[str] = 'float32', cache_path: tp.Optional[str] = None,
+                 text_cache_size: int = 1024, **kwargs):
         warnings.warn("Sample rate for CLAP conditioner was fixed in version v1.1.0, (from 44.1 to 48 kHz). "
                       "Please retrain all models.")
-        checkpoint = AudioCraftEnvironment.resolve_reference_path(checkpoint)
-        clap_tokenize = RobertaTokenizer.from_pretrained('roberta-base')
-        clap_model = laion_clap.CLAP_Module(enable_fusion=enable_fusion, amodel=model_arch)
-        load_clap_state_dict(clap_model, checkpoint)
-        clap_model.eval()
-        clap_model.to(device)
+        clap_service = CLAPEmbeddingService.get_shared(checkpoint, model_arch=model_arch, enable_fusion=enable_fusion,
+                                                       device=device, text_cache_size=text_cache_size)
         super().__init__(dim=dim, output_dim=output_dim, device=device, attribute=attribute,
                          autocast_dtype=autocast_dtype, quantize=quantize, n_q=n_q, bins=bins,
                          **kwargs)
-        self.checkpoint = checkpoint
+        self.checkpoint = clap_service.checkpoint
         self.enable_fusion = enable_fusion
         self.model_arch = model_arch
-        self.clap: laion_clap.CLAP_Module
-        self.clap_tokenize: RobertaTokenizer
+        self.clap_service: CLAPEmbeddingService
         self.clap_sample_rate = sample_rate
         self.clap_max_frames = int(self.clap_sample_rate * max_audio_length)
         self.clap_stride = int(self.clap_sample_rate * audio_stride)
-        self.batch_size = batch_size or 1
+        self.batch_size = batch_size
         self.normalize = normalize
         self.text_p = text_p
-        self.__dict__['clap_tokenize'] = clap_tokenize
-        self.__dict__['clap'] = clap_model
+        # the CLAP model is shared with other users (e.g. the CLAP metric) and not part of the checkpoint
+        self.__dict__['clap_service'] = clap_service
         self.wav_cache, self.text_cache = None, None
         if cache_path is not None:
             self.wav_cache = EmbeddingCache(Path(cache_path) / 'wav', self.device,
@@ -1132,9 +1199,9 @@ class CLAPEmbeddingConditioner(JointEmbeddingConditioner):
             self.text_cache = EmbeddingCache(Path(cache_path) / 'text', self.device,
                                              compute_embed_fn=self._get_text_embedding_for_cache)
 
-    def _tokenizer(self, texts: tp.Union[str, tp.List[str]]) -> dict:
-        # we use the default params from CLAP module here as well
-        return self.clap_tokenize(texts, padding="max_length", truncation=True, max_length=77, return_tensors="pt")
+    @property
+    def clap(self):
+        return self.clap_service.model
 
     def _compute_text_embedding(self, text: tp.List[str]) -> torch.Tensor:
         """Compute text embedding from CLAP model on a given a batch of text.
@@ -1144,9 +1211,8 @@ class CLAPEmbeddingConditioner(JointEmbeddingConditioner):
         Returns:
             torch.Tensor: CLAP embedding derived from text, of shape [B, 1, D], with D the CLAP embedding dimension.
         """
-        with torch.no_grad():
-            embed = self.clap.get_text_embedding(text, tokenizer=self._tokenizer, use_tensor=True)
-            return embed.view(embed.size(0), 1, embed.size(-1))
+        embed = self.clap_service.get_text_embedding(text)
+        return embed.view(embed.size(0), 1, embed.size(-1))
 
     def _get_text_embedding_for_cache(self, path: tp.Union[Path, str],
                                       x: JointEmbedCondition, idx: int) -> torch.Tensor:
@@ -1167,14 +1233,8 @@ class CLAPEmbeddingConditioner(JointEmbeddingConditioner):
         """
         assert wav.dim() == 3, "Expecting wav to be [B, C, T]"
         if sample_rates is not None:
-            _wav = []
-            for i, audio in enumerate(wav):
-                sr = sample_rates[i]
-                audio = convert_audio(audio, from_rate=sr, to_rate=self.clap_sample_rate, to_channels=1)
-                _wav.append(audio)
-            wav = torch.stack(_wav, dim=0)
-        wav = wav.mean(dim=1)
-        return wav
+            return self.clap_service.preprocess_wav(wav, sample_rates, self.clap_sample_rate)
+        return wav.mean(dim=1)
 
     def _compute_wav_embedding(self, wav: torch.Tensor, length: torch.Tensor,
                                sample_rates: tp.List[int], reduce_mean: bool = False) -> torch.Tensor:
@@ -1200,12 +1260,7 @@ class CLAPEmbeddingConditioner(JointEmbeddingConditioner):
             else:
                 wav = wav.view(-1, 1, T)  # [B, F, T] with F=1
             wav = einops.rearrange(wav, 'b f t -> (b f) t')
-            embed_list = []
-            for i in range(0, wav.size(0), self.batch_size):
-                _wav = wav[i:i+self.batch_size, ...]
-                _embed = self.clap.get_audio_embedding_from_data(_wav, use_tensor=True)
-                embed_list.append(_embed)
-            embed = torch.cat(embed_list, dim=0)
+            embed = self.clap_service.get_audio_embedding(wav, batch_size=self.batch_size)
             embed = einops.rearrange(embed, '(b f) d -> b f d', b=B)
             if reduce_mean:
                 embed = embed.mean(dim=1, keepdim=True)
@@ -1466,17 +1521,62 @@ class ClassifierFreeGuidanceDropout(DropoutModule):
         return f"ClassifierFreeGuidanceDropout(p={self.p})"
 
 
+def split_length_buckets(lengths: tp.Sequence[int], num_buckets: int) -> tp.List[tp.List[int]]:
+    """Split a batch in at most `num_buckets` groups of items of similar lengths,
+    minimizing the total padded length, i.e. the sum over the buckets of the bucket size
+    times the maximum length in the bucket.
+
+    Args:
+        lengths (list[int]): Length of each item in the batch.
+        num_buckets (int): Maximum number of buckets.
+    Returns:
+        list[list[int]]: Indices of the items of each bucket, sorted by increasing length.
+    """
+    order = sorted(range(len(lengths)), key=lambda idx: lengths[idx])
+    sorted_lengths = [lengths[idx] for idx in order]
+    num_buckets = max(1, min(num_buckets, len(set(sorted_lengths))))
+    num_items = len(order)
+    # cost[k][j]: minimum padded length to hold the first j items with k buckets.
+    inf = float('inf')
+    cost = [[inf] * (num_items + 1) for _ in range(num_buckets + 1)]
+    split = [[0] * (num_items + 1) for _ in range(num_buckets + 1)]
+    cost[0][0] = 0
+    for k in range(1, num_buckets + 1):
+        for j in range(1, num_items + 1):
+            for i in range(k - 1, j):
+                candidate = cost[k - 1][i] + (j - i) * sorted_lengths[j - 1]
+                if candidate < cost[k][j]:
+                    cost[k][j], split[k][j] = candidate, i
+    buckets = []
+    end = num_items
+    for k in range(num_buckets, 0, -1):
+        begin = split[k][end]
+        buckets.append(order[begin:end])
+        end = begin
+    return [bucket for bucket in buckets[::-1] if bucket]
+
+
 class ConditioningProvider(nn.Module):
     """Prepare and provide conditions given all the supported conditioners.
 
+    With `length_buckets > 1`, the batch of each conditioner supporting it (see
+    `BaseConditioner.supports_length_bucketing`) is split in up to `length_buckets` groups
+    of conditions of similar lengths, e.g. descriptions with a similar number of words.
+    Each group is padded and encoded separately and the outputs are scattered back in the
+    original batch order. This saves the compute and activation memory spent on padding
+    on batches with heterogeneous condition lengths, at the cost of more, smaller, kernel calls.
+
     Args:
         conditioners (dict): Dictionary of conditioners.
         device (torch.device or str, optional): Device for conditioners and output condition types.
+        length_buckets (int): Maximum number of length buckets per conditioner, 1 disables bucketing.
     """
-    def __init__(self, conditioners: tp.Dict[str, BaseConditioner], device: tp.Union[torch.device, str] = "cpu"):
+    def __init__(self, conditioners: tp.Dict[str, BaseConditioner], device: tp.Union[torch.device, str] = "cpu",
+                 length_buckets: int = 1):
         super().__init__()
         self.device = device
         self.conditioners = nn.ModuleDict(conditioners)
+        self.length_buckets = length_buckets
 
     @property
     def joint_embed_conditions(self):
@@ -1523,9 +1623,54 @@ class ConditioningProvider(nn.Module):
         )
 
         for attribute, batch in chain(text.items(), wavs.items(), joint_embeds.items()):
-            output[attribute] = self.conditioners[attribute].tokenize(batch)
+            output[attribute] = self._tokenize_attribute(attribute, batch)
         return output
 
+    def _tokenize_attribute(self, attribute: str, batch: tp.Any) -> tp.Any:
+        """Tokenize the collated batch of a single attribute, splitting it in length buckets if enabled."""
+        conditioner = self.conditioners[attribute]
+        if self.length_buckets <= 1 or not conditioner.supports_length_bucketing:
+            return conditioner.tokenize(batch)
+        if isinstance(batch, WavCondition):
+            lengths = [int(length) for length in batch.length]
+        elif isinstance(batch, list):
+            lengths = [len(text.split()) if text else 0 for text in batch]
+        else:
+            return conditioner.tokenize(batch)
+        buckets = split_length_buckets(lengths, self.length_buckets)
+        if len(buckets) == 1:
+            return conditioner.tokenize(batch)
+        inputs = []
+        for bucket in buckets:
+            if isinstance(batch, WavCondition):
+                # trim the padding shared by all the items of the bucket, keeping at least one sample.
+                max_len = max(1, max(lengths[idx] for idx in bucket))
+                sub_batch: tp.Any = WavCondition(
+                    batch.wav[bucket, ..., :max_len], batch.length[bucket],
+                    [batch.sample_rate[idx] for idx in bucket],
+                    [batch.path[idx] for idx in bucket] if batch.path else [],
+                    [batch.seek_time[idx] for idx in bucket] if batch.seek_time else [])
+            else:
+                sub_batch = [batch[idx] for idx in bucket]
+            inputs.append(conditioner.tokenize(sub_batch))
+        indices = [torch.tensor(bucket, dtype=torch.long) for bucket in buckets]
+        return LengthBuckets(indices, inputs, len(lengths))
+
+    def _forward_buckets(self, conditioner: BaseConditioner, buckets: LengthBuckets) -> ConditionType:
+        """Run the conditioner over each length bucket and scatter the outputs back in batch order,
+        padding them to the longest bucket output.
+        """
+        outputs = [conditioner(inputs) for inputs in buckets.inputs]
+        max_len = max(embeds.shape[1] for embeds, _ in outputs)
+        first_embeds, first_mask = outputs[0]
+        embeds = first_embeds.new_zeros(buckets.batch_size, max_len, first_embeds.shape[-1])
+        mask = first_mask.new_zeros(buckets.batch_size, max_len)
+        for indices, (bucket_embeds, bucket_mask) in zip(buckets.indices, outputs):
+            indices = indices.to(embeds.device)
+            embeds[indices, :bucket_embeds.shape[1]] = bucket_embeds.to(embeds.dtype)
+            mask[indices, :bucket_mask.shape[1]] = bucket_mask.to(mask.dtype)
+        return embeds, mask
+
     def forward(self, tokenized: tp.Dict[str, tp.Any]) -> tp.Dict[str, ConditionType]:
         """Compute pairs of `(embedding, mask)` using the configured conditioners and the tokenized representations.
         The output is for example:
@@ -1540,7 +1685,10 @@ class ConditioningProvider(nn.Module):
         """
         output = {}
         for attribute, inputs in tokenized.items():
-            condition, mask = self.conditioners[attribute](inputs)
+            if isinstance(inputs, LengthBuckets):
+                condition, mask = self._forward_buckets(self.conditioners[attribute], inputs)
+            else:
+                condition, mask = self.conditioners[attribute](inputs)
             output[attribute] = (condition, mask)
         return output
 
@@ -1683,17 +1831,31 @@ class ConditionFuser(StreamingModule):
             }
         cross_attention_pos_emb (bool, optional): Use positional embeddings in cross attention.
         cross_attention_pos_emb_scale (int): Scale for positional embeddings in cross attention if used.
+        cross_attention_padding (str): How the padded positions of the cross attention conditions
+            are handled, see `cross_attention_padding_bias`. One of:
+            - 'attend': padded positions are attended to as any other position (legacy behavior).
+            - 'collapse': all the padded positions of a sample are folded in a single key whose
+              attention score is offset by the log of the number of padded positions. As padded
+              conditions are zeroed, this gives the same output as 'attend' for models trained with it,
+              as long as no positional embedding is used in cross attention.
+            - 'mask': padded positions are ignored, for models trained this way.
     """
     FUSING_METHODS = ["sum", "prepend", "cross", "ignore", "input_interpolate"]
+    CROSS_ATTENTION_PADDING = ["attend", "collapse", "mask"]
 
     def __init__(self, fuse2cond: tp.Dict[str, tp.List[str]], cross_attention_pos_emb: bool = False,
-                 cross_attention_pos_emb_scale: float = 1.0):
+                 cross_attention_pos_emb_scale: float = 1.0, cross_attention_padding: str = 'attend'):
         super().__init__()
         assert all(
             [k in self.FUSING_METHODS for k in fuse2cond.keys()]
         ), f"Got invalid fuse method, allowed methods: {self.FUSING_METHODS}"
+        assert cross_attention_padding in self.CROSS_ATTENTION_PADDING, \
+            f"Got invalid cross attention padding, allowed values: {self.CROSS_ATTENTION_PADDING}"
+        if cross_attention_padding == 'collapse' and cross_attention_pos_emb:
+            raise ValueError("Padded positions can only be collapsed without cross attention positional embedding.")
         self.cross_attention_pos_emb = cross_attention_pos_emb
         self.cross_attention_pos_emb_scale = cross_attention_pos_emb_scale
+        self.cross_attention_padding = cross_attention_padding
         self.fuse2cond: tp.Dict[str, tp.List[str]] = fuse2cond
         self.cond2fuse: tp.Dict[str, str] = {}
         for fuse_method, conditions in fuse2cond.items():
@@ -1761,3 +1923,30 @@ class ConditionFuser(StreamingModule):
             self._streaming_state['offsets'] = offsets + T
 
         return input, cross_attention_output
+
+    def cross_attention_padding_bias(self, conditions: tp.Dict[str, ConditionType]) -> tp.Optional[torch.Tensor]:
+        """Additive attention bias for the padded positions of the cross attention source
+        returned by `forward` for the same conditions, to be used as `cross_attention_mask`.
+
+        Args:
+            conditions (dict[str, ConditionType]): Dict of conditions.
+        Returns:
+            torch.Tensor, optional: Bias of shape [B, S], or None when padded positions are attended to.
+        """
+        if self.cross_attention_padding == 'attend':
+            return None
+        masks = [cond_mask for cond_type, (_, cond_mask) in conditions.items()
+                 if self.cond2fuse[cond_type] == 'cross']
+        if not masks:
+            return None
+        padding = torch.cat(masks, dim=1) == 0  # [B, S]
+        num_padding = padding.sum(dim=1, keepdim=True)
+        bias = torch.zeros(padding.shape, device=padding.device).masked_fill(padding, float('-inf'))
+        if self.cross_attention_padding == 'collapse':
+            # keep only the first padded position, accounting for the other identical ones.
+            first_padding = padding & (padding.cumsum(dim=1) == 1)
+            bias = torch.where(first_padding, num_padding.float().log().expand_as(bias), bias)
+        else:
+            # samples without any condition attend to the (zeroed) padding rather than to nothing.
+            bias = bias.masked_fill(num_padding == padding.shape[1], 0.)
+        return bias
@@ -11,7 +11,9 @@ import warnings
 import torch
 from torch import nn
 from torch.nn import functional as F
-from torch.nn.utils import spectral_norm, weight_norm
+from torch.nn.utils import parametrize, spectral_norm, weight_norm
+from torch.nn.utils.spectral_norm import SpectralNorm
+from torch.nn.utils.weight_norm import WeightNorm
 
 
 CONV_NORMALIZATIONS = frozenset(['none', 'weight_norm', 'spectral_norm',
@@ -30,6 +32,33 @@ def apply_parametrization_norm(module: nn.Module, norm: str = 'none'):
         return module
 
 
+def remove_parametrization_norm(module: nn.Module) -> int:
+    """Fold the weight or spectral normalization of all the submodules of `module` into plain weights,
+    so that the normalized weight is no longer recomputed on each forward. The outputs are unchanged
+    in eval mode, but the weights can no longer be trained with the normalization, and the state dict
+    holds a single `weight` instead of the normalization parameters.
+
+    Args:
+        module (nn.Module): Module whose submodules normalizations are folded in place.
+    Returns:
+        int: Number of folded normalizations.
+    """
+    num_folded = 0
+    for child in module.modules():
+        if parametrize.is_parametrized(child, 'weight'):
+            parametrize.remove_parametrizations(child, 'weight', leave_parametrized=True)
+            num_folded += 1
+            continue
+        for hook in list(child._forward_pre_hooks.values()):
+            if isinstance(hook, WeightNorm):
+                torch.nn.utils.remove_weight_norm(child, hook.name)
+                num_folded += 1
+            elif isinstance(hook, SpectralNorm):
+                torch.nn.utils.remove_spectral_norm(child, hook.name)
+                num_folded += 1
+    return num_folded
+
+
 def get_norm_module(module: nn.Module, causal: bool = False, norm: str = 'none', **norm_kwargs):
     """Return the proper normalization module. If causal is True, this will ensure the returned
     module is causal, or return an error if the normalization doesn't support causal evaluation.
@@ -9,6 +9,7 @@ Functions for Noise Schedule, defines diffusion process, reverse process and dat
 """
 
 from collections import namedtuple
+import math
 import random
 import typing as tp
 import julius
@@ -124,6 +125,8 @@ class NoiseSchedule:
         sample_processor (SampleProcessor): Module that normalize data to match better the gaussian distribution
         noise_scale (float): Scaling factor for the noise
     """
+    SAMPLERS = ('ddpm', 'ddim', 'dpmpp_2m')
+
     def __init__(self, beta_t0: float = 1e-4, beta_t1: float = 0.02, num_steps: int = 1000, variance: str = 'beta',
                  clip: float = 5., rescale: float = 1., device='cuda', beta_exp: float = 1,
                  repartition: str = "power", alpha_sigmoid: dict = {}, n_bands: tp.Optional[int] = None,
@@ -145,6 +148,9 @@ class NoiseSchedule:
         else:
             raise RuntimeError('Not implemented')
         self.rng = random.Random(1234)
+        # host copy of alpha_bar for each step, and cache of the coefficients of the subsampled reverse processes.
+        self._alpha_bars = (1 - self.betas.cpu().double()).cumprod(dim=0)
+        self._coefficients: tp.Dict[tp.Tuple[str, tp.Tuple[int, ...]], tp.List[tp.Tuple]] = {}
 
     def get_beta(self, step: tp.Union[int, torch.Tensor]):
         if self.n_bands is None:
@@ -235,38 +241,131 @@ class NoiseSchedule:
         else:
             return self.sample_processor.return_sample(previous)
 
-    def generate_subsampled(self, model: torch.nn.Module, initial: torch.Tensor, step_list: tp.Optional[list] = None,
-                            condition: tp.Optional[torch.Tensor] = None, return_list: bool = False):
-        """Reverse process that only goes through Markov chain states in step_list."""
-        if step_list is None:
-            step_list = list(range(1000))[::-50] + [0]
-        alpha_bar = self.get_alpha_bar(step=self.num_steps - 1)
-        alpha_bars_subsampled = (1 - self.betas).cumprod(dim=0)[list(reversed(step_list))].cpu()
+    def get_step_list(self, num_sampling_steps: tp.Optional[int] = None) -> tp.List[int]:
+        """Markov chain states visited by the subsampled reverse process, from the noisiest to step 0.
+        Defaults to one step out of 50, otherwise `num_sampling_steps` steps linearly spaced."""
+        if num_sampling_steps is None:
+            return list(range(self.num_steps))[::-50] + [0]
+        steps = torch.linspace(self.num_steps - 1, 0, num_sampling_steps + 1).round().long().tolist()
+        return sorted(set(steps), reverse=True)
+
+    def sampling_coefficients(self, step_list: tp.List[int], sampler: str = 'ddpm') -> tp.List[tp.Tuple]:
+        """Coefficients of each step of the reverse process going through the Markov chain states in step_list,
+        computed once on the host and cached, so that the sampling loop only multiplies tensors by python
+        scalars, without any device synchronization nor extra kernel.
+
+        Returns:
+            list of tuple: One tuple per denoising step, (step, alpha, alpha_bar, sigma2) for 'ddpm', and
+                (step, alpha_t, sigma_t, coef_x, coef_denoised, weight_prev) for the deterministic samplers,
+                the next state being `coef_x * x + coef_denoised * ((1 + weight_prev) * x0 - weight_prev * x0_prev)`
+                with x0 the estimate of the clean sample.
+        """
+        if sampler not in self.SAMPLERS:
+            raise ValueError(f"Unknown sampler {sampler}, expected one of {self.SAMPLERS}.")
+        key = (sampler, tuple(step_list))
+        if key not in self._coefficients:
+            if sampler == 'ddpm':
+                self._coefficients[key] = self._ddpm_coefficients(step_list)
+            else:
+                self._coefficients[key] = self._multistep_coefficients(step_list, second_order=sampler == 'dpmpp_2m')
+        return self._coefficients[key]
+
+    def _ddpm_coefficients(self, step_list: tp.List[int]) -> tp.List[tp.Tuple]:
+        alpha_bars = self._alpha_bars
+        alpha_bars_subsampled = alpha_bars[list(reversed(step_list))]
         betas_subsampled = betas_from_alpha_bar(alpha_bars_subsampled)
-        current = initial * self.noise_scale
-        iterates = [current]
+        alpha_bar = alpha_bars[self.num_steps - 1].item()
+        coefficients = []
         for idx, step in enumerate(step_list[:-1]):
-            with torch.no_grad():
-                estimate = model(current, step, condition=condition).sample * self.noise_scale
-            alpha = 1 - betas_subsampled[-1 - idx]
-            previous = (current - (1 - alpha) / (1 - alpha_bar).sqrt() * estimate) / alpha.sqrt()
-            previous_alpha_bar = self.get_alpha_bar(step_list[idx + 1])
+            alpha = 1 - betas_subsampled[-1 - idx].item()
             if step == step_list[-2]:
-                sigma2 = 0
-                previous_alpha_bar = torch.tensor(1.0)
+                sigma2 = 0.
+                previous_alpha_bar = 1.
             else:
+                previous_alpha_bar = alpha_bars[step_list[idx + 1]].item()
                 sigma2 = (1 - previous_alpha_bar) / (1 - alpha_bar) * (1 - alpha)
-            if sigma2 > 0:
-                previous += sigma2**0.5 * torch.randn_like(previous) * self.noise_scale
-            if self.clip:
-                previous = previous.clamp(-self.clip, self.clip)
-            current = previous
+            coefficients.append((step, alpha, alpha_bar, sigma2))
             alpha_bar = previous_alpha_bar
-            if step == 0:
-                previous *= self.rescale
+        return coefficients
+
+    def _multistep_coefficients(self, step_list: tp.List[int], second_order: bool) -> tp.List[tp.Tuple]:
+        """Deterministic DDIM (eta = 0) steps, which are also the first order DPM-Solver++ steps, and the
+        second order multistep DPM-Solver++(2M) correction reusing the clean sample estimate of the previous step.
+        The last step goes to alpha_bar = 1 and returns the clean sample estimate."""
+        alpha_bars = [self._alpha_bars[step].item() for step in step_list[:-1]] + [1.]
+        lambdas = [0.5 * math.log(ab / (1 - ab)) if ab < 1 else math.inf for ab in alpha_bars]
+        coefficients = []
+        for idx, step in enumerate(step_list[:-1]):
+            alpha, sigma = alpha_bars[idx] ** 0.5, (1 - alpha_bars[idx]) ** 0.5
+            alpha_next, sigma_next = alpha_bars[idx + 1] ** 0.5, (1 - alpha_bars[idx + 1]) ** 0.5
+            coef_x = sigma_next / sigma
+            coef_denoised = alpha_next - alpha * sigma_next / sigma
+            weight_prev = 0.
+            is_last = idx == len(step_list) - 2
+            if second_order and idx > 0 and not is_last:
+                h = lambdas[idx + 1] - lambdas[idx]
+                h_prev = lambdas[idx] - lambdas[idx - 1]
+                weight_prev = h / (2 * h_prev)
+            coefficients.append((step, alpha, sigma, coef_x, coef_denoised, weight_prev))
+        return coefficients
+
+    def iter_subsampled(self, model: torch.nn.Module, initial: torch.Tensor, step_list: tp.Optional[list] = None,
+                        condition: tp.Optional[torch.Tensor] = None,
+                        sampler: str = 'ddpm') -> tp.Iterator[torch.Tensor]:
+        """Reverse process that only goes through Markov chain states in step_list, yielding the current
+        state (in the diffusion space) after each denoising step. This lets several processes be run
+        in lockstep, see `MultiBandDiffusion`.
+
+        Args:
+            sampler (str): One of `SAMPLERS`: 'ddpm' for the ancestral sampling, 'ddim' for the deterministic
+                DDIM sampling and 'dpmpp_2m' for the second order multistep DPM-Solver++, the latter two being
+                designed for few (4 to 8) steps.
+        """
+        if step_list is None:
+            step_list = self.get_step_list()
+        coefficients = self.sampling_coefficients(step_list, sampler)
+        current = initial * self.noise_scale
+        if sampler == 'ddpm':
+            for step, alpha, alpha_bar, sigma2 in coefficients:
+                with torch.no_grad():
+                    estimate = model(current, step, condition=condition).sample * self.noise_scale
+                previous = (current - (1 - alpha) / (1 - alpha_bar) ** 0.5 * estimate) / alpha ** 0.5
+                if sigma2 > 0:
+                    previous += sigma2**0.5 * torch.randn_like(previous) * self.noise_scale
+                if self.clip:
+                    previous = previous.clamp(-self.clip, self.clip)
+                if step == 0:
+                    previous *= self.rescale
+                current = previous
+                yield current
+            return
+
+        prev_x0: tp.Optional[torch.Tensor] = None
+        for idx, (step, alpha, sigma, coef_x, coef_denoised, weight_prev) in enumerate(coefficients):
+            with torch.no_grad():
+                estimate = model(current, step, condition=condition).sample * self.noise_scale
+            x0 = (current - sigma * estimate) / alpha
+            denoised = x0
+            if weight_prev and prev_x0 is not None:
+                denoised = (1 + weight_prev) * x0 - weight_prev * prev_x0
+            current = coef_x * current + coef_denoised * denoised
+            if self.clip:
+                current = current.clamp(-self.clip, self.clip)
+            if idx == len(coefficients) - 1:
+                current = current * self.rescale
+            prev_x0 = x0
+            yield current
+
+    def generate_subsampled(self, model: torch.nn.Module, initial: torch.Tensor, step_list: tp.Optional[list] = None,
+                            condition: tp.Optional[torch.Tensor] = None, return_list: bool = False,
+                            sampler: str = 'ddpm'):
+        """Reverse process that only goes through Markov chain states in step_list, see `iter_subsampled`."""
+        current = initial * self.noise_scale
+        iterates = [current]
+        for current in self.iter_subsampled(model, initial, step_list, condition, sampler=sampler):
             if return_list:
-                iterates.append(previous.cpu())
+                iterates.append(current.cpu())
         if return_list:
             return iterates
         else:
-            return self.sample_processor.return_sample(previous)
+            return self.sample_processor.return_sample(current)
@@ -220,6 +220,7 @@ class JascoConditioningProvider(ConditioningProvider):
         chords_card (int): The cardinality of the chord vocabulary.
         sequence_length (int): The length of the sequence for padding purposes.
         melody_dim (int): The dimensionality of the melody matrix.
+        length_buckets (int): Maximum number of length buckets per conditioner, see `ConditioningProvider`.
     """
     def __init__(self, *args,
                  chords_card: int = 194,
@@ -256,7 +257,7 @@ class JascoConditioningProvider(ConditioningProvider):
         )
 
         for attribute, batch in chain(text.items(), wavs.items(), symbolic.items()):
-            output[attribute] = self.conditioners[attribute].tokenize(batch)
+            output[attribute] = self._tokenize_attribute(attribute, batch)
         return output
 
     def _collate_symbolic(self, samples: tp.List[ConditioningAttributes],
@@ -0,0 +1,177 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+"""Paged keys and values cache for the streaming self attention.
+
+By default, each streaming attention layer concatenates the new keys and values to the past ones
+at every step, allocating a new tensor of the full length each time. With a paged cache, the keys and values
+are written in fixed size blocks taken from a `KVBlockPool`, which is allocated once and shared by all
+the layers, and by all the generations using the pool (e.g. successive or concurrent requests of a server).
+Each sequence has a block table, stored in the layer streaming state, giving the pool blocks holding its steps,
+so that sequences of different lengths only hold the blocks they use. The attention reads the past keys
+and values through the block table, gathered into buffers kept by the cache and reused over the steps
+and the layers, so that no new tensor of the full length is allocated at each step.
+"""
+
+import math
+import threading
+import typing as tp
+
+import torch
+
+
+class KVBlockPool:
+    """Pool of fixed size blocks of keys and values, shared by the attention layers.
+    The storage is allocated on the first use, with the dtype, device and per step shape
+    (e.g. heads and head dimension) of the first keys, all the users of the pool must then match these.
+
+    Args:
+        num_blocks (int): Number of blocks in the pool.
+        block_size (int): Number of steps per block.
+    """
+    def __init__(self, num_blocks: int, block_size: int = 64):
+        self.num_blocks = num_blocks
+        self.block_size = block_size
+        self.keys: tp.Optional[torch.Tensor] = None
+        self.values: tp.Optional[torch.Tensor] = None
+        self._free: tp.List[int] = list(range(num_blocks))
+        self._lock = threading.Lock()
+
+    @property
+    def num_free_blocks(self) -> int:
+        return len(self._free)
+
+    def _materialize(self, like: torch.Tensor):
+        shape = (self.num_blocks, self.block_size) + tuple(like.shape[2:])
+        with self._lock:
+            if self.keys is None:
+                self.keys = torch.zeros(shape, dtype=like.dtype, device=like.device)
+                self.values = torch.zeros_like(self.keys)
+        assert self.keys.shape == shape and self.keys.dtype == like.dtype and self.keys.device == like.device, \
+            "All the users of the pool must have keys with the same shape, dtype and device."
+
+    def allocate(self, num_blocks: int) -> tp.List[int]:
+        """Return the indices of `num_blocks` free blocks, raise a RuntimeError if the pool is exhausted."""
+        with self._lock:
+            if num_blocks > len(self._free):
+                raise RuntimeError(f"KV cache pool exhausted, {num_blocks} blocks requested, "
+                                   f"{len(self._free)} available.")
+            blocks, self._free = self._free[:num_blocks], self._free[num_blocks:]
+        return blocks
+
+    def free(self, blocks: tp.Iterable[int]):
+        with self._lock:
+            self._free.extend(blocks)
+
+
+class PagedKVCache:
+    """Paged cache of the attention layers of a given module, for one generation. The blocks allocated
+    through it are returned to the pool by `close`, as the streaming states holding the block tables
+    are simply cleared at the end of the generation. See `audiocraft.modules.transformer.paged_kv_cache`.
+
+    Args:
+        pool (KVBlockPool): Pool to take the blocks from.
+    """
+    def __init__(self, pool: KVBlockPool):
+        self.pool = pool
+        self._blocks: tp.Set[int] = set()
+        # blocks gathered for the attention, see `_gather`.
+        self._gathered_keys: tp.Optional[torch.Tensor] = None
+        self._gathered_values: tp.Optional[torch.Tensor] = None
+
+    def _allocate(self, num_blocks: int) -> tp.List[int]:
+        blocks = self.pool.allocate(num_blocks)
+        self._blocks.update(blocks)
+        return blocks
+
+    def _free(self, blocks: tp.List[int]):
+        self._blocks.difference_update(blocks)
+        self.pool.free(blocks)
+
+    def close(self):
+        """Return all the blocks still in use to the pool."""
+        self.pool.free(self._blocks)
+        self._blocks = set()
+        self._gathered_keys = None
+        self._gathered_values = None
+
+    def _gather(self, table: torch.Tensor) -> tp.Tuple[torch.Tensor, torch.Tensor]:
+        """Copy the blocks of the given table, of shape [B, N], into the gather buffers, and return them
+        as keys and values of shape [B, N * block_size, ...]. The buffers hold as many blocks as the largest
+        table seen so far, at least doubling when they grow, and are overwritten by the next call.
+        """
+        keys, values = self.pool.keys, self.pool.values
+        assert keys is not None and values is not None
+        B, N = table.shape
+        rows = B * N
+        if self._gathered_keys is None or self._gathered_keys.shape[0] < rows:
+            capacity = 0 if self._gathered_keys is None else self._gathered_keys.shape[0]
+            capacity = min(max(rows, 2 * capacity), self.pool.num_blocks)
+            self._gathered_keys = keys.new_empty((capacity,) + tuple(keys.shape[1:]))
+            self._gathered_values = values.new_empty((capacity,) + tuple(values.shape[1:]))
+        assert self._gathered_values is not None
+        flat_table = table.flatten()
+        nk = torch.index_select(keys, 0, flat_table, out=self._gathered_keys[:rows])
+        nv = torch.index_select(values, 0, flat_table, out=self._gathered_values[:rows])
+        return nk.view(B, N * keys.shape[1], *keys.shape[2:]), nv.view(B, N * values.shape[1], *values.shape[2:])
+
+    def complete(self, state: tp.Dict[str, torch.Tensor], k: torch.Tensor, v: torch.Tensor,
+                 past_context: tp.Optional[int] = None) -> tp.Tuple[torch.Tensor, torch.Tensor]:
+        """Append the new keys and values to the cache of a layer, and return all the keys and values,
+        including the new ones, as `StreamingMultiheadAttention._complete_kv` would.
+
+        Args:
+            state (dict): Streaming state of the layer, updated in place with the block table `kv_blocks`
+                of shape [B, N], the absolute position of the first cached step `kv_start`, the absolute
+                position after the last one `kv_length`, and the index of the first block `kv_first_block`.
+            k (torch.Tensor): New keys with the time as second dimension, i.e. of shape [B, T, ...].
+            v (torch.Tensor): New values, with the same shape.
+            past_context (int, optional): Number of past steps to keep, all of them if None.
+        Returns:
+            tuple of torch.Tensor: Keys and values of shape [B, L, ...] with L the number of past and new steps,
+                views of buffers reused by the next call, see `_gather`.
+        """
+        self.pool._materialize(k)
+        assert self.pool.keys is not None and self.pool.values is not None
+        B, T = k.shape[:2]
+        block_size = self.pool.block_size
+        if 'kv_blocks' in state:
+            table = state['kv_blocks']
+            start, length, first_block = [int(state[key]) for key in ['kv_start', 'kv_length', 'kv_first_block']]
+        else:
+            table = torch.empty(B, 0, dtype=torch.long)
+            start, length, first_block = 0, 0, 0
+        new_length = length + T
+        missing = math.ceil(new_length / block_size) - first_block - table.shape[1]
+        if missing > 0:
+            new_blocks = torch.tensor(self._allocate(B * missing), dtype=torch.long).view(B, missing)
+            table = torch.cat([table, new_blocks], dim=1)
+        device_table = table.to(k.device)
+
+        positions = torch.arange(length, new_length, device=k.device)
+        blocks = device_table[:, positions // block_size - first_block]  # [B, T]
+        slots = positions % block_size
+        self.pool.keys[blocks, slots] = k
+        self.pool.values[blocks, slots] = v
+
+        # reads all the cached steps through the block table.
+        offset = start - first_block * block_size
+        nk, nv = self._gather(device_table)
+        nk = nk[:, offset: offset + new_length - start]
+        nv = nv[:, offset: offset + new_length - start]
+
+        if past_context is not None:
+            start = max(start, new_length - past_context)
+        # the blocks entirely before the first kept step are returned to the pool.
+        dropped = start // block_size - first_block
+        if dropped > 0:
+            self._free(table[:, :dropped].flatten().tolist())
+            table = table[:, dropped:]
+            first_block += dropped
+        state['kv_blocks'] = table
+        state['kv_start'] = torch.tensor(start)
+        state['kv_length'] = torch.tensor(new_length)
+        state['kv_first_block'] = torch.tensor(first_block)
+        return nk, nv
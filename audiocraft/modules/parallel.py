@@ -0,0 +1,185 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+"""Sharding of the `StreamingTransformer` over multiple processes, for inference only.
+
+Two modes are supported, both expect every process of the group to hold the full model, to receive the same
+inputs and to run the same code, e.g. the same call to `LMModel.generate` with the same seed:
+
+- tensor parallel: the attention heads and the feed forward hidden channels of each layer are split
+    over the processes, with one all reduce after the attention output projections and the second linear
+    of the feed forward. The attention streaming state (keys and values cache) only holds the local heads.
+- pipeline parallel: the layers are split in contiguous stages, one per process. The activations
+    are sent from one stage to the next, and the output of the last stage is broadcast to all the processes.
+    Each process only holds the layers, and the streaming state, of its stage.
+
+Both modes work with the gloo (CPU) and NCCL (CUDA) backends, each process using its own device.
+"""
+
+import typing as tp
+
+import torch
+from torch import distributed as dist
+from torch import nn
+import torch.nn.functional as F
+
+from .activations import CustomGLU
+from .transformer import StreamingMultiheadAttention, StreamingTransformer, StreamingTransformerLayer
+
+
+def _rank_and_world_size(group: tp.Optional[dist.ProcessGroup] = None) -> tp.Tuple[int, int]:
+    assert dist.is_initialized(), "torch.distributed must be initialized to shard the transformer."
+    return dist.get_rank(group), dist.get_world_size(group)
+
+
+def _global_rank(group: tp.Optional[dist.ProcessGroup], rank: int) -> int:
+    return rank if group is None else dist.get_global_rank(group, rank)
+
+
+def _split(size: int, rank: int, world_size: int) -> slice:
+    assert size % world_size == 0, f"{size} cannot be split over {world_size} processes."
+    chunk = size // world_size
+    return slice(rank * chunk, (rank + 1) * chunk)
+
+
+def _new_linear(weight: torch.Tensor, bias: tp.Optional[torch.Tensor]) -> nn.Linear:
+    linear = nn.Linear(weight.shape[1], weight.shape[0], bias=bias is not None,
+                       device='meta', dtype=weight.dtype)
+    linear.weight = nn.Parameter(weight.detach().clone(), requires_grad=False)
+    if bias is not None:
+        linear.bias = nn.Parameter(bias.detach().clone(), requires_grad=False)
+    return linear
+
+
+class RowParallelLinear(nn.Module):
+    """Linear layer whose input features are split over the processes of `group`.
+    The partial outputs are summed with an all reduce, before adding the bias.
+
+    Args:
+        linear (nn.Linear): Full linear layer.
+        group (dist.ProcessGroup, optional): Process group, the default one if None.
+    """
+    def __init__(self, linear: nn.Linear, group: tp.Optional[dist.ProcessGroup] = None):
+        super().__init__()
+        rank, world_size = _rank_and_world_size(group)
+        self.group = group
+        local = _split(linear.in_features, rank, world_size)
+        self.weight = nn.Parameter(linear.weight[:, local].detach().clone(), requires_grad=False)
+        self.bias: tp.Optional[nn.Parameter] = None
+        if linear.bias is not None:
+            self.bias = nn.Parameter(linear.bias.detach().clone(), requires_grad=False)
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        out = F.linear(x, self.weight)
+        dist.all_reduce(out, group=self.group)
+        if self.bias is not None:
+            out = out + self.bias
+        return out
+
+
+def _shard_attention_(attention: StreamingMultiheadAttention, group: tp.Optional[dist.ProcessGroup] = None):
+    rank, world_size = _rank_and_world_size(group)
+    assert attention.custom, "Only the custom attention can be sharded."
+    assert not attention.qk_layer_norm, "The keys and queries layer norms cannot be sharded."
+    assert attention.in_proj_quantized is None, "Quantized attention cannot be sharded."
+    head_dim = attention.embed_dim // attention.num_heads
+    num_kv = attention.num_heads // attention.kv_repeat
+    heads = _split(attention.num_heads, rank, world_size)
+    kv_heads = _split(num_kv, rank, world_size)
+    # the input projection is made of the queries, keys and values projections, each split along the heads.
+    sections = [(0, heads), (attention.num_heads, kv_heads), (attention.num_heads + num_kv, kv_heads)]
+    rows = torch.cat([torch.arange((offset + local.start) * head_dim, (offset + local.stop) * head_dim)
+                      for offset, local in sections]).to(attention.in_proj_weight.device)
+    attention.in_proj_weight = nn.Parameter(attention.in_proj_weight[rows].detach().clone(), requires_grad=False)
+    if attention.in_proj_bias is not None:
+        attention.in_proj_bias = nn.Parameter(attention.in_proj_bias[rows].detach().clone(), requires_grad=False)
+    attention.out_proj = RowParallelLinear(attention.out_proj, group)
+    attention.num_heads //= world_size
+    attention.embed_dim //= world_size
+
+
+def _shard_layer_(layer: StreamingTransformerLayer, group: tp.Optional[dist.ProcessGroup] = None):
+    rank, world_size = _rank_and_world_size(group)
+    _shard_attention_(layer.self_attn, group)
+    if layer.cross_attention is not None:
+        _shard_attention_(layer.cross_attention, group)
+    linear1 = layer.linear1
+    if isinstance(layer.activation, CustomGLU):
+        # both halves of the gated activation must be split in the same way.
+        half = linear1.out_features // 2
+        local = _split(half, rank, world_size)
+        rows = torch.cat([torch.arange(local.start, local.stop), torch.arange(half + local.start, half + local.stop)])
+    else:
+        local = _split(linear1.out_features, rank, world_size)
+        rows = torch.arange(local.start, local.stop)
+    rows = rows.to(linear1.weight.device)
+    layer.linear1 = _new_linear(linear1.weight[rows], None if linear1.bias is None else linear1.bias[rows])
+    layer.linear2 = RowParallelLinear(layer.linear2, group)
+
+
+def tensor_parallel_(transformer: StreamingTransformer, group: tp.Optional[dist.ProcessGroup] = None):
+    """Split in place the attention heads and feed forward hidden channels of each layer of the transformer
+    over the processes of `group`. The number of heads must be a multiple of the number of processes.
+    """
+    assert not transformer.training, "Sharding is only supported for inference."
+    for layer in transformer.layers:
+        _shard_layer_(layer, group)
+
+
+class PipelineStage:
+    """Stage of a pipeline parallel transformer, in charge of the communications between the stages.
+
+    Args:
+        group (dist.ProcessGroup, optional): Process group, the default one if None.
+    """
+    def __init__(self, group: tp.Optional[dist.ProcessGroup] = None):
+        self.group = group
+        self.rank, self.world_size = _rank_and_world_size(group)
+
+    def receive(self, x: torch.Tensor) -> torch.Tensor:
+        """Return the output of the previous stage, or `x` for the first stage.
+        `x` is the input of the transformer, which has the same shape on all the processes.
+        """
+        if self.rank == 0:
+            return x
+        out = torch.empty_like(x)
+        dist.recv(out, src=_global_rank(self.group, self.rank - 1), group=self.group)
+        return out
+
+    def send(self, x: torch.Tensor) -> torch.Tensor:
+        """Send the output of the stage to the next one, and return the output of the last stage."""
+        x = x.contiguous()
+        if self.rank < self.world_size - 1:
+            dist.send(x, dst=_global_rank(self.group, self.rank + 1), group=self.group)
+        dist.broadcast(x, src=_global_rank(self.group, self.world_size - 1), group=self.group)
+        return x
+
+
+def pipeline_parallel_(transformer: StreamingTransformer, group: tp.Optional[dist.ProcessGroup] = None):
+    """Split in place the layers of the transformer in contiguous stages, one per process of `group`,
+    the first processes holding one more layer if the number of layers is not a multiple of the group size.
+    """
+    assert not transformer.training, "Sharding is only supported for inference."
+    stage = PipelineStage(group)
+    num_layers = len(transformer.layers)
+    assert num_layers >= stage.world_size, "At least one layer per process is required."
+    chunk, remainder = divmod(num_layers, stage.world_size)
+    start = stage.rank * chunk + min(stage.rank, remainder)
+    end = start + chunk + (1 if stage.rank < remainder else 0)
+    transformer.layers = nn.ModuleList(transformer.layers[start:end])
+    transformer.pipeline = stage
+
+
+def shard_transformer_(transformer: StreamingTransformer, mode: str,
+                       group: tp.Optional[dist.ProcessGroup] = None):
+    """Shard in place the transformer over the processes of `group`, with `mode` being
+    either 'tensor' or 'pipeline', see the module docstring.
+    """
+    if mode == 'tensor':
+        tensor_parallel_(transformer, group)
+    elif mode == 'pipeline':
+        pipeline_parallel_(transformer, group)
+    else:
+        raise ValueError(f"Unknown sharding mode {mode}, should be 'tensor' or 'pipeline'.")
@@ -13,6 +13,7 @@ See `StreamingTransformer` for more information.
 Unlike regular PyTorch Transformer, we make the hard choice that batches are first.
 """
 
+from contextlib import contextmanager
 import typing as tp
 
 from einops import rearrange
@@ -22,8 +23,10 @@ from torch.nn import functional as F
 from torch.utils.checkpoint import checkpoint as torch_checkpoint
 from xformers import ops
 
+from .kv_cache import KVBlockPool, PagedKVCache
 from .rope import RotaryEmbedding
 from .streaming import StreamingModule
+from .weight_quantization import QuantizedLinear
 
 _efficient_attention_backend: str = 'torch'
 
@@ -109,6 +112,156 @@ def expand_repeated_kv(x: torch.Tensor, n_rep: int, memory_efficient: bool) -> t
         )
 
 
+def key_padding_to_bias(key_padding_mask: torch.Tensor, dtype: torch.dtype) -> torch.Tensor:
+    """Convert a key padding mask of shape [B, S] to an additive attention bias of shape [B, 1, 1, S].
+    Following `nn.MultiheadAttention`, a boolean mask is True for the keys to ignore,
+    while a float mask is directly added to the attention scores.
+    """
+    if key_padding_mask.dtype == torch.bool:
+        bias = torch.zeros(key_padding_mask.shape, device=key_padding_mask.device, dtype=dtype)
+        bias = bias.masked_fill(key_padding_mask, float('-inf'))
+    else:
+        bias = key_padding_mask.to(dtype)
+    return bias[:, None, None, :]
+
+
+def _materialize_attn_bias(bias: torch.Tensor, shape: tp.Sequence[int]) -> torch.Tensor:
+    # xformers kernels expect a dense [B, H, T, S] bias, with the last dim in memory aligned to 8.
+    *dims, keys = shape
+    aligned = ((keys + 7) // 8) * 8
+    out = bias.new_empty(*dims, aligned)[..., :keys]
+    out.copy_(bias.expand(*shape))
+    return out
+
+
+class LocalAttentionMask:
+    """Symmetric local attention pattern, where the query at time step t only attends to
+    the keys in [t - context, t + context]. It can be given as `attn_mask` to `StreamingMultiheadAttention`:
+    with the custom implementation, the attention is then computed over blocks of `block_size` queries,
+    each attending to a window of `block_size + 2 * context` keys, so that neither the [T, T] scores nor
+    a [T, T] mask are ever materialized. The small per block bias, and the dense mask used with
+    the regular MHA, are lazily computed for each sequence length and cached.
+
+    Args:
+        context (int): Number of time steps attended on each side of the query.
+        block_size (int): Number of queries processed together.
+    """
+    def __init__(self, context: int, block_size: int = 64):
+        assert context >= 0
+        self.context = context
+        self.block_size = block_size
+        self._cache: tp.Dict[tp.Tuple[str, int, torch.device, torch.dtype], torch.Tensor] = {}
+
+    def _cached(self, kind: str, seq_len: int, device: torch.device, dtype: torch.dtype,
+                make_fn: tp.Callable[[], torch.Tensor]) -> torch.Tensor:
+        key = (kind, seq_len, device, dtype)
+        if key not in self._cache:
+            self._cache[key] = make_fn()
+        return self._cache[key]
+
+    @staticmethod
+    def _bias_from_valid(valid: torch.Tensor, dtype: torch.dtype) -> torch.Tensor:
+        return torch.where(
+            valid,
+            torch.zeros([], device=valid.device, dtype=dtype),
+            torch.full([], float('-inf'), device=valid.device, dtype=dtype))
+
+    def to_dense(self, seq_len: int, device: torch.device, dtype: torch.dtype) -> torch.Tensor:
+        """Return the equivalent additive [T, T] attention mask."""
+        def _make():
+            positions = torch.arange(seq_len, device=device)
+            delta = positions.view(-1, 1) - positions.view(1, -1)
+            return self._bias_from_valid(delta.abs() <= self.context, dtype)
+        return self._cached('dense', seq_len, device, dtype, _make)
+
+    def _block_bias(self, seq_len: int, device: torch.device, dtype: torch.dtype) -> torch.Tensor:
+        # Bias of shape [num_blocks, block_size, window] for the queries of each block
+        # and the keys of its window, starting `context` steps before the block.
+        def _make():
+            num_blocks = -(-seq_len // self.block_size)
+            window = self.block_size + 2 * self.context
+            starts = torch.arange(num_blocks, device=device).view(-1, 1, 1) * self.block_size
+            queries = starts + torch.arange(self.block_size, device=device).view(1, -1, 1)
+            keys = starts - self.context + torch.arange(window, device=device).view(1, 1, -1)
+            # queries added by the padding attend to padded keys, so that no row is fully masked.
+            valid = ((queries - keys).abs() <= self.context) & (keys >= 0) & ((keys < seq_len) | (queries >= seq_len))
+            return self._bias_from_valid(valid, dtype)
+        return self._cached('block', seq_len, device, dtype, _make)
+
+    def attend(self, q: torch.Tensor, k: torch.Tensor, v: torch.Tensor, time_dim: int,
+               dropout: float = 0., use_sdpa: bool = False) -> torch.Tensor:
+        """Compute the local attention.
+
+        Args:
+            q, k, v (torch.Tensor): Queries, keys and values, of shape [B, H, T, D] if `time_dim == 2`,
+                or [B, T, H, D] if `time_dim == 1`.
+            time_dim (int): Time dimension of the inputs.
+            dropout (float): Dropout on the attention weights.
+            use_sdpa (bool): Use `scaled_dot_product_attention` rather than the explicit softmax.
+        Returns:
+            torch.Tensor: Attention output, with the same layout as the queries.
+        """
+        if time_dim == 1:
+            q, k, v = [x.transpose(1, 2) for x in [q, k, v]]
+        B, H, T, D = q.shape
+        assert k.shape[2] == T, "Local attention requires as many keys as queries."
+        block, context = self.block_size, self.context
+        num_blocks = -(-T // block)
+        pad = num_blocks * block - T
+        window = block + 2 * context
+        q = F.pad(q, (0, 0, 0, pad)).reshape(B, H, num_blocks, block, D)
+        k, v = [F.pad(x, (0, 0, context, pad + context)).unfold(2, window, block).transpose(-1, -2)
+                for x in [k, v]]  # [B, H, num_blocks, window, D]
+        bias = self._block_bias(T, q.device, q.dtype)
+        if use_sdpa:
+            x = torch.nn.functional.scaled_dot_product_attention(q, k, v, attn_mask=bias, dropout_p=dropout)
+        else:
+            pre_w = torch.einsum("bhnqd,bhnkd->bhnqk", q / D ** 0.5, k) + bias
+            w = torch.softmax(pre_w, dim=-1)
+            w = F.dropout(w, dropout, training=dropout > 0).to(v)
+            x = torch.einsum("bhnqk,bhnkd->bhnqd", w, v)
+        x = x.reshape(B, H, num_blocks * block, D)[:, :, :T]
+        if time_dim == 1:
+            x = x.transpose(1, 2)
+        return x
+
+
+@contextmanager
+def cross_attention_kv_cache(module: nn.Module):
+    """Context manager in which the cross attention layers of the given module cache the keys and values
+    projected from their last cross attention source, and reuse them as long as they are given the same
+    source tensor (e.g. the conditions, over all the steps of an ODE solver). Use `cross_attention_shift`
+    in the transformer layers to add a term varying across calls (e.g. a time embedding) to the source,
+    for which only the projection of the shift is computed.
+    """
+    layers = [m for m in module.modules() if isinstance(m, StreamingMultiheadAttention) and m.cross_attention]
+    for layer in layers:
+        layer._cross_kv_cache = {}
+    try:
+        yield
+    finally:
+        for layer in layers:
+            layer._cross_kv_cache = None
+
+
+@contextmanager
+def paged_kv_cache(module: nn.Module, pool: KVBlockPool):
+    """Context manager in which the streaming self attention layers of the given module store their past
+    keys and values in blocks taken from the given pool, see `audiocraft.modules.kv_cache`. All the blocks
+    used by the module are returned to the pool on exit, the streaming states must not be used after that.
+    """
+    layers = [m for m in module.modules() if isinstance(m, StreamingMultiheadAttention) and not m.cross_attention]
+    cache = PagedKVCache(pool)
+    for layer in layers:
+        layer._kv_cache = cache
+    try:
+        yield cache
+    finally:
+        for layer in layers:
+            layer._kv_cache = None
+        cache.close()
+
+
 class LayerScale(nn.Module):
     """Layer scale from [Touvron et al 2021] (https://arxiv.org/pdf/2103.17239.pdf).
     This rescales diagonally the residual outputs close to 0, with a learnt scale.
@@ -220,6 +373,12 @@ class StreamingMultiheadAttention(StreamingModule):
             ln_dim = embed_dim
             self.q_layer_norm = nn.LayerNorm(ln_dim)
             self.k_layer_norm = nn.LayerNorm(ln_dim)
+        # see `cross_attention_kv_cache`.
+        self._cross_kv_cache: tp.Optional[tp.Dict[str, torch.Tensor]] = None
+        # see `paged_kv_cache`.
+        self._kv_cache: tp.Optional[PagedKVCache] = None
+        # see `quantize_in_proj`.
+        self.in_proj_quantized: tp.Optional[QuantizedLinear] = None
 
     def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
         if not self.custom:
@@ -230,6 +389,23 @@ class StreamingMultiheadAttention(StreamingModule):
                     state_dict[prefix + "mha." + key] = state_dict.pop(prefix + key)
         super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
+    def quantize_in_proj(self, bits: int = 8, group_size: tp.Optional[int] = None):
+        """Replace the input projection weights by a weight-only quantized layer, for inference only.
+        See `audiocraft.modules.weight_quantization.quantize_linears_`.
+        """
+        assert self.custom, "Only the custom attention input projection can be quantized."
+        self.in_proj_quantized = QuantizedLinear.from_weight(self.in_proj_weight, self.in_proj_bias, bits, group_size)
+        del self.in_proj_weight
+        del self.in_proj_bias
+
+    def _in_proj(self, x: torch.Tensor, start: int = 0, end: tp.Optional[int] = None,
+                 use_bias: bool = True) -> torch.Tensor:
+        """Apply the output channels `start:end` of the input projection."""
+        if self.in_proj_quantized is not None:
+            return self.in_proj_quantized.project(x, start, end, use_bias)
+        bias = self.in_proj_bias[start:end] if (use_bias and self.in_proj_bias is not None) else None
+        return nn.functional.linear(x, self.in_proj_weight[start:end], bias)
+
     def _get_mask(self, current_steps: int, device: torch.device, dtype: torch.dtype):
         # Return a causal mask, accounting for potentially stored past keys/values
         # We actually return a bias for the attention score, as this has the same
@@ -240,12 +416,14 @@ class StreamingMultiheadAttention(StreamingModule):
             if current_steps == 1:
                 # If we only have one step, then we do not need a mask.
                 return None
-            elif 'past_keys' in self._streaming_state:
+            elif 'past_keys' in self._streaming_state or 'kv_blocks' in self._streaming_state:
                 raise RuntimeError("Not supported at the moment")
             else:
                 # Then we can safely use a lower triangular mask
                 return LowerTriangularMask()
-        if self._streaming_state:
+        if 'kv_blocks' in self._streaming_state:
+            past_steps = int(self._streaming_state['kv_length']) - int(self._streaming_state['kv_start'])
+        elif self._streaming_state:
             past_keys = self._streaming_state['past_keys']
             past_steps = past_keys.shape[time_dim]
         else:
@@ -270,6 +448,13 @@ class StreamingMultiheadAttention(StreamingModule):
             # are already available, and streaming is with respect
             # to the queries only.
             return k, v
+        if self._kv_cache is not None and self._is_streaming:
+            if time_dim == 2:
+                k, v = k.transpose(1, 2), v.transpose(1, 2)
+            nk, nv = self._kv_cache.complete(self._streaming_state, k, v, self.past_context)
+            if time_dim == 2:
+                nk, nv = nk.transpose(1, 2), nv.transpose(1, 2)
+            return nk, nv
         # Complete the key/value pair using the streaming state.
         if self._streaming_state:
             pk = self._streaming_state['past_keys']
@@ -301,6 +486,10 @@ class StreamingMultiheadAttention(StreamingModule):
         time_dim = _get_attention_time_dimension(self.memory_efficient)
         # Apply rope embeddings to query and key tensors.
         assert self.rope is not None
+        if 'kv_blocks' in self._streaming_state:
+            # position of the first new step.
+            streaming_offset = int(self._streaming_state['kv_length'])
+            return self.rope.rotate_qk(query, key, start=streaming_offset, time_dim=time_dim)
         if 'past_keys' in self._streaming_state:
             past_keys_offset = self._streaming_state['past_keys'].shape[1]
         else:
@@ -312,11 +501,31 @@ class StreamingMultiheadAttention(StreamingModule):
         streaming_offset = past_context_offset + past_keys_offset
         return self.rope.rotate_qk(query, key, start=streaming_offset, time_dim=time_dim)
 
+    def _cross_kv(self, key: torch.Tensor, value: torch.Tensor,
+                  kv_shift: tp.Optional[torch.Tensor] = None) -> tp.Tuple[torch.Tensor, torch.Tensor]:
+        """Project the cross attention keys and values, with the cache of `cross_attention_kv_cache`."""
+        dim = self.embed_dim
+        cache = self._cross_kv_cache
+        if cache is not None and cache.get('source') is key and key is value:
+            k, v = cache['keys'], cache['values']
+        else:
+            k = self._in_proj(key, dim, 2 * dim)
+            v = self._in_proj(value, 2 * dim)
+            if cache is not None and key is value:
+                cache.update(source=key, keys=k, values=v)
+        if kv_shift is not None:
+            # the projection is linear, so only the shift of the source has to be projected.
+            k = k + self._in_proj(kv_shift, dim, 2 * dim, use_bias=False)
+            v = v + self._in_proj(kv_shift, 2 * dim, use_bias=False)
+        return k, v
+
     def forward(self, query: torch.Tensor, key: torch.Tensor, value: torch.Tensor,
                 key_padding_mask=None, need_weights=False, attn_mask=None,
-                average_attn_weights=True, is_causal=False):
+                average_attn_weights=True, is_causal=False, kv_shift: tp.Optional[torch.Tensor] = None):
         assert not is_causal, ("New param added in torch 2.0.1 not supported, "
                                "use the causal args in the constructor.")
+        # `kv_shift` is added to the keys and values sources before their projection.
+        assert kv_shift is None or self.cross_attention, "Shifting the keys is only supported in cross attention."
 
         time_dim = _get_attention_time_dimension(self.memory_efficient)
         if time_dim == 2:
@@ -328,6 +537,12 @@ class StreamingMultiheadAttention(StreamingModule):
             assert self.causal or self.cross_attention, \
                 "Streaming only available for causal or cross attention"
 
+        local_attn_mask: tp.Optional[LocalAttentionMask] = None
+        if isinstance(attn_mask, LocalAttentionMask):
+            if self.custom:
+                local_attn_mask, attn_mask = attn_mask, None
+            else:
+                attn_mask = attn_mask.to_dense(query.shape[1], query.device, query.dtype)
         custom_attn_mask = attn_mask is not None
 
         if self.causal:
@@ -340,21 +555,11 @@ class StreamingMultiheadAttention(StreamingModule):
         if self.custom:
             # custom implementation
             assert need_weights is False
-            assert key_padding_mask is None
             if self.cross_attention:
                 # Different queries, keys, values, we have to spit manually the weights
                 # before applying the linear.
-                dim = self.in_proj_weight.shape[0] // 3
-                if self.in_proj_bias is None:
-                    bias_q, bias_k, bias_v = None, None, None
-                else:
-                    bias_q = self.in_proj_bias[:dim]
-                    bias_k = self.in_proj_bias[dim: 2 * dim]
-                    bias_v = self.in_proj_bias[2 * dim:]
-                q = nn.functional.linear(query, self.in_proj_weight[:dim], bias_q)
-                # todo: when streaming, we could actually save k, v and check the shape actually match.
-                k = nn.functional.linear(key, self.in_proj_weight[dim: 2 * dim], bias_k)
-                v = nn.functional.linear(value, self.in_proj_weight[2 * dim:], bias_v)
+                q = self._in_proj(query, 0, self.embed_dim)
+                k, v = self._cross_kv(key, value, kv_shift)
                 if self.qk_layer_norm is True:
                     q = self.q_layer_norm(q)
                     k = self.k_layer_norm(k)
@@ -364,7 +569,7 @@ class StreamingMultiheadAttention(StreamingModule):
                     # profiling breaks that propertysomehow.
                     assert query is key, "specialized implementation"
                     assert value is key, "specialized implementation"
-                projected = nn.functional.linear(query, self.in_proj_weight, self.in_proj_bias)
+                projected = self._in_proj(query)
                 if self.kv_repeat == 1:
                     if time_dim == 2:
                         bound_layout = "b h p t d"
@@ -399,19 +604,44 @@ class StreamingMultiheadAttention(StreamingModule):
                     v = expand_repeated_kv(v, self.kv_repeat, self.memory_efficient)
             if self.attention_as_float32:
                 q, k, v = [x.float() for x in [q, k, v]]
-            if self.memory_efficient:
+            padding_bias: tp.Optional[torch.Tensor] = None
+            if key_padding_mask is not None:
+                padding_bias = key_padding_to_bias(key_padding_mask, q.dtype)
+            if local_attn_mask is not None:
+                assert padding_bias is None, "Key padding with local attention is not supported."
+                assert not self._is_streaming, "Local attention is not supported when streaming."
+                p = self.dropout if self.training else 0
+                x = local_attn_mask.attend(q, k, v, time_dim, dropout=p, use_sdpa=self.memory_efficient)
+            elif self.memory_efficient and padding_bias is not None:
+                # Only the padding bias is applied, which lets SDPA use its memory efficient kernel.
+                assert attn_mask is None, "Key padding with a custom or causal mask is not supported."
+                p = self.dropout if self.training else 0
+                if _efficient_attention_backend == 'torch':
+                    x = torch.nn.functional.scaled_dot_product_attention(
+                        q, k, v, attn_mask=padding_bias, dropout_p=p)
+                else:
+                    B, T, H, _ = q.shape
+                    attn_bias = _materialize_attn_bias(padding_bias, (B, H, T, k.shape[1]))
+                    x = ops.memory_efficient_attention(q, k, v, attn_bias, p=p)
+            elif self.memory_efficient:
                 if custom_attn_mask:
                     # When using a custom attn mask:
-                    # Move to query's device, repeat for each sample, remove align8 padding
+                    # Move to query's device, remove align8 padding, and for xformers, repeat for each sample.
+                    # SDPA broadcasts the mask over the batch and heads.
                     seq_len = query.shape[1]
                     attn_mask = attn_mask.to(q.dtype)
-                    attn_mask = attn_mask.repeat((q.shape[0], 1, 1, 1))
+                    if _efficient_attention_backend != 'torch':
+                        attn_mask = attn_mask.repeat((q.shape[0], 1, 1, 1))
                     attn_mask = attn_mask[..., :seq_len, :seq_len]
 
                 p = self.dropout if self.training else 0
                 if _efficient_attention_backend == 'torch':
-                    x = torch.nn.functional.scaled_dot_product_attention(
-                        q, k, v, is_causal=attn_mask is not None, dropout_p=p)
+                    if custom_attn_mask:
+                        x = torch.nn.functional.scaled_dot_product_attention(
+                            q, k, v, attn_mask=attn_mask, dropout_p=p)
+                    else:
+                        x = torch.nn.functional.scaled_dot_product_attention(
+                            q, k, v, is_causal=attn_mask is not None, dropout_p=p)
                 else:
                     x = ops.memory_efficient_attention(q, k, v, attn_mask, p=p)
             else:
@@ -432,6 +662,8 @@ class StreamingMultiheadAttention(StreamingModule):
                     pre_w = torch.einsum(f"{query_layout},{key_layout}-> b h t k", q, k)
                 if attn_mask is not None:
                     pre_w = pre_w + attn_mask
+                if padding_bias is not None:
+                    pre_w = pre_w + padding_bias
                 w = torch.softmax(pre_w, dim=-1)
                 w = F.dropout(w, self.dropout, training=self.training).to(v)
                 # Key and value have the same format.
@@ -440,6 +672,8 @@ class StreamingMultiheadAttention(StreamingModule):
             x = rearrange(x, f"{layout} -> b t (h d)", h=self.num_heads)
             x = self.out_proj(x)
         else:
+            if kv_shift is not None:
+                key, value = key + kv_shift, value + kv_shift
             key, value = self._complete_kv(key, value)
             if self.attention_as_float32:
                 query, key, value = [x.float() for x in [query, key, value]]
@@ -539,17 +773,21 @@ class StreamingTransformerLayer(nn.TransformerEncoderLayer):
         self.norm1 = create_norm_fn(norm, d_model, **factory_kwargs)  # type: ignore
         self.norm2 = create_norm_fn(norm, d_model, **factory_kwargs)  # type: ignore
 
-    def _cross_attention_block(self, src: torch.Tensor,
-                               cross_attention_src: torch.Tensor) -> torch.Tensor:
+    def _cross_attention_block(self, src: torch.Tensor, cross_attention_src: torch.Tensor,
+                               cross_attention_mask: tp.Optional[torch.Tensor] = None,
+                               cross_attention_shift: tp.Optional[torch.Tensor] = None) -> torch.Tensor:
         assert self.cross_attention is not None
-        # queries are from src, keys and values from cross_attention_src.
+        # queries are from src, keys and values from cross_attention_src (+ cross_attention_shift).
         x = self.cross_attention(
-            src, cross_attention_src, cross_attention_src, need_weights=False)[0]
+            src, cross_attention_src, cross_attention_src,
+            key_padding_mask=cross_attention_mask, need_weights=False, kv_shift=cross_attention_shift)[0]
         return self.dropout_cross(x)  # type: ignore
 
     def forward(self, src: torch.Tensor, src_mask: tp.Optional[torch.Tensor] = None,  # type: ignore
                 src_key_padding_mask: tp.Optional[torch.Tensor] = None,
-                cross_attention_src: tp.Optional[torch.Tensor] = None):
+                cross_attention_src: tp.Optional[torch.Tensor] = None,
+                cross_attention_mask: tp.Optional[torch.Tensor] = None,
+                cross_attention_shift: tp.Optional[torch.Tensor] = None):
         if self.cross_attention is None:
             assert cross_attention_src is None
         else:
@@ -561,7 +799,7 @@ class StreamingTransformerLayer(nn.TransformerEncoderLayer):
             if cross_attention_src is not None:
                 x = x + self.layer_scale_cross(
                     self._cross_attention_block(
-                        self.norm_cross(x), cross_attention_src))
+                        self.norm_cross(x), cross_attention_src, cross_attention_mask, cross_attention_shift))
             x = x + self.layer_scale_2(self._ff_block(self.norm2(x)))
         else:
             x = self.norm1(x + self.layer_scale_1(
@@ -569,7 +807,8 @@ class StreamingTransformerLayer(nn.TransformerEncoderLayer):
             if cross_attention_src is not None:
                 x = self.norm_cross(
                     x + self.layer_scale_cross(
-                        self._cross_attention_block(src, cross_attention_src)))
+                        self._cross_attention_block(
+                            src, cross_attention_src, cross_attention_mask, cross_attention_shift)))
             x = self.norm2(x + self.layer_scale_2(self._ff_block(x)))
         return x
 
@@ -658,6 +897,8 @@ class StreamingTransformer(StreamingModule):
                 # see audiocraft/optim/fsdp.py, magic signal to indicate this requires fixing the
                 # backward hook inside of FSDP...
                 layer._magma_checkpointed = True  # type: ignore
+        # see `audiocraft.modules.parallel.pipeline_parallel_`.
+        self.pipeline: tp.Optional[tp.Any] = None
 
     def _apply_layer(self, layer, *args, **kwargs):
         method = self.checkpointing
@@ -704,8 +945,12 @@ class StreamingTransformer(StreamingModule):
             pos_emb = create_sin_embedding(positions, C, max_period=self.max_period, dtype=x.dtype)
             x = x + self.positional_scale * pos_emb
 
+        if self.pipeline is not None:
+            x = self.pipeline.receive(x)
         for layer in self.layers:
             x = self._apply_layer(layer, x, *args, **kwargs)
+        if self.pipeline is not None:
+            x = self.pipeline.send(x)
 
         if self._is_streaming:
             self._streaming_state['offsets'] = offsets + T
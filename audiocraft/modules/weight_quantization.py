@@ -0,0 +1,175 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+"""Weight-only quantization of linear layers and embeddings, for inference on CPU.
+
+The weights are quantized symmetrically to int8 or int4, with a scale per output channel
+(or per group of `group_size` input features), which does not require any calibration data.
+The activations are kept in floating point. int4 weights are packed by pairs in uint8 tensors.
+"""
+
+import typing as tp
+
+import torch
+from torch import nn
+import torch.nn.functional as F
+
+
+SUPPORTED_BITS = (8, 4)
+
+
+def _int8_mm_available() -> bool:
+    # `_weight_int8pack_mm` provides an int8 weight-only matmul on CPU, available from torch 2.3.
+    return hasattr(torch.ops.aten, '_weight_int8pack_mm')
+
+
+def quantize_weight(weight: torch.Tensor, bits: int = 8,
+                    group_size: tp.Optional[int] = None) -> tp.Tuple[torch.Tensor, torch.Tensor]:
+    """Symmetric per-channel (or per-group) quantization of a weight matrix.
+
+    Args:
+        weight (torch.Tensor): Weight of shape [N, K], with N the output channels.
+        bits (int): Number of bits, 8 or 4.
+        group_size (int, optional): Number of input features sharing a scale. Per output channel if None.
+    Returns:
+        tuple of torch.Tensor: The quantized weight, int8 of shape [N, K] for 8 bits, uint8 of shape [N, K // 2]
+            for 4 bits, and the float32 scales of shape [N, K // group_size].
+    """
+    assert bits in SUPPORTED_BITS, f"Unsupported number of bits {bits}."
+    assert weight.dim() == 2
+    out_features, in_features = weight.shape
+    group_size = group_size or in_features
+    assert in_features % group_size == 0, "The number of input features must be a multiple of the group size."
+    qmax = 2 ** (bits - 1) - 1
+    grouped = weight.detach().float().view(out_features, in_features // group_size, group_size)
+    scales = grouped.abs().amax(dim=-1, keepdim=True).clamp(min=1e-8) / qmax
+    qweight = (grouped / scales).round().clamp(-qmax - 1, qmax).to(torch.int8).view(out_features, in_features)
+    if bits == 4:
+        assert in_features % 2 == 0
+        unsigned = (qweight + 8).to(torch.uint8)
+        qweight = unsigned[:, ::2] | (unsigned[:, 1::2] << 4)
+    return qweight, scales.squeeze(-1)
+
+
+def dequantize_weight(qweight: torch.Tensor, scales: torch.Tensor, bits: int = 8,
+                      dtype: torch.dtype = torch.float32) -> torch.Tensor:
+    """Inverse of `quantize_weight`, returns the weight of shape [N, K] in the given dtype."""
+    if bits == 4:
+        low = (qweight & 0xF).to(torch.int8) - 8
+        high = (qweight >> 4).to(torch.int8) - 8
+        qweight = torch.stack([low, high], dim=-1).flatten(1)
+    out_features, in_features = qweight.shape
+    grouped = qweight.view(out_features, scales.shape[1], -1).to(dtype)
+    return (grouped * scales.to(dtype)[..., None]).view(out_features, in_features)
+
+
+class QuantizedLinear(nn.Module):
+    """Linear layer with weight-only quantization, see `quantize_weight`.
+    The quantized weight and scales are stored as buffers, and are dequantized on the fly,
+    unless an int8 weight-only matmul kernel is available for the input.
+
+    Args:
+        qweight (torch.Tensor): Quantized weight.
+        scales (torch.Tensor): Scales of the quantized weight.
+        bias (torch.Tensor, optional): Floating point bias.
+        bits (int): Number of bits of the quantized weight, 8 or 4.
+    """
+    def __init__(self, qweight: torch.Tensor, scales: torch.Tensor, bias: tp.Optional[torch.Tensor] = None,
+                 bits: int = 8):
+        super().__init__()
+        self.bits = bits
+        self.out_features = qweight.shape[0]
+        self.in_features = qweight.shape[1] * (8 // bits)
+        self.qweight: torch.Tensor
+        self.scales: torch.Tensor
+        self.bias: tp.Optional[torch.Tensor]
+        self.register_buffer('qweight', qweight)
+        self.register_buffer('scales', scales)
+        self.register_buffer('bias', bias)
+
+    @classmethod
+    def from_weight(cls, weight: torch.Tensor, bias: tp.Optional[torch.Tensor] = None,
+                    bits: int = 8, group_size: tp.Optional[int] = None) -> 'QuantizedLinear':
+        qweight, scales = quantize_weight(weight, bits, group_size)
+        if bias is not None:
+            bias = bias.detach().clone()
+        return cls(qweight, scales, bias, bits)
+
+    @classmethod
+    def from_linear(cls, linear: nn.Linear, bits: int = 8, group_size: tp.Optional[int] = None) -> 'QuantizedLinear':
+        return cls.from_weight(linear.weight, linear.bias, bits, group_size)
+
+    def project(self, x: torch.Tensor, start: int = 0, end: tp.Optional[int] = None,
+                use_bias: bool = True) -> torch.Tensor:
+        """Apply the output channels `start:end` of the layer to `x`, so that fused projections
+        (e.g. the attention input projection) can be applied in parts.
+        """
+        qweight, scales = self.qweight[start:end], self.scales[start:end]
+        bias = self.bias[start:end] if (use_bias and self.bias is not None) else None
+        if self.bits == 8 and scales.shape[1] == 1 and x.device.type == 'cpu' and _int8_mm_available():
+            out = torch.ops.aten._weight_int8pack_mm(
+                x.reshape(-1, self.in_features).contiguous(), qweight.contiguous(), scales[:, 0].to(x.dtype))
+            out = out.view(*x.shape[:-1], qweight.shape[0])
+            return out if bias is None else out + bias.to(x.dtype)
+        weight = dequantize_weight(qweight, scales, self.bits, x.dtype)
+        return F.linear(x, weight, None if bias is None else bias.to(x.dtype))
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        return self.project(x)
+
+    def extra_repr(self) -> str:
+        return f"in_features={self.in_features}, out_features={self.out_features}, bits={self.bits}"
+
+
+class QuantizedEmbedding(nn.Module):
+    """Embedding table quantized to int8 with a scale per row. Only the looked up rows are dequantized.
+
+    Args:
+        qweight (torch.Tensor): int8 table of shape [num_embeddings, dim].
+        scales (torch.Tensor): Scales of shape [num_embeddings, 1].
+        dtype (torch.dtype): dtype of the returned embeddings.
+    """
+    def __init__(self, qweight: torch.Tensor, scales: torch.Tensor, dtype: torch.dtype = torch.float32):
+        super().__init__()
+        self.dtype = dtype
+        self.qweight: torch.Tensor
+        self.scales: torch.Tensor
+        self.register_buffer('qweight', qweight)
+        self.register_buffer('scales', scales)
+
+    @classmethod
+    def from_embedding(cls, embedding: nn.Embedding) -> 'QuantizedEmbedding':
+        qweight, scales = quantize_weight(embedding.weight, bits=8)
+        return cls(qweight, scales, embedding.weight.dtype)
+
+    def forward(self, indices: torch.Tensor) -> torch.Tensor:
+        return self.qweight[indices].to(self.dtype) * self.scales[indices].to(self.dtype)
+
+    def extra_repr(self) -> str:
+        return f"{self.qweight.shape[0]}, {self.qweight.shape[1]}, bits=8"
+
+
+def quantize_linears_(module: nn.Module, bits: int = 8, group_size: tp.Optional[int] = None) -> int:
+    """Replace in place the `nn.Linear` submodules of `module` by `QuantizedLinear`,
+    as well as the input projections of the custom `StreamingMultiheadAttention`.
+    The linear layers of `nn.MultiheadAttention` are left untouched, as it accesses their weights directly.
+
+    Returns:
+        int: Number of quantized layers.
+    """
+    from .transformer import StreamingMultiheadAttention
+
+    count = 0
+    for parent in list(module.modules()):
+        if isinstance(parent, nn.MultiheadAttention):
+            continue
+        if isinstance(parent, StreamingMultiheadAttention) and parent.custom and parent.in_proj_quantized is None:
+            parent.quantize_in_proj(bits, group_size)
+            count += 1
+        for name, child in list(parent.named_children()):
+            if isinstance(child, nn.Linear):
+                setattr(parent, name, QuantizedLinear.from_linear(child, bits, group_size))
+                count += 1
+    return count
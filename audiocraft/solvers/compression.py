@@ -234,7 +234,8 @@ class CompressionSolver(base.StandardSolver):
         flashy.distrib.barrier()
 
     def load_from_pretrained(self, name: str) -> dict:
-        model = models.CompressionModel.get_pretrained(name)
+        # keep the weight normalization of exported checkpoints, so that the state matches the trained model.
+        model = models.CompressionModel.get_pretrained(name, fuse=False)
         if isinstance(model, models.DAC):
             raise RuntimeError("Cannot fine tune a DAC model.")
         elif isinstance(model, models.HFEncodecCompressionModel):
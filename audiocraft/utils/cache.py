@@ -77,8 +77,10 @@ class EmbeddingCache:
         self._memory_cache: dict = {}
 
     def _get_cache_path(self, path: tp.Union[Path, str]):
-        """Get cache path for the given file path."""
-        sig = sha1(str(path).encode()).hexdigest()
+        """Get cache path for the given file path. The path is normalized with `Path`, so that e.g. `./a.wav`
+        from a manifest and `a.wav` from the dataset share the same cache entry.
+        """
+        sig = sha1(str(Path(path)).encode()).hexdigest()
         return self.cache_path / sig
 
     @staticmethod
@@ -109,18 +111,47 @@ class EmbeddingCache:
                 embed = self._current_batch_cache[cache]
             else:
                 full_embed = self._compute_embed_fn(path, x, idx)
-                try:
-                    with flashy.utils.write_and_rename(cache, pid=True) as f:
-                        torch.save(full_embed.cpu(), f)
-                except Exception as exc:
-                    logger.error('Error saving embed %s (%s): %r', cache, full_embed.shape, exc)
-                else:
-                    logger.info('New embed cache saved: %s (%s)', cache, full_embed.shape)
+                if self._save_full_embed(cache, full_embed):
                     embed = self._extract_embed_fn(full_embed, x, idx)
             embeds.append(embed)
         embed = torch.stack(embeds, dim=0)
         return embed
 
+    @staticmethod
+    def _save_full_embed(cache: Path, full_embed: torch.Tensor) -> bool:
+        """Saves full pre-computed embedding to the cache, returning whether it succeeded."""
+        try:
+            with flashy.utils.write_and_rename(cache, pid=True) as f:
+                torch.save(full_embed.cpu(), f)
+        except Exception as exc:
+            logger.error('Error saving embed %s (%s): %r', cache, full_embed.shape, exc)
+            return False
+        logger.info('New embed cache saved: %s (%s)', cache, full_embed.shape)
+        return True
+
+    def is_cached(self, path: tp.Union[Path, str]) -> bool:
+        """Whether the full embedding for the given file path is already stored on disk."""
+        return self._get_cache_path(Path(path)).exists()
+
+    def precompute_embed(self, path: tp.Union[Path, str], x: tp.Any = None, idx: int = 0) -> bool:
+        """Compute the full embedding for the given file path and store it on disk,
+        unless it is already present in the cache. This is meant to fill the cache ahead of time
+        from offline jobs, see `scripts/precompute_chroma_stem_cache.py`.
+
+        Args:
+            path (Path or str): Path from where the embedding is computed.
+            x (any): Optional object passed to the compute function.
+            idx (int): Index of the object to consider in `x`.
+        Returns:
+            bool: True if a new embedding was computed and saved, False otherwise.
+        """
+        path = Path(path)
+        cache = self._get_cache_path(path)
+        if cache.exists():
+            return False
+        full_embed = self._compute_embed_fn(path, x, idx)
+        return self._save_full_embed(cache, full_embed)
+
     def populate_embed_cache(self, paths: tp.List[Path], x: tp.Any) -> None:
         """Populate in-memory caches for embeddings reading from the embeddings stored on disk.
         The in-memory caches consist in a cache for the full embedding and another cache for the
@@ -8,6 +8,7 @@
 Utility to export a training checkpoint to a lightweight release checkpoint.
 """
 
+import json
 from pathlib import Path
 import typing as tp
 
@@ -77,3 +78,64 @@ def export_lm(checkpoint_path: tp.Union[Path, str], out_file: tp.Union[Path, str
     Path(out_file).parent.mkdir(exist_ok=True, parents=True)
     torch.save(new_pkg, out_file)
     return out_file
+
+
+def export_snapshot(model: tp.Any, out_dir: tp.Union[Path, str]):
+    """Export a loaded MusicGen, AudioGen or MAGNeT model to a self-contained snapshot directory, to be loaded
+    with `audiocraft.models.loaders.load_snapshot` without any network access nor weights re-initialization.
+    The snapshot holds the resolved LM config and its weights in their final dtype, the compression model
+    config and its weights with the weight normalization folded, and the T5 tokenizer and weights.
+    The other pretrained conditioners (e.g. Demucs or CLAP) are still loaded from their own caches.
+
+    Args:
+        model (BaseGenModel): Model to export, as returned by `get_pretrained`. The LM dtype depends on the
+            device the model was loaded on, e.g. float16 on GPU, so it should be loaded on the target device type.
+        out_dir (Path or str): Directory of the snapshot.
+    """
+    from audiocraft.models import loaders
+    from audiocraft.modules.conditioners import T5Conditioner
+    from audiocraft.modules.weight_quantization import QuantizedEmbedding, QuantizedLinear
+
+    lm = model.lm
+    if any(isinstance(module, (QuantizedLinear, QuantizedEmbedding)) for module in lm.modules()):
+        raise ValueError("Snapshots of quantized LMs are not supported, quantize the LM once the snapshot is loaded.")
+    out_dir = Path(out_dir)
+    out_dir.mkdir(exist_ok=True, parents=True)
+    compression_model = model.compression_model
+    # the stereo wrapper is rebuilt from the LM config when loading the snapshot.
+    compression_model = getattr(compression_model, 'model', compression_model)
+    compression_pkg = loaders.load_compression_model_ckpt(model.name)
+    if 'pretrained' in compression_pkg:
+        raise ValueError("Snapshots only support compression models trained with AudioCraft.")
+    compression_model.fuse_for_inference()
+
+    torch.save({
+        'best_state': {key: value.detach().cpu() for key, value in lm.state_dict().items()},
+        'xp.cfg': OmegaConf.to_yaml(lm.cfg),
+        'version': __version__,
+        'exported': True,
+    }, out_dir / 'state_dict.bin')
+    torch.save({
+        'best_state': {key: value.detach().cpu() for key, value in compression_model.state_dict().items()},
+        'xp.cfg': compression_pkg['xp.cfg'],
+        'version': __version__,
+        'exported': True,
+        'fused': True,
+    }, out_dir / 'compression_state_dict.bin')
+    for name, conditioner in lm.condition_provider.conditioners.items():
+        if isinstance(conditioner, T5Conditioner):
+            conditioner.t5_tokenizer.save_pretrained(out_dir / 't5' / name)
+            conditioner.t5.save_pretrained(out_dir / 't5' / name, safe_serialization=True)
+
+    metadata: tp.Dict[str, tp.Any] = {
+        'model_class': model.__class__.__name__,
+        'name': model.name,
+        'version': __version__,
+    }
+    self_wav = lm.condition_provider.conditioners.get('self_wav')
+    if self_wav is not None:
+        metadata['self_wav'] = {key: getattr(self_wav, key) for key in ['match_len_on_eval', '_use_masking']
+                                if hasattr(self_wav, key)}
+    with open(out_dir / 'snapshot.json', 'w') as f:
+        json.dump(metadata, f, indent=2)
+    return out_dir
@@ -4,10 +4,19 @@
 # This source code is licensed under the license found in the
 # LICENSE file in the root directory of this source tree.
 
+from collections import defaultdict, deque
+import contextlib
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+import functools
+import json
 import logging
+import os
+from pathlib import Path
+import threading
+import time
 import typing as tp
 
-import dora
 import torch
 
 
@@ -20,6 +29,7 @@ class Profiler:
     def __init__(self, module: torch.nn.Module, enabled: bool = False):
         self.profiler: tp.Optional[tp.Any] = None
         if enabled:
+            import dora
             from xformers.profiler import profile
             output_dir = dora.get_xp().folder / 'profiler_data'
             logger.info("Profiling activated, results with be saved to %s", output_dir)
@@ -36,3 +46,212 @@ class Profiler:
     def __exit__(self, exc_type, exc_value, exc_tb):
         if self.profiler is not None:
             return self.profiler.__exit__(exc_type, exc_value, exc_tb)  # type: ignore
+
+
+@dataclass
+class Span:
+    """A timed call recorded by a `Tracer`.
+
+    Args:
+        name (str): Name of the span, e.g. `lm.step`.
+        start (float): Start time in seconds, relative to the creation of the tracer.
+        thread (int): Identifier of the thread that recorded the span.
+        args (dict): Additional information, e.g. the batch size.
+        duration (float, optional): Duration in seconds, None until known, see `Tracer.flush`.
+    """
+    name: str
+    start: float
+    thread: int
+    args: tp.Dict[str, tp.Any] = field(default_factory=dict)
+    duration: tp.Optional[float] = None
+    _events: tp.Optional[tp.Tuple[tp.Any, tp.Any]] = field(default=None, repr=False)
+
+
+SpanSink = tp.Callable[[Span], None]
+CounterSink = tp.Callable[[str, float], None]
+
+
+class Tracer:
+    """Lightweight tracer of the generation, recording spans (timed calls) and counters (e.g. generated
+    tokens). The instrumented code calls `trace_span` and `trace_count`, which only record anything
+    within `Tracer.activate`, and otherwise cost a context variable lookup.
+
+    When CUDA is in use, the duration of the spans is measured with CUDA events rather than by synchronizing
+    the device, so that tracing does not change the timings of the asynchronous GPU work. The durations are
+    then only known after `flush`, which waits for the events, while the start times are those of the host.
+    The spans whose events already completed are also flushed without waiting at the end of each
+    `traced` call, and whenever more than `max_pending` spans are waiting for their events.
+    The finished spans and counter updates are also passed to the sinks, e.g. to feed a metrics system.
+
+    Args:
+        use_cuda_events (bool): Time the spans with CUDA events if CUDA is initialized.
+        max_spans (int, optional): Maximum number of spans kept, the older ones are dropped.
+            The sinks still receive all the spans.
+        max_pending (int): Maximum number of spans waiting for their CUDA events, beyond which
+            the completed ones are flushed, and if there are still too many, all of them are.
+    """
+    def __init__(self, use_cuda_events: bool = True, max_spans: tp.Optional[int] = 100_000,
+                 max_pending: int = 10_000):
+        self.use_cuda_events = use_cuda_events
+        self.max_pending = max_pending
+        self.spans: tp.Deque[Span] = deque(maxlen=max_spans)
+        self.counters: tp.Dict[str, float] = defaultdict(float)
+        self._pending: tp.List[Span] = []
+        self._span_sinks: tp.List[SpanSink] = []
+        self._counter_sinks: tp.List[CounterSink] = []
+        self._origin = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def add_sink(self, on_span: tp.Optional[SpanSink] = None, on_count: tp.Optional[CounterSink] = None):
+        """Register functions called with each finished span, and with each counter update."""
+        if on_span is not None:
+            self._span_sinks.append(on_span)
+        if on_count is not None:
+            self._counter_sinks.append(on_count)
+
+    @contextlib.contextmanager
+    def activate(self):
+        """Context manager within which `trace_span` and `trace_count` record to this tracer."""
+        token = _current_tracer.set(self)
+        try:
+            yield self
+        finally:
+            _current_tracer.reset(token)
+
+    @contextlib.contextmanager
+    def span(self, name: str, **args):
+        """Context manager recording the enclosed code as a span."""
+        span = Span(name, time.perf_counter() - self._origin, threading.get_ident(), args)
+        start_event = None
+        if self.use_cuda_events and torch.cuda.is_initialized():
+            start_event = torch.cuda.Event(enable_timing=True)
+            start_event.record()
+        try:
+            yield span
+        finally:
+            if start_event is not None:
+                end_event = torch.cuda.Event(enable_timing=True)
+                end_event.record()
+                span._events = (start_event, end_event)
+                with self._lock:
+                    self._pending.append(span)
+                    num_pending = len(self._pending)
+                if num_pending > self.max_pending:
+                    self.flush(wait=False)
+                    if len(self._pending) > self.max_pending:
+                        self.flush()
+            else:
+                span.duration = time.perf_counter() - self._origin - span.start
+                self._finish(span)
+
+    def count(self, name: str, value: float = 1):
+        """Increment the counter with the given name."""
+        with self._lock:
+            self.counters[name] += value
+        for sink in self._counter_sinks:
+            sink(name, value)
+
+    def _finish(self, span: Span):
+        with self._lock:
+            self.spans.append(span)
+        for sink in self._span_sinks:
+            sink(span)
+
+    def flush(self, wait: bool = True):
+        """Wait for the CUDA events of the pending spans, to set their duration and pass them to the sinks.
+        Without `wait`, only the spans whose events already completed are flushed.
+        """
+        with self._lock:
+            if wait:
+                pending, self._pending = self._pending, []
+            else:
+                completed = [span._events is not None and span._events[1].query() for span in self._pending]
+                pending = [span for span, done in zip(self._pending, completed) if done]
+                self._pending = [span for span, done in zip(self._pending, completed) if not done]
+        for span in pending:
+            assert span._events is not None
+            start_event, end_event = span._events
+            end_event.synchronize()
+            span.duration = start_event.elapsed_time(end_event) / 1000
+            span._events = None
+            self._finish(span)
+
+    def reset(self):
+        """Drop all the recorded spans and counters."""
+        self.flush()
+        with self._lock:
+            self.spans.clear()
+            self.counters.clear()
+
+    def summary(self) -> tp.Dict[str, tp.Any]:
+        """Number of calls, total and mean duration in milliseconds of each span name, along with the counters."""
+        self.flush()
+        stats: tp.Dict[str, tp.Dict[str, float]] = {}
+        with self._lock:
+            for span in self.spans:
+                assert span.duration is not None
+                stat = stats.setdefault(span.name, {'calls': 0, 'total_ms': 0.})
+                stat['calls'] += 1
+                stat['total_ms'] += 1000 * span.duration
+            counters = dict(self.counters)
+        for stat in stats.values():
+            stat['mean_ms'] = stat['total_ms'] / stat['calls']
+        return {'spans': stats, 'counters': counters}
+
+    def chrome_trace(self) -> tp.Dict[str, tp.Any]:
+        """Spans in the Chrome trace event format, to be loaded in `chrome://tracing` or Perfetto."""
+        self.flush()
+        pid = os.getpid()
+        with self._lock:
+            events = [{
+                'name': span.name, 'ph': 'X', 'pid': pid, 'tid': span.thread,
+                'ts': 1e6 * span.start, 'dur': 1e6 * (span.duration or 0.), 'args': span.args,
+            } for span in self.spans]
+            counters = dict(self.counters)
+        return {'traceEvents': events, 'displayTimeUnit': 'ms', 'otherData': {'counters': counters}}
+
+    def export_chrome_trace(self, path: tp.Union[str, Path]):
+        """Save the spans as a Chrome trace JSON file, see `chrome_trace`."""
+        with open(path, 'w') as f:
+            json.dump(self.chrome_trace(), f)
+
+
+_current_tracer: 'ContextVar[tp.Optional[Tracer]]' = ContextVar('audiocraft_tracer', default=None)
+_NO_SPAN = contextlib.nullcontext()
+
+
+def trace_span(name: str, **args) -> tp.ContextManager:
+    """Record the enclosed code as a span of the active tracer if any, see `Tracer`."""
+    tracer = _current_tracer.get()
+    if tracer is None:
+        return _NO_SPAN
+    return tracer.span(name, **args)
+
+
+def trace_count(name: str, value: float = 1):
+    """Increment a counter of the active tracer if any, see `Tracer`."""
+    tracer = _current_tracer.get()
+    if tracer is not None:
+        tracer.count(name, value)
+
+
+def traced(name: str):
+    """Decorator of the methods of objects with a `tracer` attribute, e.g. `BaseGenModel`.
+    If the tracer is set, it is activated during the call, which is recorded as a span.
+    """
+    def _decorator(method):
+        @functools.wraps(method)
+        def _wrapped(self, *args, **kwargs):
+            tracer: tp.Optional[Tracer] = self.tracer
+            if tracer is None:
+                return method(self, *args, **kwargs)
+            outermost = _current_tracer.get() is not tracer
+            try:
+                with tracer.activate(), tracer.span(name):
+                    return method(self, *args, **kwargs)
+            finally:
+                if outermost:
+                    # hand over the spans already timed on the GPU, without waiting for the others.
+                    tracer.flush(wait=False)
+        return _wrapped
+    return _decorator
@@ -246,6 +246,55 @@ def collate(tensors: tp.List[torch.Tensor], dim: int = 0) -> tp.Tuple[torch.Tens
     return padded_tensors, lens
 
 
+def chunked_overlap_add(decode_fn: tp.Callable[[torch.Tensor, int], torch.Tensor], frames: torch.Tensor,
+                        chunk_frames: int, overlap_frames: int, upsampling: int,
+                        length: tp.Optional[int] = None, offload: bool = False) -> torch.Tensor:
+    """Decode a long sequence of frames by overlapping chunks, stitched back with a linear cross-fade,
+    so that the peak activation memory of `decode_fn` only depends on the chunk size.
+
+    Args:
+        decode_fn (callable): Function mapping a chunk of frames of shape [..., t] and the expected
+            number of output samples to a tensor of shape [..., C, L] with at least that many samples.
+        frames (torch.Tensor): Frames to decode, with time as the last dimension.
+        chunk_frames (int): Number of frames in each chunk.
+        overlap_frames (int): Number of frames shared by consecutive chunks, over which they are cross-faded,
+            at most half of `chunk_frames`.
+        upsampling (int): Number of output samples per frame.
+        length (int, optional): Length of the output, defaults to `upsampling` samples per frame.
+            Any difference is absorbed by the last chunk.
+        offload (bool): If True, the decoded chunks are moved to the CPU as soon as they are ready,
+            so that the device memory usage does not depend on the sequence length either.
+    Returns:
+        torch.Tensor: Decoded sequence of `length` samples.
+    """
+    # each sample is shared by at most two chunks, whose fades sum to one.
+    assert 0 <= 2 * overlap_frames <= chunk_frames, "The chunks overlap should be at most half of the chunks."
+    num_frames = frames.shape[-1]
+    if length is None:
+        length = num_frames * upsampling
+    overlap = overlap_frames * upsampling
+    out: tp.Optional[torch.Tensor] = None
+    stride = chunk_frames - overlap_frames
+    for start in range(0, max(num_frames - overlap_frames, 1), stride):
+        end = min(start + chunk_frames, num_frames)
+        offset = start * upsampling
+        chunk_length = (end - start) * upsampling if end < num_frames else length - offset
+        chunk = decode_fn(frames[..., start:end], chunk_length)[..., :chunk_length]
+        if offload:
+            chunk = chunk.cpu()
+        if out is None:
+            out = chunk.new_zeros(*chunk.shape[:-1], length)
+            fade_in = torch.linspace(0., 1., overlap + 2, device=chunk.device, dtype=chunk.dtype)[1:-1]
+        # linear cross-fade with the previous and next chunks, the two fades summing to one.
+        if start > 0 and overlap > 0:
+            chunk[..., :overlap] *= fade_in
+        if end < num_frames and overlap > 0:
+            chunk[..., -overlap:] *= fade_in.flip(0)
+        out[..., offset:offset + chunk_length] += chunk
+    assert out is not None
+    return out
+
+
 # TODO: Move to flashy?
 def copy_state(state: tp.Any, device: tp.Union[torch.device, str] = 'cpu',
                dtype: tp.Optional[torch.dtype] = None) -> tp.Any:
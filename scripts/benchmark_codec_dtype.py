@@ -0,0 +1,95 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+"""Benchmark of the reduced precision inference of the EnCodec compression models.
+
+The decoding of random tokens and the encoding of the decoded audio are timed in float32 with the weight
+normalization as in training, then with the weight normalization folded and the encoder and decoder in each
+of the given dtypes. The script reports the SNR of the decoded audio and the agreement of the tokens with
+respect to the reference:
+
+    python -m scripts.benchmark_codec_dtype --model facebook/musicgen-small --dtypes float32,float16,bfloat16 \\
+        --output codec_dtype.json
+"""
+import argparse
+import json
+import time
+import typing as tp
+
+import torch
+
+from audiocraft.models.encodec import CompressionModel
+from audiocraft.models.loaders import load_compression_model
+
+
+def snr(estimate: torch.Tensor, reference: torch.Tensor) -> float:
+    """Signal to noise ratio in dB of the estimate with respect to the reference."""
+    noise = (estimate - reference).pow(2).sum()
+    return 10 * torch.log10(reference.pow(2).sum() / noise.clamp(min=1e-12)).item()
+
+
+def _sync(device: str):
+    if device.startswith('cuda'):
+        torch.cuda.synchronize()
+
+
+@torch.no_grad()
+def timed(fn: tp.Callable[[], tp.Any], args: argparse.Namespace) -> tp.Tuple[tp.Any, float]:
+    """Return the output of `fn` and its average duration in seconds over `args.repeats` runs, after a warmup."""
+    fn()
+    _sync(args.device)
+    begin = time.perf_counter()
+    for _ in range(args.repeats):
+        out = fn()
+    _sync(args.device)
+    return out, (time.perf_counter() - begin) / args.repeats
+
+
+def run(args: argparse.Namespace) -> tp.Dict[str, tp.Any]:
+    model: CompressionModel = load_compression_model(args.model, device=args.device, fuse=False)
+    num_frames = int(args.duration * model.frame_rate)
+    codes = torch.randint(model.cardinality, (args.batch_size, model.num_codebooks, num_frames), device=args.device)
+    results: tp.Dict[str, tp.Any] = {'config': vars(args), 'runs': []}
+
+    ref_wav, decode_time = timed(lambda: model.decode(codes), args)
+    ref_codes, encode_time = timed(lambda: model.encode(ref_wav)[0], args)
+    results['reference'] = {'dtype': 'float32', 'fused': False,
+                            'decode_seconds': decode_time, 'encode_seconds': encode_time}
+    print(json.dumps(results['reference']))
+
+    for dtype_name in args.dtypes:
+        model.set_inference_dtype(getattr(torch, dtype_name), fold_norms=True)
+        wav, decode_time = timed(lambda: model.decode(codes), args)
+        # the tokens are compared to those of the float32 encoding of the same audio.
+        new_codes, encode_time = timed(lambda: model.encode(ref_wav)[0], args)
+        run_stats = {
+            'dtype': dtype_name,
+            'fused': True,
+            'decode_seconds': decode_time,
+            'encode_seconds': encode_time,
+            'wav_snr_db': snr(wav, ref_wav),
+            'tokens_agreement': (new_codes == ref_codes).float().mean().item(),
+        }
+        results['runs'].append(run_stats)
+        print(json.dumps(run_stats))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark reduced precision EnCodec inference.")
+    parser.add_argument('--model', type=str, default='facebook/musicgen-small',
+                        help="Pretrained model or checkpoint holding the compression model.")
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--batch_size', type=int, default=4)
+    parser.add_argument('--duration', type=float, default=30., help="Duration in seconds of the decoded audio.")
+    parser.add_argument('--dtypes', type=lambda x: x.split(','), default=['float32', 'float16', 'bfloat16'],
+                        help="Comma separated list of torch dtypes.")
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--output', type=str, default=None, help="Optional JSON file to write the results to.")
+    args = parser.parse_args()
+    results = run(args)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
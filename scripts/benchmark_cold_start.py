@@ -0,0 +1,68 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+"""Benchmark of the cold start of the LM loading, with and without the meta device construction
+and memory mapped checkpoint loading. Each run happens in a fresh process, so that the reported
+peak resident memory (RSS) is not shared between runs. The checkpoint is downloaded beforehand,
+and the OS page cache is not dropped, hence the timings are those of a warm disk cache:
+
+    python -m scripts.benchmark_cold_start --model facebook/musicgen-large --output cold_start.json
+"""
+import argparse
+import json
+import multiprocessing as mp
+import resource
+import time
+import typing as tp
+
+import torch
+
+
+def _load(model: str, device: str, empty_init: bool, queue: mp.Queue):
+    from audiocraft.models.loaders import load_lm_model
+
+    begin = time.perf_counter()
+    lm = load_lm_model(model, device=device, empty_init=empty_init)
+    if device.startswith('cuda'):
+        torch.cuda.synchronize()
+    elapsed = time.perf_counter() - begin
+    queue.put({
+        'empty_init': empty_init,
+        'seconds': elapsed,
+        # ru_maxrss is in kilobytes on Linux.
+        'peak_rss_gb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**20,
+        'num_params': sum(p.numel() for p in lm.parameters()),
+    })
+
+
+def run(args: argparse.Namespace) -> tp.Dict[str, tp.Any]:
+    from audiocraft.models.loaders import load_lm_model_ckpt
+    load_lm_model_ckpt(args.model, mmap=True)  # make sure the checkpoint is downloaded.
+
+    results: tp.Dict[str, tp.Any] = {'config': vars(args), 'runs': []}
+    ctx = mp.get_context('spawn')
+    for empty_init in [False, True]:
+        for _ in range(args.repeats):
+            queue = ctx.Queue()
+            process = ctx.Process(target=_load, args=(args.model, args.device, empty_init, queue))
+            process.start()
+            run_stats = queue.get()
+            process.join()
+            results['runs'].append(run_stats)
+            print(json.dumps(run_stats))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the cold start of the LM loading.")
+    parser.add_argument('--model', type=str, default='facebook/musicgen-small')
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--repeats', type=int, default=2)
+    parser.add_argument('--output', type=str, default=None, help="Optional JSON file to write the results to.")
+    args = parser.parse_args()
+    results = run(args)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,185 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+"""Benchmark of the text to audio generation of MusicGen, AudioGen, MAGNeT and JASCO, over a grid
+of batch sizes and durations. For each run, the script reports the real time factor (generation time
+over generated duration), the time to the first generation step, the throughput of the LM in frames
+and tokens per second, the peak memory, and the time spent in each stage of the generation:
+the conditioning (e.g. T5), the LM (or flow matching model for JASCO) and the decoding (e.g. EnCodec).
+
+The models are given as `family:name`, with `name` a pretrained model, or `debug` for the small
+random models used in the unit tests, which run quickly on CPU, e.g. to track regressions in CI:
+
+    python -m scripts.benchmark_generation --models musicgen:debug,audiogen:debug,magnet:debug \\
+        --batch_sizes 1,4 --durations 1,2 --output generation.json
+    python -m scripts.benchmark_generation --models musicgen:facebook/musicgen-small,\\
+        jasco:facebook/jasco-chords-drums-400M --batch_sizes 1,8 --durations 10 --output generation.json
+
+MAGNeT and JASCO generate a fixed duration, set by their training config, so the durations
+are ignored for these models. There is no debug JASCO model. On CPU, the peak memory is the peak
+resident memory of the process, which only grows from one run to the next.
+"""
+import argparse
+import json
+import resource
+import time
+import typing as tp
+
+import torch
+
+from audiocraft.models import AudioGen, JASCO, MAGNeT, MusicGen
+from audiocraft.models.genmodel import BaseGenModel
+
+
+MODELS: tp.Dict[str, tp.Any] = {
+    'musicgen': MusicGen,
+    'audiogen': AudioGen,
+    'magnet': MAGNeT,
+    'jasco': JASCO,
+}
+FIXED_DURATION = ['magnet', 'jasco']
+DESCRIPTIONS = ['80s pop track with bassy drums and synth', 'dog barking next to a busy road',
+                'acoustic folk song with a gentle guitar', 'heavy rain on a tin roof']
+
+
+def _sync(device: str):
+    if device.startswith('cuda'):
+        torch.cuda.synchronize()
+
+
+class StageTimer:
+    """Measure the time spent in the stages of the generation, by wrapping the relevant methods of a model.
+    The conditioning happens inside the LM generation, so its time is subtracted from the LM time.
+    """
+    def __init__(self, model: BaseGenModel):
+        self.device = str(model.device)
+        self.totals: tp.Dict[str, float] = {}
+        self.first_step: tp.Optional[float] = None
+        self.begin = 0.
+        provider = model.lm.condition_provider
+        self._wrap(provider, 'tokenize', 'conditioning')
+        self._wrap(provider, 'forward', 'conditioning')
+        self._wrap(model.lm, 'generate', 'lm')
+        self._wrap(model, 'generate_audio', 'decode')
+        model.set_custom_progress_callback(self._on_step)
+
+    def _wrap(self, obj: tp.Any, method: str, stage: str):
+        fn = getattr(obj, method)
+
+        def _timed(*args, **kwargs):
+            _sync(self.device)
+            begin = time.perf_counter()
+            out = fn(*args, **kwargs)
+            _sync(self.device)
+            self.totals[stage] = self.totals.get(stage, 0.) + time.perf_counter() - begin
+            return out
+        setattr(obj, method, _timed)
+
+    def _on_step(self, step: int, total: int):
+        if self.first_step is None:
+            _sync(self.device)
+            self.first_step = time.perf_counter() - self.begin
+
+    def reset(self):
+        self.totals = {}
+        self.first_step = None
+        self.begin = time.perf_counter()
+
+    def stages_ms(self) -> tp.Dict[str, float]:
+        conditioning = self.totals.get('conditioning', 0.)
+        return {
+            'conditioning': 1000 * conditioning,
+            'lm': 1000 * (self.totals.get('lm', 0.) - conditioning),
+            'decode': 1000 * self.totals.get('decode', 0.),
+        }
+
+
+def _peak_memory_gb(device: str) -> float:
+    if device.startswith('cuda'):
+        return torch.cuda.max_memory_allocated() / 2**30
+    # ru_maxrss is in kilobytes on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**20
+
+
+@torch.no_grad()
+def benchmark_model(family: str, name: str, args: argparse.Namespace) -> tp.List[tp.Dict[str, tp.Any]]:
+    if family == 'jasco' and name == 'debug':
+        raise ValueError("There is no debug JASCO model, use a pretrained one.")
+    model: BaseGenModel = MODELS[family].get_pretrained(name, device=args.device)
+    timer = StageTimer(model)
+    num_codebooks = getattr(model.lm, 'num_codebooks', None)
+    durations = [model.duration] if family in FIXED_DURATION else args.durations
+
+    runs = []
+    for duration in durations:
+        if family not in FIXED_DURATION:
+            model.set_generation_params(duration=duration)
+        for batch_size in args.batch_sizes:
+            descriptions = [DESCRIPTIONS[idx % len(DESCRIPTIONS)] for idx in range(batch_size)]
+            torch.manual_seed(args.seed)
+            model.generate(descriptions[:1], progress=True)  # warmup.
+            seconds = []
+            for _ in range(args.repeats):
+                if args.device.startswith('cuda'):
+                    torch.cuda.reset_peak_memory_stats()
+                _sync(args.device)
+                timer.reset()
+                model.generate(descriptions, progress=True)
+                _sync(args.device)
+                seconds.append(time.perf_counter() - timer.begin)
+            # the stages and time to first step are those of the last repeat.
+            elapsed = sum(seconds) / len(seconds)
+            stages = timer.stages_ms()
+            frames = batch_size * int(model.duration * model.frame_rate)
+            run_stats: tp.Dict[str, tp.Any] = {
+                'model': f'{family}:{name}',
+                'batch_size': batch_size,
+                'duration': model.duration,
+                'seconds': elapsed,
+                'rtf': elapsed / model.duration,
+                'ttft_ms': None if timer.first_step is None else 1000 * timer.first_step,
+                'frames_per_second': 1000 * frames / stages['lm'],
+                'tokens_per_second': None if num_codebooks is None else 1000 * frames * num_codebooks / stages['lm'],
+                'stages_ms': stages,
+                'peak_memory_gb': _peak_memory_gb(args.device),
+            }
+            print(json.dumps(run_stats))
+            runs.append(run_stats)
+    return runs
+
+
+def run(args: argparse.Namespace) -> tp.Dict[str, tp.Any]:
+    results: tp.Dict[str, tp.Any] = {
+        'config': vars(args),
+        'torch': torch.__version__,
+        'device_name': torch.cuda.get_device_name() if args.device.startswith('cuda') else 'cpu',
+        'runs': [],
+    }
+    for spec in args.models:
+        family, name = spec.split(':', 1)
+        if family not in MODELS:
+            raise ValueError(f"Unknown model family {family}, should be one of {list(MODELS)}.")
+        results['runs'] += benchmark_model(family, name, args)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the generation of the audio generative models.")
+    parser.add_argument('--models', type=lambda x: x.split(','), default=['musicgen:debug'],
+                        help="Comma separated list of family:name, e.g. musicgen:facebook/musicgen-small. "
+                             f"The families are {', '.join(MODELS)}.")
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--batch_sizes', type=lambda x: [int(b) for b in x.split(',')], default=[1, 4],
+                        help="Comma separated list of batch sizes.")
+    parser.add_argument('--durations', type=lambda x: [float(d) for d in x.split(',')], default=[1., 2.],
+                        help="Comma separated list of durations in seconds.")
+    parser.add_argument('--repeats', type=int, default=2)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', type=str, default=None, help="Optional JSON file to write the results to.")
+    args = parser.parse_args()
+    results = run(args)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,97 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+"""Benchmark of the import time of the audiocraft package and of its most used entry points.
+Each import runs in a fresh interpreter with `-X importtime`, the script reports the wall clock
+time of the import, the cumulative import time of the imported module and the slowest third party
+packages it pulled in. With `--max_seconds`, it exits with an error if any import is slower, so that
+it can be used as a regression check:
+
+    python -m scripts.benchmark_import_time --output import_time.json
+"""
+import argparse
+import json
+import subprocess
+import sys
+import time
+import typing as tp
+
+
+DEFAULT_MODULES = [
+    'audiocraft',
+    'audiocraft.data.audio',
+    'audiocraft.models.encodec',
+    'audiocraft.models.musicgen',
+    'audiocraft.models.multibanddiffusion',
+]
+
+
+def parse_importtime(stderr: str, module: str) -> tp.Dict[str, float]:
+    """Return the cumulative import time in seconds of `module` and of each of the modules imported
+    because of it, from the `-X importtime` output. The modules imported at the interpreter startup are skipped.
+    """
+    times: tp.Dict[str, float] = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = int(cumulative) / 1e6
+        # a module is printed once all of its own imports are done, with no indentation for the top level ones.
+        if not name.startswith('  '):
+            if name.strip() == module:
+                return times
+            times = {}
+    return times
+
+
+def time_import(module: str, top: int) -> tp.Dict[str, tp.Any]:
+    begin = time.perf_counter()
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                          capture_output=True, text=True, check=True)
+    wall_time = time.perf_counter() - begin
+    times = parse_importtime(proc.stderr, module)
+    # only keep the top level third party packages, as their submodules are included in the cumulative time.
+    stdlib = getattr(sys, 'stdlib_module_names', set())  # only available from Python 3.10.
+    third_party = {name: seconds for name, seconds in times.items()
+                   if '.' not in name and name != 'audiocraft' and name not in stdlib}
+    slowest = sorted(third_party.items(), key=lambda x: x[1], reverse=True)[:top]
+    return {
+        'module': module,
+        'wall_seconds': wall_time,
+        'import_seconds': times.get(module, 0.),
+        'num_modules': len(times),
+        'slowest_dependencies': dict(slowest),
+    }
+
+
+def run(args: argparse.Namespace) -> tp.Dict[str, tp.Any]:
+    results: tp.Dict[str, tp.Any] = {'config': vars(args), 'runs': []}
+    for module in args.modules:
+        # keep the fastest of the repeats, the first one may be slowed down by the disk cache.
+        runs = [time_import(module, args.top) for _ in range(args.repeats)]
+        run_stats = min(runs, key=lambda x: x['import_seconds'])
+        results['runs'].append(run_stats)
+        print(json.dumps(run_stats))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the import time of audiocraft.")
+    parser.add_argument('--modules', type=lambda x: x.split(','), default=DEFAULT_MODULES,
+                        help="Comma separated list of modules to import.")
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--top', type=int, default=5, help="Number of slowest dependencies to report.")
+    parser.add_argument('--max_seconds', type=float, default=None,
+                        help="If given, fail when the import of any of the modules is slower.")
+    parser.add_argument('--output', type=str, default=None, help="Optional JSON file to write the results to.")
+    args = parser.parse_args()
+    results = run(args)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.max_seconds is not None:
+        slow = [r['module'] for r in results['runs'] if r['import_seconds'] > args.max_seconds]
+        if slow:
+            sys.exit(f"Import slower than {args.max_seconds}s for: {', '.join(slow)}")
@@ -0,0 +1,115 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+"""Benchmark of the ODE solvers of JASCO flow matching inference, quality versus number of function evaluations.
+
+Each solver is run from the same initial noise as a reference adaptive dopri5 solve, and the script reports
+the latency, the number of function evaluations (NFE, i.e. transformer passes), the time per NFE,
+and the SNR of the generated latents and waveforms with respect to the reference:
+
+    python -m scripts.benchmark_jasco_solvers --solvers euler,heun,ab2,rk4 --nfe 8,16,32,64 \\
+        --output jasco_solvers.json
+"""
+import argparse
+import json
+import time
+import typing as tp
+
+import torch
+
+from audiocraft.models import JASCO
+from audiocraft.models.flow_matching import FIXED_STEP_SOLVERS
+
+
+DESCRIPTIONS = [
+    "Strings, woodwind, orchestral, symphony.",
+    "Funky groove with slap bass and brass section.",
+    "Lofi hip hop beat with mellow piano.",
+    "Energetic rock with distorted guitars.",
+]
+CHORDS = [('C', 0.0), ('D', 2.0), ('F', 4.0), ('Ab', 6.0), ('Bb', 7.0), ('C', 8.0)]
+
+
+def snr(estimate: torch.Tensor, reference: torch.Tensor) -> float:
+    """Signal to noise ratio in dB of the estimate with respect to the reference."""
+    noise = (estimate - reference).pow(2).sum()
+    return 10 * torch.log10(reference.pow(2).sum() / noise.clamp(min=1e-12)).item()
+
+
+def _sync(device: str):
+    if device.startswith('cuda'):
+        torch.cuda.synchronize()
+
+
+@torch.no_grad()
+def generate(model: JASCO, args: argparse.Namespace,
+             **generation_params: tp.Any) -> tp.Tuple[torch.Tensor, torch.Tensor, float, int]:
+    num_evals = 0
+
+    def _callback(evals: int, total_evals: int):
+        nonlocal num_evals
+        num_evals = evals
+
+    model.set_generation_params(cfg_coef_all=args.cfg_coef_all, cfg_coef_txt=args.cfg_coef_txt,
+                                **generation_params)
+    model.set_custom_progress_callback(_callback)
+    torch.manual_seed(args.seed)
+    _sync(args.device)
+    begin = time.perf_counter()
+    wav, latents = model.generate_music(descriptions=DESCRIPTIONS[:args.batch_size], chords=CHORDS,
+                                        progress=True, return_latents=True)
+    _sync(args.device)
+    return wav, latents, time.perf_counter() - begin, num_evals
+
+
+def run(args: argparse.Namespace) -> tp.Dict[str, tp.Any]:
+    model = JASCO.get_pretrained(args.model, device=args.device, chords_mapping_path=args.chords_mapping_path)
+    results: tp.Dict[str, tp.Any] = {'config': vars(args), 'runs': []}
+
+    ref_wav, ref_latents, elapsed, num_evals = generate(model, args, ode_solver='dopri5')
+    reference = {'ode_solver': 'dopri5', 'nfe': num_evals, 'seconds': elapsed,
+                 'ms_per_nfe': 1000 * elapsed / num_evals}
+    results['reference'] = reference
+    print(json.dumps(reference))
+
+    for solver in args.solvers:
+        for nfe in args.nfe:
+            if nfe < FIXED_STEP_SOLVERS[solver]:
+                continue
+            # warmup run, so that the timings do not include the kernels compilation.
+            generate(model, args, ode_solver=solver, nfe=FIXED_STEP_SOLVERS[solver])
+            wav, latents, elapsed, num_evals = generate(model, args, ode_solver=solver, nfe=nfe)
+            run_stats = {
+                'ode_solver': solver,
+                'nfe': num_evals,
+                'seconds': elapsed,
+                'ms_per_nfe': 1000 * elapsed / num_evals,
+                'latents_snr_db': snr(latents, ref_latents),
+                'wav_snr_db': snr(wav, ref_wav),
+            }
+            results['runs'].append(run_stats)
+            print(json.dumps(run_stats))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark fixed-step ODE solvers for JASCO.")
+    parser.add_argument('--model', type=str, default='facebook/jasco-chords-drums-400M')
+    parser.add_argument('--chords_mapping_path', type=str, default='assets/chord_to_index_mapping.pkl')
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--batch_size', type=int, default=2, choices=range(1, len(DESCRIPTIONS) + 1))
+    parser.add_argument('--cfg_coef_all', type=float, default=5.0)
+    parser.add_argument('--cfg_coef_txt', type=float, default=0.0)
+    parser.add_argument('--solvers', type=lambda x: x.split(','), default=['euler', 'heun', 'ab2', 'rk4'],
+                        help=f"Comma separated list of solvers among {list(FIXED_STEP_SOLVERS)}.")
+    parser.add_argument('--nfe', type=lambda x: [int(n) for n in x.split(',')], default=[8, 16, 32, 64],
+                        help="Comma separated list of function evaluation budgets.")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', type=str, default=None, help="Optional JSON file to write the results to.")
+    args = parser.parse_args()
+    results = run(args)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,117 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+"""Benchmark of the length bucketing of the `ConditioningProvider` on heterogeneous text batches.
+
+Batches of descriptions with long-tail word counts are encoded with T5, with and without length buckets,
+and the script reports the latency, the peak memory (on CUDA) and the number of T5 tokens computed,
+padding included, which is a proxy for the encoder FLOPs:
+
+    python -m scripts.benchmark_length_buckets --device cuda --batch_size 64 --buckets 1,2,4,8 \\
+        --output bucketing.json
+"""
+import argparse
+import json
+import random
+import time
+import typing as tp
+
+import torch
+
+from audiocraft.modules.conditioners import (
+    ConditioningAttributes, ConditioningProvider, LengthBuckets, T5Conditioner)
+
+
+WORDS = ("rock pop jazz ambient guitar piano drums bass synth vocals upbeat mellow energetic dark "
+         "cinematic orchestral strings lofi chill epic groovy acoustic electric reverb solo melody").split()
+
+
+def make_descriptions(batch_size: int, max_words: int, rng: random.Random) -> tp.List[tp.Optional[str]]:
+    """Long-tail distribution of description lengths, with a few empty descriptions as for CFG."""
+    descriptions: tp.List[tp.Optional[str]] = []
+    for _ in range(batch_size):
+        if rng.random() < 0.1:
+            descriptions.append(None)
+            continue
+        num_words = min(max_words, 1 + int(rng.expovariate(1 / 8)))
+        descriptions.append(" ".join(rng.choice(WORDS) for _ in range(num_words)))
+    return descriptions
+
+
+def count_tokens(tokenized: tp.Any) -> tp.Tuple[int, int]:
+    """Return the number of computed and of non padding T5 tokens."""
+    if isinstance(tokenized, LengthBuckets):
+        counts = [count_tokens(inputs) for inputs in tokenized.inputs]
+        return sum(c for c, _ in counts), sum(u for _, u in counts)
+    mask = tokenized['attention_mask']
+    return mask.numel(), int(mask.sum().item())
+
+
+def _sync(device: str):
+    if device.startswith('cuda'):
+        torch.cuda.synchronize()
+
+
+@torch.no_grad()
+def run(args: argparse.Namespace) -> tp.Dict[str, tp.Any]:
+    conditioner = T5Conditioner(args.t5, output_dim=args.output_dim, finetune=False, device=args.device)
+    provider = ConditioningProvider({'description': conditioner}, device=args.device).to(args.device)
+    provider.eval()
+    rng = random.Random(args.seed)
+    batches = [
+        [ConditioningAttributes(text={'description': desc})
+         for desc in make_descriptions(args.batch_size, args.max_words, rng)]
+        for _ in range(args.num_batches)]
+
+    results: tp.Dict[str, tp.Any] = {'config': vars(args), 'runs': []}
+    for num_buckets in args.buckets:
+        provider.length_buckets = num_buckets
+        for attributes in batches[:args.warmup]:
+            provider(provider.tokenize(attributes))
+        if args.device.startswith('cuda'):
+            torch.cuda.reset_peak_memory_stats()
+        computed, useful, elapsed = 0, 0, 0.
+        for attributes in batches:
+            _sync(args.device)
+            begin = time.perf_counter()
+            tokenized = provider.tokenize(attributes)
+            provider(tokenized)
+            _sync(args.device)
+            elapsed += time.perf_counter() - begin
+            c, u = count_tokens(tokenized['description'])
+            computed += c
+            useful += u
+        run_stats = {
+            'length_buckets': num_buckets,
+            'ms_per_batch': 1000 * elapsed / len(batches),
+            'computed_tokens': computed,
+            'useful_tokens': useful,
+            'padding_ratio': 1 - useful / computed,
+        }
+        if args.device.startswith('cuda'):
+            run_stats['peak_memory_mb'] = torch.cuda.max_memory_allocated() / 2 ** 20
+        results['runs'].append(run_stats)
+        print(json.dumps(run_stats))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark length bucketing of the conditioning provider.")
+    parser.add_argument('--t5', type=str, default='t5-base', choices=T5Conditioner.MODELS)
+    parser.add_argument('--output_dim', type=int, default=1024)
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--batch_size', type=int, default=64)
+    parser.add_argument('--max_words', type=int, default=128)
+    parser.add_argument('--num_batches', type=int, default=20)
+    parser.add_argument('--warmup', type=int, default=2)
+    parser.add_argument('--buckets', type=lambda x: [int(b) for b in x.split(',')], default=[1, 2, 4, 8],
+                        help="Comma separated list of `length_buckets` values to benchmark, 1 disables bucketing.")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', type=str, default=None, help="Optional JSON file to write the results to.")
+    args = parser.parse_args()
+    results = run(args)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,98 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+"""Benchmark of the weight-only quantized MusicGen LM on CPU.
+
+The tokens are first generated greedily with the float32 LM. For each quantization setting, the script reports
+the agreement of the teacher forced greedy predictions with those of the float32 LM on these tokens,
+the real time factor of the generation (generation time over duration of the generated audio,
+decoding included), and the size of the LM weights:
+
+    python -m scripts.benchmark_lm_quantization --model facebook/musicgen-small --output lm_quantization.json
+"""
+import argparse
+import itertools
+import json
+import time
+import typing as tp
+
+import torch
+
+from audiocraft.models import MusicGen
+from audiocraft.models.lm import LMModel
+from audiocraft.models.loaders import load_lm_model
+
+
+DESCRIPTIONS = [
+    'lofi hip hop beat with a mellow piano',
+    'energetic rock song with distorted guitars',
+    'ambient pad with slow evolving textures',
+    'upbeat funk with slap bass and brass section',
+]
+
+SETTINGS = {
+    'float32': dict(weight_bits=None),
+    'int8': dict(weight_bits=8),
+    'int4': dict(weight_bits=4, group_size=64),
+}
+
+
+def lm_size_mb(lm: LMModel) -> float:
+    tensors = itertools.chain(lm.parameters(), lm.buffers())
+    return sum(t.numel() * t.element_size() for t in tensors) / 2**20
+
+
+@torch.no_grad()
+def greedy_predictions(model: MusicGen, tokens: torch.Tensor) -> tp.Tuple[torch.Tensor, torch.Tensor]:
+    attributes, _ = model._prepare_tokens_and_attributes(DESCRIPTIONS[:len(tokens)], None)
+    output = model.lm.compute_predictions(tokens, attributes)
+    return output.logits.argmax(dim=-1), output.mask
+
+
+def run(args: argparse.Namespace) -> tp.Dict[str, tp.Any]:
+    torch.set_num_threads(args.threads)
+    model = MusicGen.get_pretrained(args.model, device='cpu')
+    model.set_generation_params(duration=args.duration, use_sampling=False)
+    descriptions = DESCRIPTIONS[:args.batch_size]
+    results: tp.Dict[str, tp.Any] = {'config': vars(args), 'runs': []}
+    ref_tokens: tp.Optional[torch.Tensor] = None
+    ref_predictions: tp.Optional[torch.Tensor] = None
+    for name in args.settings:
+        model.lm = load_lm_model(args.model, device='cpu', **SETTINGS[name])
+        begin = time.perf_counter()
+        _, tokens = model.generate(descriptions, return_tokens=True)
+        elapsed = time.perf_counter() - begin
+        if ref_tokens is None:
+            ref_tokens = tokens
+        predictions, mask = greedy_predictions(model, ref_tokens)
+        if ref_predictions is None:
+            ref_predictions = predictions
+        run_stats = {
+            'setting': name,
+            'lm_size_mb': lm_size_mb(model.lm),
+            'seconds': elapsed,
+            'rtf': elapsed / args.duration,
+            'tokens_agreement': (predictions == ref_predictions)[mask].float().mean().item(),
+            'generation_agreement': (tokens == ref_tokens).float().mean().item(),
+        }
+        results['runs'].append(run_stats)
+        print(json.dumps(run_stats))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the weight-only quantized MusicGen LM on CPU.")
+    parser.add_argument('--model', type=str, default='facebook/musicgen-small')
+    parser.add_argument('--settings', type=lambda x: x.split(','), default=list(SETTINGS),
+                        help="Comma separated list of settings among " + ', '.join(SETTINGS))
+    parser.add_argument('--batch_size', type=int, default=1, choices=range(1, len(DESCRIPTIONS) + 1))
+    parser.add_argument('--duration', type=float, default=5., help="Duration in seconds of the generated audio.")
+    parser.add_argument('--threads', type=int, default=torch.get_num_threads())
+    parser.add_argument('--output', type=str, default=None, help="Optional JSON file to write the results to.")
+    args = parser.parse_args()
+    results = run(args)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,79 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+"""Benchmark of the decoding steps of the LM, as done by `LMModel.generate` but without sampling,
+along with the time spent in the codebooks embeddings and output heads alone:
+
+    python -m scripts.benchmark_lm_step --model facebook/musicgen-small --batch_size 8 --output lm_step.json
+"""
+import argparse
+import json
+import time
+import typing as tp
+
+import torch
+
+from audiocraft.models.builders import get_debug_lm_model
+from audiocraft.models.lm import LMModel
+from audiocraft.models.loaders import load_lm_model
+from audiocraft.modules.conditioners import ConditioningAttributes
+
+
+def _sync(device: str):
+    if device.startswith('cuda'):
+        torch.cuda.synchronize()
+
+
+@torch.no_grad()
+def timed(fn: tp.Callable[[], tp.Any], args: argparse.Namespace) -> float:
+    """Average duration in seconds of `fn` over `args.steps` runs, after a warmup."""
+    fn()
+    _sync(args.device)
+    begin = time.perf_counter()
+    for _ in range(args.steps):
+        fn()
+    _sync(args.device)
+    return (time.perf_counter() - begin) / args.steps
+
+
+@torch.no_grad()
+def run(args: argparse.Namespace) -> tp.Dict[str, tp.Any]:
+    lm: LMModel
+    if args.model == 'debug':
+        lm = get_debug_lm_model(args.device)
+    else:
+        lm = load_lm_model(args.model, device=args.device)
+    conditions = [ConditioningAttributes(text={'description': 'some text'})] * args.batch_size
+    condition_tensors = lm.condition_provider(lm.condition_provider.tokenize(conditions))
+    codes = torch.randint(lm.card, (args.batch_size, lm.num_codebooks, 1), device=args.device)
+    out = torch.randn(args.batch_size, 1, lm.dim, device=args.device, dtype=next(lm.parameters()).dtype)
+
+    with lm.streaming():
+        # fills a context of `args.context` steps, then times single steps as during generation.
+        lm(codes.repeat(1, 1, args.context), [], condition_tensors)
+        step_time = timed(lambda: lm(codes, [], condition_tensors), args)
+    results = {
+        'config': vars(args),
+        'step_ms': 1000 * step_time,
+        'embeddings_ms': 1000 * timed(lambda: lm.emb(codes), args),
+        'heads_ms': 1000 * timed(lambda: lm.linears(out), args),
+    }
+    print(json.dumps(results))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the decoding steps of the LM.")
+    parser.add_argument('--model', type=str, default='facebook/musicgen-small', help="Pretrained LM, or 'debug'.")
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--context', type=int, default=100, help="Number of steps already in the cache.")
+    parser.add_argument('--steps', type=int, default=50)
+    parser.add_argument('--output', type=str, default=None, help="Optional JSON file to write the results to.")
+    args = parser.parse_args()
+    results = run(args)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,87 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+"""Benchmark of the MusicGen LM sharded over multiple GPUs, see `audiocraft.modules.parallel`.
+For each batch size, the script reports the generation time and the peak memory of each GPU,
+or `null` if the batch does not fit in memory. It must be launched with one process per GPU:
+
+    torchrun --nproc_per_node 2 -m scripts.benchmark_parallel_lm --model facebook/musicgen-large \\
+        --mode tensor --batch_sizes 8,16,32 --output parallel_lm.json
+
+Without `torchrun`, the LM is not sharded, which gives the single GPU reference. It also runs on CPU
+with the gloo backend, e.g. to check the setup.
+"""
+import argparse
+import json
+import os
+import time
+import typing as tp
+
+import torch
+from torch import distributed as dist
+
+from audiocraft.models import MusicGen
+
+
+def _sync(device: str):
+    if device.startswith('cuda'):
+        torch.cuda.synchronize()
+
+
+def run(args: argparse.Namespace) -> tp.Dict[str, tp.Any]:
+    world_size = int(os.environ.get('WORLD_SIZE', 1))
+    local_rank = int(os.environ.get('LOCAL_RANK', 0))
+    device = f'cuda:{local_rank}' if torch.cuda.is_available() else 'cpu'
+    if world_size > 1:
+        dist.init_process_group('nccl' if device.startswith('cuda') else 'gloo')
+    if device.startswith('cuda'):
+        torch.cuda.set_device(device)
+
+    model = MusicGen.get_pretrained(args.model, device=device)
+    model.set_generation_params(duration=args.duration)
+    if world_size > 1:
+        model.lm.shard_for_inference(args.mode)
+
+    results: tp.Dict[str, tp.Any] = {'config': vars(args), 'world_size': world_size, 'runs': []}
+    for batch_size in args.batch_sizes:
+        # all the processes must sample the same tokens.
+        torch.manual_seed(args.seed)
+        if device.startswith('cuda'):
+            torch.cuda.empty_cache()
+            torch.cuda.reset_peak_memory_stats()
+        _sync(device)
+        begin = time.perf_counter()
+        try:
+            model.generate(['80s pop track with bassy drums and synth'] * batch_size)
+        except torch.cuda.OutOfMemoryError:
+            run_stats: tp.Dict[str, tp.Any] = {'batch_size': batch_size, 'seconds': None, 'peak_memory_gb': None}
+        else:
+            _sync(device)
+            elapsed = time.perf_counter() - begin
+            peak = torch.cuda.max_memory_allocated() / 2**30 if device.startswith('cuda') else None
+            run_stats = {'batch_size': batch_size, 'seconds': elapsed, 'rtf': elapsed / args.duration,
+                         'peak_memory_gb': peak}
+        results['runs'].append(run_stats)
+        if local_rank == 0:
+            print(json.dumps(run_stats))
+    if world_size > 1:
+        dist.destroy_process_group()
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the MusicGen LM sharded over multiple GPUs.")
+    parser.add_argument('--model', type=str, default='facebook/musicgen-large')
+    parser.add_argument('--mode', type=str, default='tensor', choices=['tensor', 'pipeline'])
+    parser.add_argument('--batch_sizes', type=lambda x: [int(b) for b in x.split(',')], default=[8, 16, 32],
+                        help="Comma separated list of batch sizes.")
+    parser.add_argument('--duration', type=float, default=10., help="Duration in seconds of the generated audio.")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', type=str, default=None, help="Optional JSON file to write the results to.")
+    args = parser.parse_args()
+    results = run(args)
+    if args.output is not None and int(os.environ.get('RANK', 0)) == 0:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
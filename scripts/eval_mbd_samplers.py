@@ -0,0 +1,95 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+"""Evaluation of the MultiBandDiffusion samplers, quality versus number of denoising steps.
+
+Audio files are compressed with EnCodec 24kHz and regenerated with MultiBandDiffusion using each sampler
+and number of steps. The script reports the mel spectrogram L1 distance and the SI-SNR to the original audio,
+along with the real time factor (RTF, processing time over audio duration):
+
+    python -m scripts.eval_mbd_samplers --bw 3.0 --samplers ddpm,ddim,dpmpp_2m --steps 4,8,20 \\
+        --output mbd_samplers.json path/to/audio/dir
+"""
+import argparse
+import json
+from pathlib import Path
+import time
+import typing as tp
+
+import torch
+
+from audiocraft.data.audio import audio_read
+from audiocraft.data.audio_utils import convert_audio
+from audiocraft.losses import MelSpectrogramL1Loss, SISNR
+from audiocraft.models import MultiBandDiffusion
+from audiocraft.modules.diffusion_schedule import NoiseSchedule
+
+
+def _sync(device: str):
+    if device.startswith('cuda'):
+        torch.cuda.synchronize()
+
+
+def load_audio(paths: tp.List[Path], sample_rate: int, duration: float) -> tp.List[torch.Tensor]:
+    wavs = []
+    for path in paths:
+        wav, sr = audio_read(path, duration=duration)
+        wavs.append(convert_audio(wav, sr, sample_rate, 1))
+    return wavs
+
+
+@torch.no_grad()
+def run(args: argparse.Namespace) -> tp.Dict[str, tp.Any]:
+    mbd = MultiBandDiffusion.get_mbd_24khz(bw=args.bw, device=args.device)
+    paths = sorted(p for ext in ['wav', 'mp3', 'flac', 'ogg'] for p in Path(args.audio).rglob(f'*.{ext}'))
+    wavs = load_audio(paths[:args.num_files], mbd.sample_rate, args.duration)
+    mel = MelSpectrogramL1Loss(sample_rate=mbd.sample_rate)
+    sisnr = SISNR(sample_rate=mbd.sample_rate, segment=None)
+    results: tp.Dict[str, tp.Any] = {'config': vars(args), 'runs': []}
+    for sampler in args.samplers:
+        for num_steps in args.steps:
+            mbd.set_sampling_params(sampler=sampler, num_steps=num_steps)
+            torch.manual_seed(args.seed)
+            mel_dist, si_snr, elapsed, duration = 0., 0., 0., 0.
+            for wav in wavs:
+                wav = wav[None].to(args.device)
+                _sync(args.device)
+                begin = time.perf_counter()
+                out = mbd.regenerate(wav, sample_rate=mbd.sample_rate)
+                _sync(args.device)
+                elapsed += time.perf_counter() - begin
+                duration += wav.shape[-1] / mbd.sample_rate
+                mel_dist += mel(out, wav).item()
+                si_snr += -sisnr(out, wav).item()  # SISNR returns the opposite of the SI-SNR.
+            run_stats = {
+                'sampler': sampler,
+                'num_steps': num_steps,
+                'mel_l1': mel_dist / len(wavs),
+                'si_snr_db': si_snr / len(wavs),
+                'rtf': elapsed / duration,
+            }
+            results['runs'].append(run_stats)
+            print(json.dumps(run_stats))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Evaluate MultiBandDiffusion samplers against the step count.")
+    parser.add_argument('audio', type=str, help="Folder of audio files to compress and regenerate.")
+    parser.add_argument('--bw', type=float, default=3.0, choices=[1.5, 3.0, 6.0])
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--num_files', type=int, default=20)
+    parser.add_argument('--duration', type=float, default=10., help="Duration in seconds read from each file.")
+    parser.add_argument('--samplers', type=lambda x: x.split(','), default=list(NoiseSchedule.SAMPLERS),
+                        help=f"Comma separated list of samplers among {NoiseSchedule.SAMPLERS}.")
+    parser.add_argument('--steps', type=lambda x: [int(n) for n in x.split(',')], default=[4, 8, 20],
+                        help="Comma separated list of numbers of denoising steps.")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', type=str, default=None, help="Optional JSON file to write the results to.")
+    args = parser.parse_args()
+    results = run(args)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
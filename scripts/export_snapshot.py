@@ -0,0 +1,32 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+"""Export a pretrained model to a self-contained snapshot, loadable without network access
+with `audiocraft.models.loaders.load_snapshot`:
+
+    python -m scripts.export_snapshot --model facebook/musicgen-small --device cuda /snapshots/musicgen-small
+"""
+import argparse
+import time
+
+from audiocraft import models
+from audiocraft.models.loaders import load_snapshot
+from audiocraft.utils.export import export_snapshot
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Export a pretrained model to a snapshot.")
+    parser.add_argument('out_dir', type=str, help="Directory of the snapshot.")
+    parser.add_argument('--model', type=str, default='facebook/musicgen-small')
+    parser.add_argument('--model_class', type=str, default='MusicGen', choices=['MusicGen', 'AudioGen', 'MAGNeT'])
+    parser.add_argument('--device', type=str, default='cuda',
+                        help="Device type the snapshot is meant for, which sets the LM dtype.")
+    args = parser.parse_args()
+    model = getattr(models, args.model_class).get_pretrained(args.model, device=args.device)
+    export_snapshot(model, args.out_dir)
+    del model
+    begin = time.perf_counter()
+    load_snapshot(args.out_dir, device=args.device)
+    print(f"Exported {args.model} to {args.out_dir}, loaded back in {time.perf_counter() - begin:.1f}s.")
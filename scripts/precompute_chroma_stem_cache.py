@@ -0,0 +1,125 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+"""Offline pre-computation of the `ChromaStemConditioner` embedding cache.
+
+Running the Demucs source separation on each melody conditioned batch is by far the most expensive
+part of the conditioning for MusicGen melody. This script separates the stems and extracts the chroma
+of each full track once, and stores it with the same layout the conditioner expects for its `cache_path`.
+Tracks already present in the cache are skipped, so the job can be stopped and resumed at any time.
+The file list is split across local worker processes, and can further be split across jobs
+(e.g. with a SLURM job array using `--shard_index=$SLURM_ARRAY_TASK_ID`):
+
+    python -m scripts.precompute_chroma_stem_cache --manifest egs/example \\
+        --cache_path /path/to/chroma_cache --workers 4 --devices cuda:0,cuda:1
+
+The cache is then used at train time with `conditioners.self_wav.chroma_stem.cache_path=/path/to/chroma_cache`,
+the chroma parameters must match the ones of the conditioner config.
+"""
+import argparse
+from pathlib import Path
+import time
+import typing as tp
+
+import torch
+import torch.multiprocessing as mp
+
+from audiocraft.data.audio_dataset import load_audio_meta
+from audiocraft.environment import AudioCraftEnvironment
+
+
+def read_file_list(path: tp.Union[str, Path]) -> tp.List[str]:
+    """Read the list of audio files, either from a .txt file (one file per line)
+    or from an egs folder or manifest (data.jsonl[.gz]), so that paths match the ones of the dataset.
+    """
+    path = Path(path)
+    if path.suffix == '.txt':
+        with open(path) as f:
+            return [line.rstrip() for line in f if line.strip()]
+    if path.is_dir():
+        if (path / 'data.jsonl').exists():
+            path = path / 'data.jsonl'
+        elif (path / 'data.jsonl.gz').exists():
+            path = path / 'data.jsonl.gz'
+        else:
+            raise ValueError("Don't know where to read metadata from in the dir. "
+                             "Expecting either a data.jsonl or data.jsonl.gz file but none found.")
+    return [m.path for m in load_audio_meta(path)]
+
+
+def process_shard(args: argparse.Namespace, shard_index: int, num_shards: int, device: str):
+    """Fill the cache for all the files of the given shard."""
+    # imported here so that each spawned worker initializes its own CUDA context.
+    from audiocraft.modules.conditioners import ChromaStemConditioner
+
+    if device.startswith('cuda'):
+        torch.cuda.set_device(torch.device(device))
+        device = 'cuda'
+    conditioner = ChromaStemConditioner(
+        output_dim=-1, sample_rate=args.sample_rate, n_chroma=args.n_chroma, radix2_exp=args.radix2_exp,
+        duration=args.duration, argmax=args.argmax, cache_path=args.cache_path, memo_size=0, device=device)
+    assert conditioner.cache is not None
+    conditioner.eval()
+
+    files = read_file_list(args.manifest)[shard_index::num_shards]
+    print(f"[shard {shard_index}/{num_shards}] {len(files)} files to process on {device}")
+    begin = time.time()
+    computed, skipped, failed = 0, 0, 0
+    for idx, path in enumerate(files):
+        try:
+            if conditioner.cache.precompute_embed(path):
+                computed += 1
+            else:
+                skipped += 1
+        except Exception as exc:
+            failed += 1
+            print(f"[shard {shard_index}/{num_shards}] Error processing {path}: {exc!r}")
+        if (idx + 1) % args.log_every == 0:
+            print(f"[shard {shard_index}/{num_shards}] {idx + 1}/{len(files)} files, "
+                  f"{(time.time() - begin) / (idx + 1):.2f}s/file")
+    print(f"[shard {shard_index}/{num_shards}] done: computed={computed}, skipped={skipped}, failed={failed}")
+
+
+def _worker(worker_index: int, args: argparse.Namespace, devices: tp.List[str]):
+    num_shards = args.num_shards * args.workers
+    shard_index = args.shard_index * args.workers + worker_index
+    process_shard(args, shard_index, num_shards, devices[worker_index % len(devices)])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Pre-compute the ChromaStemConditioner cache.")
+    parser.add_argument('--manifest', type=Path, required=True,
+                        help="Files to process, either an egs folder or manifest (jsonl[.gz]), or a .txt file.")
+    parser.add_argument('--cache_path', type=Path, required=True,
+                        help="Conditioner cache path, embeddings are stored in its `wav` subfolder.")
+    parser.add_argument('--sample_rate', type=int, default=32000)
+    parser.add_argument('--n_chroma', type=int, default=12)
+    parser.add_argument('--radix2_exp', type=int, default=14)
+    parser.add_argument('--no_argmax', dest='argmax', action='store_false',
+                        help="Disable argmax quantization of the chroma (enabled by default as in chroma2music).")
+    parser.add_argument('--duration', type=float, default=30.,
+                        help="Training segment duration, only used to instantiate the conditioner.")
+    parser.add_argument('--workers', type=int, default=1, help="Number of local worker processes.")
+    parser.add_argument('--devices', type=str, default=None,
+                        help="Comma separated list of devices assigned round-robin to workers. "
+                             "Defaults to all visible GPUs, or cpu.")
+    parser.add_argument('--shard_index', type=int, default=0, help="Index of this job when sharding across jobs.")
+    parser.add_argument('--num_shards', type=int, default=1, help="Total number of jobs.")
+    parser.add_argument('--log_every', type=int, default=50)
+    args = parser.parse_args()
+    assert 0 <= args.shard_index < args.num_shards, "Invalid shard index"
+    args.cache_path = AudioCraftEnvironment.resolve_reference_path(args.cache_path)
+
+    if args.devices is not None:
+        devices = args.devices.split(',')
+    elif torch.cuda.device_count():
+        devices = [f'cuda:{idx}' for idx in range(torch.cuda.device_count())]
+    else:
+        devices = ['cpu']
+
+    if args.workers == 1:
+        _worker(0, args, devices)
+    else:
+        mp.spawn(_worker, args=(args, devices), nprocs=args.workers, join=True)
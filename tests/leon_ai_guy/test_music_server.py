@@ -0,0 +1,92 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import threading
+import time
+import typing as tp
+
+import pytest
+import torch
+
+from Leon_ai_guy.music_server import MusicGenServer, ServerBusy
+
+
+class StubMusicGen:
+    """Stand-in for MusicGen recording the batches, each generation taking `step_time` seconds per step."""
+    sample_rate = 32000
+
+    def __init__(self, step_time: float = 0.02, release: tp.Optional[threading.Event] = None):
+        self.step_time = step_time
+        self.release = release
+        self.calls: tp.List[tp.Tuple[int, tp.List[str]]] = []
+        self.duration: tp.Optional[int] = None
+        self.callback: tp.Optional[tp.Callable[[int, int], None]] = None
+
+    def set_custom_progress_callback(self, callback):
+        self.callback = callback
+
+    def set_generation_params(self, duration):
+        self.duration = duration
+
+    def generate(self, descriptions, progress=False):
+        self.calls.append((self.duration, list(descriptions)))
+        if self.release is not None:
+            self.release.wait()
+        for step in range(4):
+            time.sleep(self.step_time)
+            self.callback(step + 1, 4)
+        return torch.zeros(len(descriptions), 1, self.duration)
+
+
+def _start(model, **kwargs) -> MusicGenServer:
+    server = MusicGenServer(lambda device: model, devices=['cpu'], **kwargs)
+    server.start()
+    return server
+
+
+def test_batches_same_duration():
+    model = StubMusicGen()
+    release = threading.Event()
+    model.release = release
+    server = _start(model, max_batch_size=3, batch_wait=0.05)
+    # the first request keeps the worker busy while the next ones are queued.
+    first = server.submit('warmup', 5)
+    time.sleep(0.2)
+    requests = [server.submit(f'p{idx}', 10 if idx % 2 else 20) for idx in range(6)]
+    release.set()
+    wavs = [request.future.result(timeout=10) for request in [first] + requests]
+    assert [tuple(wav.shape) for wav in wavs] == [(1, 5)] + [(1, 10 if idx % 2 else 20) for idx in range(6)]
+    assert model.calls == [(5, ['warmup']), (20, ['p0', 'p2', 'p4']), (10, ['p1', 'p3', 'p5'])]
+    assert all(request.progress == 1. for request in requests)
+    assert server.num_outstanding == 0
+
+
+def test_server_busy():
+    release = threading.Event()
+    server = _start(StubMusicGen(release=release), max_queue_size=2)
+    requests = [server.submit('a', 5), server.submit('b', 5)]
+    with pytest.raises(ServerBusy):
+        server.submit('c', 5)
+    release.set()
+    for request in requests:
+        request.future.result(timeout=10)
+    server.submit('c', 5).future.result(timeout=10)
+
+
+def test_expired_request():
+    release = threading.Event()
+    server = _start(StubMusicGen(release=release), timeout=0.3, sweep_interval=0.05)
+    busy = server.submit('busy', 5, timeout=60)
+    time.sleep(0.2)
+    progress_calls = []
+    begin = time.monotonic()
+    # the only worker stays busy, the request must still fail when its deadline is reached.
+    with pytest.raises(TimeoutError):
+        server.generate('late', 5, on_progress=progress_calls.append, poll_interval=0.05)
+    assert time.monotonic() - begin < 2
+    assert len(progress_calls) < 100
+    release.set()
+    assert busy.future.result(timeout=10).shape == (1, 5)
@@ -7,11 +7,13 @@
 import random
 
 import numpy as np
+import pytest
 import torch
 
 from audiocraft.models import EncodecModel
 from audiocraft.modules import SEANetEncoder, SEANetDecoder
 from audiocraft.quantization import DummyQuantizer
+from audiocraft.utils.utils import chunked_overlap_add
 
 
 class TestEncodecModel:
@@ -58,3 +60,78 @@ class TestEncodecModel:
             codes, scales = model_nonorm.encode(x)
             codes, scales = model_renorm.encode(x)
             assert scales is not None
+
+    def test_chunked_overlap_add(self):
+        frames = torch.randn(2, 3, 47)
+        upsampling = 4
+
+        def decode_fn(chunk: torch.Tensor, length: int) -> torch.Tensor:
+            return chunk.repeat_interleave(upsampling, dim=-1)
+
+        ref = decode_fn(frames, frames.shape[-1] * upsampling)
+        for chunk_frames, overlap_frames in [(10, 0), (10, 3), (16, 8), (100, 4)]:
+            out = chunked_overlap_add(decode_fn, frames, chunk_frames, overlap_frames, upsampling)
+            # the cross-fades sum to one, so that a decoder without context is exactly reconstructed.
+            assert torch.allclose(out, ref, atol=1e-6)
+
+    def test_decode_chunked(self):
+        torch.manual_seed(1234)
+        # the sample rate matches the hop length of the model, i.e. 120 frames per second.
+        sample_rate = 14_400
+        model = self._create_encodec_model(sample_rate, channels=1).eval()
+        codes = torch.randn(2, 5, 110)
+        with torch.no_grad():
+            out = model.decode(codes)
+            out_chunked = model.decode_chunked(codes, chunk_duration=40 / 120, chunk_overlap=10 / 120,
+                                               offload=True)
+        assert out_chunked.shape == out.shape
+        # far from the chunk boundaries, the output is unchanged.
+        hop = 120
+        assert torch.allclose(out_chunked[..., :20 * hop], out[..., :20 * hop], atol=1e-5)
+        assert (out_chunked - out).norm() < 0.25 * out.norm()
+        # the default overlap of 0.5 seconds is reduced to half of the chunks.
+        with torch.no_grad():
+            assert model.decode_chunked(codes, chunk_duration=40 / 120).shape == out.shape
+
+    def test_inference_dtype(self):
+        torch.manual_seed(1234)
+        sample_rate = 24_000
+        ratios = [5, 4, 3, 2]
+        encoder = SEANetEncoder(dimension=5, n_filters=3, n_residual_layers=1, ratios=ratios, norm='weight_norm')
+        decoder = SEANetDecoder(dimension=5, n_filters=3, n_residual_layers=1, ratios=ratios, norm='weight_norm')
+        model = EncodecModel(encoder, decoder, DummyQuantizer(), frame_rate=np.prod(ratios),
+                             sample_rate=sample_rate, channels=1).eval()
+        x = torch.randn(2, 1, 2_400)
+        with torch.no_grad():
+            emb, _ = model.encode(x)
+            out = model.decode(emb)
+            # folding the weight normalization does not change the outputs.
+            model.set_inference_dtype(None, fold_norms=True)
+            assert all(not name.endswith('weight_g') for name in model.state_dict())
+            emb_folded, _ = model.encode(x)
+            assert torch.allclose(emb_folded, emb, atol=1e-5)
+            assert torch.allclose(model.decode(emb), out, atol=1e-5)
+
+            model.set_inference_dtype(torch.bfloat16)
+            emb_bf16, _ = model.encode(x)
+            out_bf16 = model.decode(emb)
+        assert emb_bf16.dtype == torch.float32 and out_bf16.dtype == torch.float32
+        assert (emb_bf16 - emb).norm() < 0.1 * emb.norm()
+        assert (out_bf16 - out).norm() < 0.1 * out.norm()
+
+    def test_fuse_for_inference(self):
+        torch.manual_seed(1234)
+        ratios = [5, 4, 3, 2]
+        encoder = SEANetEncoder(dimension=5, n_filters=3, n_residual_layers=1, ratios=ratios, norm='weight_norm')
+        decoder = SEANetDecoder(dimension=5, n_filters=3, n_residual_layers=1, ratios=ratios, norm='weight_norm')
+        model = EncodecModel(encoder, decoder, DummyQuantizer(), frame_rate=np.prod(ratios),
+                             sample_rate=24_000, channels=1)
+        with pytest.raises(AssertionError):
+            model.fuse_for_inference()
+        model.eval()
+        x = torch.randn(2, 1, 2_400)
+        with torch.no_grad():
+            out = model(x).x
+            assert model.fuse_for_inference() > 0
+            assert model.fuse_for_inference() == 0
+            assert torch.allclose(model(x).x, out, atol=1e-5)
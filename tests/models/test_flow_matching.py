@@ -0,0 +1,42 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import math
+
+import pytest
+import torch
+
+from audiocraft.models.flow_matching import FIXED_STEP_SOLVERS, fixed_step_odeint
+
+
+def test_fixed_step_odeint():
+    z_0 = torch.randn(2, 5, 3)
+    target = z_0 * math.exp(-1.)
+    errors = {}
+    for solver, evals_per_step in FIXED_STEP_SOLVERS.items():
+        num_evals = 0
+
+        def func(t, z):
+            nonlocal num_evals
+            num_evals += 1
+            assert t.shape == (1,)
+            return -z
+
+        z_1 = fixed_step_odeint(func, z_0, solver=solver, nfe=16)
+        assert num_evals == 16
+        errors[solver] = (z_1 - target).abs().max().item()
+    assert errors['rk4'] < errors['heun'] / 10
+    assert errors['heun'] < errors['euler'] / 10
+    assert errors['midpoint'] < errors['euler'] / 10
+    assert errors['ab2'] < errors['euler'] / 10
+
+
+def test_fixed_step_odeint_time_dependent():
+    # dz/dt = 3 t^2, integrated exactly by 4th order solvers.
+    z_1 = fixed_step_odeint(lambda t, z: 3 * t ** 2 * torch.ones_like(z), torch.zeros(1), solver='rk4', nfe=8)
+    assert z_1.item() == pytest.approx(1., abs=1e-6)
+    with pytest.raises(ValueError):
+        fixed_step_odeint(lambda t, z: z, torch.zeros(1), solver='dopri5')
@@ -0,0 +1,44 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import subprocess
+import sys
+import typing as tp
+
+import pytest
+
+
+HEAVY_MODULES = ['transformers', 'spacy', 'demucs', 'librosa', 'xformers']
+
+
+def _loaded_modules(statement: str, modules: tp.List[str]) -> tp.List[str]:
+    # each statement runs in a fresh interpreter, as the modules imported by other tests are cached.
+    code = f"import sys\n{statement}\nprint(','.join(m for m in {modules!r} if m in sys.modules))"
+    out = subprocess.run([sys.executable, '-c', code], check=True, capture_output=True, text=True).stdout
+    return [name for name in out.strip().split(',') if name]
+
+
+class TestLazyImports:
+
+    @pytest.mark.parametrize('statement', [
+        'import audiocraft',
+        'import audiocraft.data.audio',
+        'from audiocraft.models import EncodecModel',
+    ])
+    def test_no_heavy_import(self, statement: str):
+        assert _loaded_modules(statement, HEAVY_MODULES) == []
+
+    def test_public_api(self):
+        import audiocraft
+        from audiocraft.models import MusicGen, HFEncodecModel
+        from audiocraft.modules import StreamingTransformer
+        assert audiocraft.models.MusicGen is MusicGen
+        assert audiocraft.models.musicgen.MusicGen is MusicGen
+        assert HFEncodecModel.__module__.startswith('transformers')
+        assert StreamingTransformer.__module__ == 'audiocraft.modules.transformer'
+        assert 'MusicGen' in dir(audiocraft.models)
+        with pytest.raises(AttributeError):
+            audiocraft.models.NotAModel
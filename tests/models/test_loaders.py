@@ -0,0 +1,113 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import itertools
+
+from omegaconf import OmegaConf
+import torch
+
+from audiocraft.models import EncodecModel
+from audiocraft.models.builders import get_compression_model, get_debug_lm_model
+from audiocraft.models.loaders import load_lm_model_ckpt, load_state_dict_into_empty
+from audiocraft.modules import SEANetEncoder, SEANetDecoder
+from audiocraft.modules.conditioners import ConditioningAttributes
+from audiocraft.quantization import DummyQuantizer
+from audiocraft.solvers.compression import CompressionSolver
+from audiocraft.utils.export import export_encodec
+
+
+class TestLoaders:
+
+    def test_load_state_dict_into_empty(self, tmp_path):
+        torch.manual_seed(1234)
+        lm = get_debug_lm_model()
+        path = tmp_path / 'state_dict.bin'
+        torch.save({'best_state': lm.state_dict()}, path)
+
+        empty_lm = get_debug_lm_model(empty_init=True)
+        assert all(param.is_meta for param in empty_lm.transformer.parameters())
+        state = load_lm_model_ckpt(path, mmap=True)['best_state']
+        load_state_dict_into_empty(empty_lm, state)
+        tensors = itertools.chain(empty_lm.parameters(), empty_lm.buffers())
+        assert not any(tensor.is_meta for tensor in tensors)
+
+        codes = torch.randint(lm.card, (2, lm.num_codebooks, 10))
+        conditions = [ConditioningAttributes(text={'description': 'some text'}) for _ in range(2)]
+        with torch.no_grad():
+            assert torch.allclose(empty_lm(codes, conditions), lm(codes, conditions))
+
+    def test_load_fused_state_dict_into_empty(self):
+        # this is how the compression models are restored from a snapshot.
+        def _create_model():
+            kwargs = dict(dimension=5, n_filters=3, n_residual_layers=1, ratios=[4, 2], norm='weight_norm')
+            return EncodecModel(SEANetEncoder(**kwargs), SEANetDecoder(**kwargs), DummyQuantizer(),
+                                frame_rate=8, sample_rate=64, channels=1).eval()
+
+        torch.manual_seed(1234)
+        model = _create_model()
+        model.fuse_for_inference()
+        with torch.device('meta'):
+            empty_model = _create_model()
+        empty_model.fuse_for_inference()
+        load_state_dict_into_empty(empty_model, model.state_dict())
+        x = torch.randn(2, 1, 64)
+        with torch.no_grad():
+            assert torch.allclose(empty_model(x).x, model(x).x)
+
+    def test_load_exported_compression_model_for_fine_tuning(self, tmp_path):
+        cfg = OmegaConf.create({
+            'device': 'cpu',
+            'compression_model': 'encodec',
+            'encodec': {'autoencoder': 'seanet', 'quantizer': 'no_quant', 'sample_rate': 64, 'channels': 1},
+            'seanet': {'dimension': 5, 'channels': 1, 'n_filters': 3, 'n_residual_layers': 1, 'ratios': [4, 2],
+                       'norm': 'weight_norm', 'encoder': {}, 'decoder': {}},
+            'no_quant': {},
+        })
+        torch.manual_seed(1234)
+        model = get_compression_model(cfg).eval()
+        checkpoint = tmp_path / 'checkpoint.th'
+        torch.save({'xp.cfg': OmegaConf.to_container(cfg), 'best_state': {'model': model.state_dict()}}, checkpoint)
+        exported = export_encodec(checkpoint, tmp_path / 'exported.th')
+
+        # `load_from_pretrained` does not depend on the state of the solver.
+        solver = CompressionSolver.__new__(CompressionSolver)
+        state = solver.load_from_pretrained(str(exported))['best_state']['model']
+        assert state.keys() == model.state_dict().keys()
+        new_model = get_compression_model(cfg).eval()
+        new_model.load_state_dict(state)
+        x = torch.randn(2, 1, 64)
+        with torch.no_grad():
+            assert torch.allclose(new_model(x).x, model(x).x)
+
+    def test_load_legacy_codebooks_state_dict(self):
+        # checkpoints saved before the fusion of the codebooks embeddings and output heads.
+        torch.manual_seed(1234)
+        lm = get_debug_lm_model()
+        state = lm.state_dict()
+        card, K = lm.card, lm.num_codebooks
+        legacy_state = {key: value for key, value in state.items() if not key.startswith(('emb.', 'linears.'))}
+        for k in range(K):
+            legacy_state[f'emb.{k}.weight'] = state['emb.table.weight'][k * (card + 1): (k + 1) * (card + 1)]
+            legacy_state[f'linears.{k}.weight'] = state['linears.proj.weight'][k * card: (k + 1) * card]
+            legacy_state[f'linears.{k}.bias'] = state['linears.proj.bias'][k * card: (k + 1) * card]
+
+        codes = torch.randint(card, (2, K, 10))
+        conditions = [ConditioningAttributes(text={'description': 'some text'}) for _ in range(2)]
+        for empty_init in [False, True]:
+            new_lm = get_debug_lm_model(empty_init=empty_init)
+            load_state_dict_into_empty(new_lm, dict(legacy_state))
+            with torch.no_grad():
+                assert torch.allclose(new_lm(codes, conditions), lm(codes, conditions))
+
+        # the fused embeddings and heads match the per codebook ones.
+        out = torch.randn(2, 10, lm.dim)
+        with torch.no_grad():
+            emb = sum([torch.nn.functional.embedding(codes[:, k], legacy_state[f'emb.{k}.weight']) for k in range(K)])
+            assert torch.allclose(lm.emb(codes), emb, atol=1e-6)
+            logits = torch.stack([torch.nn.functional.linear(out, legacy_state[f'linears.{k}.weight'],
+                                                             legacy_state[f'linears.{k}.bias'])
+                                  for k in range(K)], dim=1)
+            assert torch.allclose(lm.linears(out), logits, atol=1e-6)
@@ -0,0 +1,93 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import torch
+
+from audiocraft.models import MAGNeT
+from audiocraft.models.lm_magnet import MagnetLMModel
+from audiocraft.modules.codebooks_patterns import ParallelPatternProvider
+from audiocraft.modules.conditioners import (
+    ConditionFuser, ConditioningAttributes, ConditioningProvider, LUTConditioner)
+
+
+class TestMagnetLMModel:
+    def get_lm(self, span_len: int = 3) -> MagnetLMModel:
+        torch.manual_seed(1234)
+        dim = 16
+        condition_provider = ConditioningProvider({
+            'description': LUTConditioner(n_bins=32, dim=dim, output_dim=dim, tokenizer='noop')})
+        fuser = ConditionFuser({'cross': ['description'], 'prepend': [], 'sum': [], 'input_interpolate': []})
+        lm = MagnetLMModel(
+            pattern_provider=ParallelPatternProvider(n_q=4), condition_provider=condition_provider,
+            fuser=fuser, n_q=4, card=32, dim=dim, num_heads=4, num_layers=2, custom=True,
+            cross_attention=True, causal=False, subcodes_context=2, span_len=span_len,
+            device='cpu', dtype=torch.float32)
+        return lm.eval()
+
+    def test_least_probable_span_masking(self):
+        lm = self.get_lm()
+        scores = torch.rand(4, 1, 40)
+        num_masked = torch.tensor([3, 10, 17, 30])
+        mask = lm._least_probable_span_masking(scores, num_masked)
+        assert list(mask.shape) == [4, 1, 40]
+        # the binary search stops within a span of the target.
+        n_masked = mask.sum(dim=(1, 2))
+        assert ((n_masked - num_masked).abs() < lm.span_len).all(), n_masked
+        # the items are independent of each other.
+        single = lm._least_probable_span_masking(scores[2:3], num_masked[2:3])
+        assert torch.equal(single, mask[2:3])
+
+    def test_generate_prompt_lengths(self):
+        lm = self.get_lm()
+        conditions = [ConditioningAttributes(text={'description': desc}) for desc in ['a', 'b', None]]
+        prompt = torch.randint(0, 32, (3, 4, 6))
+        prompt_lengths = [0, 3, 6]
+        for span_arrangement in ['nonoverlap', 'stride1']:
+            out = lm.generate(prompt, conditions, max_gen_len=15, use_sampling=False,
+                              decoding_steps=[3, 2, 2, 2], span_arrangement=span_arrangement,
+                              prompt_lengths=prompt_lengths)
+            assert out.shape[:2] == (3, 4)
+            assert not (out == lm.special_token_id).any()
+            for idx, length in enumerate(prompt_lengths):
+                assert torch.equal(out[idx, :, :length], prompt[idx, :, :length])
+
+    def test_generate_early_exit(self):
+        lm = self.get_lm()
+        conditions = [ConditioningAttributes(text={'description': desc}) for desc in ['a', None]]
+        steps = []
+
+        def _callback(step: int, total: int):
+            steps.append((step, total))
+
+        decoding_steps = [4, 3, 3, 3]
+        out = lm.generate(None, conditions, max_gen_len=15, use_sampling=False, decoding_steps=decoding_steps,
+                          callback=_callback)
+        assert lm.decoding_stats['executed_steps'] == decoding_steps
+        assert lm.decoding_stats['saved_forward_passes'] == 0
+
+        steps.clear()
+        # with a threshold above any change rate, each stage stops after the minimal number of steps.
+        out = lm.generate(None, conditions, max_gen_len=15, use_sampling=False, decoding_steps=decoding_steps,
+                          callback=_callback, early_exit_threshold=1.1, early_exit_min_steps=2)
+        assert lm.decoding_stats['executed_steps'] == [2, 2, 2, 2]
+        assert lm.decoding_stats['saved_forward_passes'] == 5
+        assert steps[-1] == (13, 13)
+        assert not (out == lm.special_token_id).any()
+
+        # the early exit is only checked every 3 steps, i.e. not before the last step of the 3 steps stages.
+        lm.generate(None, conditions, max_gen_len=15, use_sampling=False, decoding_steps=decoding_steps,
+                    early_exit_threshold=1.1, early_exit_min_steps=2, early_exit_interval=3)
+        assert lm.decoding_stats['executed_steps'] == [3, 3, 3, 3]
+        assert lm.decoding_stats['saved_forward_passes'] == 1
+
+
+class TestMAGNeTModel:
+    def test_generate(self):
+        model = MAGNeT.get_pretrained(name='debug', device='cpu')
+        model.set_generation_params(decoding_steps=[3, 2, 2, 2])
+        assert model.duration == 2
+        wav = model.generate(['youpi', 'lapin dort'])
+        assert list(wav.shape) == [2, 1, 64000]
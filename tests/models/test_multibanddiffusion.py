@@ -6,6 +6,7 @@
 
 import random
 
+import julius
 import numpy as np
 import torch
 from audiocraft.models.multibanddiffusion import MultiBandDiffusion, DiffusionProcess
@@ -51,3 +52,31 @@ class TestMBD:
             x = torch.randn(2, channels, length)
             res = mbd.regenerate(x, sample_rate)
             assert res.shape == x.shape
+
+    def test_chunked_generation(self):
+        torch.manual_seed(1234)
+        sample_rate = 24_000
+        mbd = self._create_mbd(sample_rate=sample_rate, channels=1, codec_dim=32)
+        frame_rate = mbd.codec_model.frame_rate
+        emb = torch.randn(2, 32, 25)
+        step_list = [999, 500, 0]
+        out = mbd.generate(emb, step_list=step_list)
+        # 25 frames, by chunks of 10 frames overlapping by 2 frames.
+        out_chunked = mbd.generate(emb, step_list=step_list, chunk_duration=10 / frame_rate,
+                                   chunk_overlap=2 / frame_rate)
+        assert out_chunked.shape == out.shape
+        assert torch.isfinite(out_chunked).all()
+        # the default overlap of 0.5 seconds is reduced to half of the short chunks.
+        out_chunked = mbd.generate(emb, step_list=step_list, chunk_duration=10 / frame_rate)
+        assert out_chunked.shape == out.shape
+
+    def test_re_eq(self):
+        torch.manual_seed(1234)
+        mbd = self._create_mbd(sample_rate=24_000, channels=1)
+        wav = torch.randn(2, 1, 4_000)
+        ref = torch.randn(2, 1, 4_000) * torch.linspace(0.1, 2., 4_000)
+        n_bands = 8
+        out = mbd.re_eq(wav, ref, n_bands=n_bands)
+        bands, bands_ref = julius.split_bands(wav, 24_000, n_bands), julius.split_bands(ref, 24_000, n_bands)
+        out_ref = sum(bands[i] * bands_ref[i].std() / bands[i].std() for i in range(n_bands))
+        assert torch.allclose(out, out_ref, atol=1e-5)
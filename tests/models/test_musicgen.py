@@ -8,6 +8,7 @@ import pytest
 import torch
 
 from audiocraft.models import MusicGen
+from audiocraft.models.lm import load_cfg_conditions, save_cfg_conditions
 
 
 class TestMusicGenModel:
@@ -63,3 +64,21 @@ class TestMusicGenModel:
         wav = mg.generate(
             ['youpi', 'lapin dort'])
         assert list(wav.shape) == [2, 1, 64000]
+
+    def test_generate_precomputed_conditions(self, tmp_path):
+        mg = self.get_musicgen()
+        cfg_conditions = mg.compute_cfg_conditions(['youpi', 'lapin dort'])
+        path = tmp_path / 'conditions.th'
+        save_cfg_conditions(cfg_conditions, path)
+        cfg_conditions = load_cfg_conditions(path)
+        wav = mg.generate(['youpi', 'lapin dort'], cfg_conditions=cfg_conditions)
+        assert list(wav.shape) == [2, 1, 64000]
+
+        mg.set_generation_params(duration=2.0, extend_stride=2., two_step_cfg=True)
+        cfg_conditions = mg.compute_cfg_conditions(['youpi', 'lapin dort'])
+        assert isinstance(cfg_conditions, tuple)
+        save_cfg_conditions(cfg_conditions, path)
+        cfg_conditions = load_cfg_conditions(path)
+        assert isinstance(cfg_conditions, tuple)
+        wav = mg.generate(['youpi', 'lapin dort'], cfg_conditions=cfg_conditions)
+        assert list(wav.shape) == [2, 1, 64000]
@@ -0,0 +1,104 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+from collections import OrderedDict
+import typing as tp
+
+import torch
+
+from audiocraft.modules import clap
+from audiocraft.modules.clap import CLAPEmbeddingService
+
+
+class _StubCLAPModel:
+    """Stands for the CLAP module, with text embeddings filled with the length of the text."""
+    def __init__(self, dim: int = 4):
+        self.dim = dim
+        self.text_calls: tp.List[tp.List[str]] = []
+        self.audio_calls: tp.List[int] = []
+
+    def get_text_embedding(self, texts, tokenizer=None, use_tensor=True):
+        self.text_calls.append(list(texts))
+        return torch.stack([torch.full((self.dim,), float(len(text))) for text in texts])
+
+    def get_audio_embedding_from_data(self, wav, use_tensor=True):
+        self.audio_calls.append(wav.size(0))
+        return wav[:, :self.dim]
+
+
+class _StubCLAPService(CLAPEmbeddingService):
+    _shared: tp.Dict[tp.Tuple[str, str, bool, str], CLAPEmbeddingService] = {}
+
+    def __init__(self, checkpoint, model_arch='HTSAT-tiny', enable_fusion=False, device='cpu',
+                 text_cache_size=1024):
+        self.checkpoint = checkpoint
+        self.model_arch = model_arch
+        self.enable_fusion = enable_fusion
+        self.device = torch.device(device)
+        self.model = _StubCLAPModel()
+        self.text_cache_size = text_cache_size
+        self._text_cache = OrderedDict()
+
+
+class TestCLAPEmbeddingService:
+
+    def test_get_shared(self):
+        _StubCLAPService.clear_shared()
+        service = _StubCLAPService.get_shared('clap.pt', text_cache_size=2)
+        assert _StubCLAPService.get_shared('clap.pt') is service
+        assert service.text_cache_size == 2
+        assert _StubCLAPService.get_shared('clap.pt', text_cache_size=8) is service
+        assert service.text_cache_size == 8
+        _StubCLAPService.get_shared('clap.pt', text_cache_size=4)
+        assert service.text_cache_size == 8
+        assert _StubCLAPService.get_shared('clap.pt', model_arch='HTSAT-base') is not service
+        _StubCLAPService.clear_shared()
+
+    def test_text_cache_eviction(self):
+        service = _StubCLAPService('clap.pt', text_cache_size=2)
+        embed = service.get_text_embedding(['a', 'bb', 'a'])
+        assert embed.shape == (3, 4)
+        assert embed[:, 0].tolist() == [1., 2., 1.]
+        assert service.model.text_calls == [['a', 'bb']]
+
+        service.get_text_embedding(['a'])  # 'a' is now the most recently used.
+        assert service.model.text_calls == [['a', 'bb']]
+        service.get_text_embedding(['ccc'])  # evicts 'bb'.
+        assert list(service._text_cache) == ['a', 'ccc']
+        embed = service.get_text_embedding(['bb', 'ccc'])
+        assert embed[:, 0].tolist() == [2., 3.]
+        assert service.model.text_calls == [['a', 'bb'], ['ccc'], ['bb']]
+        assert list(service._text_cache) == ['ccc', 'bb']
+
+    def test_preprocess_wav_groups_sample_rates(self, monkeypatch):
+        calls = []
+
+        def _convert_audio(wav, from_rate, to_rate, to_channels):
+            # keeps the length, so that the items can be told apart by their scaling.
+            calls.append((from_rate, len(wav)))
+            return wav.mean(dim=1, keepdim=True) * from_rate
+
+        monkeypatch.setattr(clap, 'convert_audio', _convert_audio)
+        service = _StubCLAPService('clap.pt')
+        wav = torch.ones(4, 2, 8)
+        out = service.preprocess_wav(wav, [16000, 32000, 16000, 48000])
+        assert out.shape == (4, 8)
+        assert out[:, 0].tolist() == [16000., 32000., 16000., 48000.]
+        assert sorted(calls) == [(16000, 2), (32000, 1), (48000, 1)]
+
+        calls.clear()
+        out = service.preprocess_wav(wav, [24000] * 4, sample_rate=44100)
+        assert calls == [(24000, 4)]
+
+    def test_audio_embedding_batches(self):
+        service = _StubCLAPService('clap.pt')
+        wav = torch.randn(5, 16)
+        embed = service.get_audio_embedding(wav)
+        assert service.model.audio_calls == [5]
+        assert torch.equal(embed, wav[:, :4])
+        embed = service.get_audio_embedding(wav, batch_size=2)
+        assert service.model.audio_calls == [5, 2, 2, 1]
+        assert torch.equal(embed, wav[:, :4])
@@ -0,0 +1,36 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import torch
+
+from audiocraft.modules.conditioners import (
+    ConditioningAttributes, ConditioningProvider, LengthBuckets, LUTConditioner, split_length_buckets)
+
+
+def test_split_length_buckets():
+    lengths = [7, 1, 2, 8, 0, 1]
+    buckets = split_length_buckets(lengths, 3)
+    assert sorted(idx for bucket in buckets for idx in bucket) == list(range(len(lengths)))
+    assert buckets == [[4, 1, 5], [2], [0, 3]]
+    assert split_length_buckets([3, 3, 3], 4) == [[0, 1, 2]]
+
+
+def test_provider_length_buckets():
+    torch.manual_seed(1234)
+    conditioner = LUTConditioner(n_bins=32, dim=8, output_dim=16, tokenizer='noop')
+    descriptions = ["a b c d e f g", None, "a", "h i j k l m n o p", "b c", None]
+    attributes = [ConditioningAttributes(text={'description': desc}) for desc in descriptions]
+
+    provider = ConditioningProvider({'description': conditioner})
+    ref_embeds, ref_mask = provider(provider.tokenize(attributes))['description']
+
+    provider.length_buckets = 3
+    tokenized = provider.tokenize(attributes)
+    assert isinstance(tokenized['description'], LengthBuckets)
+    embeds, mask = provider(tokenized)['description']
+    assert embeds.shape == ref_embeds.shape
+    assert torch.equal(mask, ref_mask)
+    assert torch.allclose(embeds, ref_embeds, atol=1e-6)
@@ -0,0 +1,58 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+from collections import namedtuple
+
+import pytest
+import torch
+
+from audiocraft.modules.diffusion_schedule import NoiseSchedule
+
+Output = namedtuple("Output", "sample")
+
+
+class OracleDenoiser:
+    """Predicts the exact noise for data consisting of a single known sample."""
+    def __init__(self, schedule: NoiseSchedule, x0: torch.Tensor):
+        self.alpha_bars = schedule.get_alpha_bar()
+        self.x0 = x0
+        self.num_calls = 0
+
+    def __call__(self, x: torch.Tensor, step: int, condition=None):
+        self.num_calls += 1
+        alpha_bar = self.alpha_bars[step]
+        return Output((x - alpha_bar.sqrt() * self.x0) / (1 - alpha_bar).sqrt())
+
+
+def test_get_step_list():
+    schedule = NoiseSchedule(device='cpu')
+    assert schedule.get_step_list() == list(range(1000))[::-50] + [0]
+    step_list = schedule.get_step_list(4)
+    assert step_list == [999, 749, 500, 250, 0]
+
+
+@pytest.mark.parametrize("sampler", ['ddim', 'dpmpp_2m'])
+def test_deterministic_samplers(sampler: str):
+    torch.manual_seed(1234)
+    schedule = NoiseSchedule(device='cpu', clip=0)
+    x0 = torch.randn(2, 1, 50)
+    model = OracleDenoiser(schedule, x0)
+    step_list = schedule.get_step_list(6)
+    out = schedule.generate_subsampled(model, torch.randn(2, 1, 50), step_list=step_list, sampler=sampler)
+    assert model.num_calls == 6
+    assert torch.allclose(out, x0, atol=1e-4)
+    # coefficients are computed once per sampler and step list.
+    assert schedule.sampling_coefficients(step_list, sampler) is schedule.sampling_coefficients(step_list, sampler)
+
+
+def test_ddpm_sampler():
+    torch.manual_seed(1234)
+    schedule = NoiseSchedule(device='cpu')
+    model = OracleDenoiser(schedule, torch.zeros(2, 1, 50))
+    iterates = schedule.generate_subsampled(model, torch.randn(2, 1, 50), return_list=True)
+    assert len(iterates) == 21
+    with pytest.raises(ValueError):
+        schedule.sampling_coefficients([999, 0], sampler='unknown')
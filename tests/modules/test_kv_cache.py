@@ -0,0 +1,80 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+from itertools import product
+
+import pytest
+import torch
+
+from audiocraft.models.builders import get_debug_lm_model
+from audiocraft.modules.conditioners import ConditioningAttributes
+from audiocraft.modules.kv_cache import KVBlockPool
+from audiocraft.modules.transformer import StreamingTransformer, paged_kv_cache
+
+
+def _stream(tr: StreamingTransformer, x: torch.Tensor, chunk: int) -> torch.Tensor:
+    ys = []
+    with tr.streaming():
+        for offset in range(0, x.shape[1], chunk):
+            ys.append(tr(x[:, offset: offset + chunk]))
+    return torch.cat(ys, dim=1)
+
+
+class TestPagedKVCache:
+
+    @pytest.mark.parametrize('context,custom', product([None, 5], [False, True]))
+    def test_streaming_transformer(self, context, custom):
+        torch.manual_seed(1234)
+        tr = StreamingTransformer(16, 4, 2, causal=True, past_context=context, custom=custom, dropout=0.).eval()
+        x = torch.randn(3, 20, 16)
+        pool = KVBlockPool(num_blocks=64, block_size=4)
+        with torch.no_grad():
+            ref = _stream(tr, x, chunk=3)
+            with paged_kv_cache(tr, pool):
+                y = _stream(tr, x, chunk=3)
+                if context is not None:
+                    # the blocks out of the past context are given back to the pool along the way.
+                    assert pool.num_free_blocks >= 64 - 2 * 3 * 3
+        assert torch.allclose(y, ref, atol=1e-6)
+        assert pool.num_free_blocks == 64
+
+    def test_pool_exhausted(self):
+        tr = StreamingTransformer(16, 4, 1, causal=True, custom=True, dropout=0.).eval()
+        pool = KVBlockPool(num_blocks=2, block_size=4)
+        with torch.no_grad(), pytest.raises(RuntimeError):
+            with paged_kv_cache(tr, pool):
+                _stream(tr, torch.randn(1, 12, 16), chunk=1)
+        assert pool.num_free_blocks == 2
+
+    def test_lm_generate(self):
+        torch.manual_seed(1234)
+        lm = get_debug_lm_model()
+        conditions = [ConditioningAttributes(text={'description': 'some text'}) for _ in range(2)]
+        pool = KVBlockPool(num_blocks=256, block_size=8)
+        with torch.no_grad():
+            ref = lm.generate(conditions=conditions, max_gen_len=20, use_sampling=False)
+            ref_two_step = lm.generate(conditions=conditions, max_gen_len=20, use_sampling=False,
+                                       two_step_cfg=True)
+            lm.kv_pool = pool
+            tokens = lm.generate(conditions=conditions, max_gen_len=20, use_sampling=False)
+            tokens_two_step = lm.generate(conditions=conditions, max_gen_len=20, use_sampling=False,
+                                          two_step_cfg=True)
+        assert torch.equal(tokens, ref)
+        assert torch.equal(tokens_two_step, ref_two_step)
+        assert pool.num_free_blocks == 256
+
+    def test_gather_buffers_reused(self):
+        torch.manual_seed(1234)
+        tr = StreamingTransformer(16, 4, 2, causal=True, custom=True, dropout=0.).eval()
+        pool = KVBlockPool(num_blocks=64, block_size=4)
+        capacities = set()
+        with torch.no_grad(), paged_kv_cache(tr, pool) as cache, tr.streaming():
+            for _ in range(32):
+                tr(torch.randn(2, 1, 16))
+                assert cache._gathered_keys is not None
+                capacities.add(cache._gathered_keys.shape[0])
+        # 2 sequences of up to 8 blocks, the buffers are only reallocated to grow to 2, 4, 8 and 16 blocks.
+        assert capacities == {2, 4, 8, 16}
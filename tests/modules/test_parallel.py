@@ -0,0 +1,43 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import pytest
+import torch
+from torch import distributed as dist
+import torch.multiprocessing as mp
+
+from audiocraft.models.builders import get_debug_lm_model
+from audiocraft.modules.conditioners import ConditioningAttributes
+
+
+def _check_sharded_lm(rank: int, world_size: int, mode: str, init_file: str):
+    dist.init_process_group('gloo', init_method=f'file://{init_file}', rank=rank, world_size=world_size)
+    try:
+        torch.manual_seed(1234)
+        lm = get_debug_lm_model()
+        codes = torch.randint(lm.card, (2, lm.num_codebooks, 10))
+        conditions = [ConditioningAttributes(text={'description': 'some text'}) for _ in range(2)]
+        with torch.no_grad():
+            ref_logits = lm(codes, conditions)
+            ref_tokens = lm.generate(conditions=conditions, max_gen_len=12, use_sampling=False)
+            lm.shard_for_inference(mode)
+            logits = lm(codes, conditions)
+            tokens = lm.generate(conditions=conditions, max_gen_len=12, use_sampling=False)
+        assert torch.allclose(logits, ref_logits, atol=1e-5)
+        assert torch.equal(tokens, ref_tokens)
+        if mode == 'pipeline':
+            assert len(lm.transformer.layers) == 1
+        else:
+            assert lm.transformer.layers[0].self_attn.num_heads == 4 // world_size
+    finally:
+        dist.destroy_process_group()
+
+
+@pytest.mark.parametrize('mode', ['tensor', 'pipeline'])
+def test_sharded_lm(mode, tmp_path):
+    # the debug LM has 4 heads and 2 layers.
+    world_size = 2
+    mp.spawn(_check_sharded_lm, args=(world_size, mode, str(tmp_path / 'init')), nprocs=world_size)
@@ -9,8 +9,10 @@ from itertools import product
 import pytest
 import torch
 
+from audiocraft.modules.conditioners import ConditionFuser
 from audiocraft.modules.transformer import (
-    StreamingMultiheadAttention, StreamingTransformer, set_efficient_attention_backend)
+    LocalAttentionMask, StreamingMultiheadAttention, StreamingTransformer, cross_attention_kv_cache,
+    set_efficient_attention_backend)
 
 
 def test_transformer_causal_streaming():
@@ -221,6 +223,71 @@ def test_cross_attention_compat():
     assert torch.allclose(y_streaming, y, atol=1e-7)
 
 
+def test_cross_attention_key_padding():
+    torch.manual_seed(1234)
+    num_heads = 2
+    dim = num_heads * 64
+    cross_attn = StreamingMultiheadAttention(
+        dim, num_heads, dropout=0, cross_attention=True, custom=True)
+    ref_attn = torch.nn.MultiheadAttention(dim, num_heads, dropout=0, batch_first=True)
+    cross_attn.load_state_dict(ref_attn.state_dict())
+
+    queries = torch.randn(3, 7, dim)
+    keys = torch.randn(3, 9, dim)
+    lengths = torch.tensor([9, 4, 1])
+    padding = torch.arange(9)[None, :] >= lengths[:, None]
+    keys = keys * (~padding)[..., None]
+    y = cross_attn(queries, keys, keys, key_padding_mask=padding)[0]
+    y_ref = ref_attn(queries, keys, keys, key_padding_mask=padding)[0]
+    assert torch.allclose(y, y_ref, atol=1e-6), (y - y_ref).norm() / y_ref.norm()
+
+    # Collapsing the identical padded keys in a single one gives back attention over the full keys.
+    y_full = cross_attn(queries, keys, keys)[0]
+    fuser = ConditionFuser({'cross': ['description']}, cross_attention_padding='collapse')
+    bias = fuser.cross_attention_padding_bias({'description': (keys, (~padding).int())})
+    y_collapsed = cross_attn(queries, keys, keys, key_padding_mask=bias)[0]
+    assert torch.allclose(y_collapsed, y_full, atol=1e-5), (y_collapsed - y_full).norm() / y_full.norm()
+
+
+def test_cross_attention_kv_cache():
+    torch.manual_seed(1234)
+    for custom in [False, True]:
+        tr = StreamingTransformer(16, 4, 2, cross_attention=True, custom=custom, dropout=0.)
+        tr.eval()
+        src = torch.randn(3, 5, 16)
+        shifts = [torch.randn(1, 1, 16) for _ in range(3)]
+        xs = [torch.randn(3, 7, 16) for _ in shifts]
+        with torch.no_grad():
+            refs = [tr(x, cross_attention_src=src + shift) for x, shift in zip(xs, shifts)]
+            with cross_attention_kv_cache(tr):
+                ys = [tr(x, cross_attention_src=src, cross_attention_shift=shift) for x, shift in zip(xs, shifts)]
+                cache = tr.layers[0].cross_attention._cross_kv_cache
+                assert not custom or cache['source'] is src
+        assert tr.layers[0].cross_attention._cross_kv_cache is None
+        for y, y_ref in zip(ys, refs):
+            assert torch.allclose(y, y_ref, atol=1e-5), (y - y_ref).norm()
+
+
+def test_local_attention():
+    torch.manual_seed(1234)
+    set_efficient_attention_backend('torch')
+    tr = StreamingTransformer(16, 4, 2, causal=False, custom=True, dropout=0.)
+    tr_mem_efficient = StreamingTransformer(16, 4, 2, causal=False, memory_efficient=True, dropout=0.)
+    tr_mem_efficient.load_state_dict(tr.state_dict())
+    for steps in [1, 7, 20]:
+        x = torch.randn(3, steps, 16)
+        local_mask = LocalAttentionMask(context=2, block_size=4)
+        dense_mask = local_mask.to_dense(steps, x.device, x.dtype)
+        with torch.no_grad():
+            y_ref = tr(x, src_mask=dense_mask)
+            y = tr(x, src_mask=local_mask)
+            y_mem_efficient = tr_mem_efficient(x, src_mask=local_mask)
+        assert torch.allclose(y, y_ref, atol=1e-6), (y - y_ref).norm()
+        assert torch.allclose(y_mem_efficient, y_ref, atol=1e-5), (y_mem_efficient - y_ref).norm()
+        # masks are computed once per sequence length.
+        assert local_mask.to_dense(steps, x.device, x.dtype) is dense_mask
+
+
 def test_repeat_kv():
     torch.manual_seed(1234)
     num_heads = 8
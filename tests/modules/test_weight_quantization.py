@@ -0,0 +1,63 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import pytest
+import torch
+from torch import nn
+
+from audiocraft.models.builders import get_debug_lm_model
+from audiocraft.modules.conditioners import ConditioningAttributes
+from audiocraft.modules.weight_quantization import (
+    QuantizedEmbedding, QuantizedLinear, dequantize_weight, quantize_weight)
+
+
+class TestWeightQuantization:
+
+    @pytest.mark.parametrize('bits,group_size,tolerance', [(8, None, 0.01), (4, None, 0.2), (4, 8, 0.15)])
+    def test_quantize_weight(self, bits, group_size, tolerance):
+        torch.manual_seed(1234)
+        weight = torch.randn(12, 32)
+        qweight, scales = quantize_weight(weight, bits, group_size)
+        assert qweight.shape == (12, 32 * bits // 8)
+        assert scales.shape == (12, 32 // (group_size or 32))
+        restored = dequantize_weight(qweight, scales, bits)
+        assert (restored - weight).norm() / weight.norm() < tolerance
+
+    def test_quantized_linear(self):
+        torch.manual_seed(1234)
+        linear = nn.Linear(32, 48)
+        quantized = QuantizedLinear.from_linear(linear, bits=8)
+        x = torch.randn(2, 5, 32)
+        with torch.no_grad():
+            ref = linear(x)
+            out = quantized(x)
+        assert out.shape == ref.shape
+        assert (out - ref).norm() / ref.norm() < 0.01
+        # applying the layer in parts is equivalent to slicing the full output.
+        part = quantized.project(x, 16, 32, use_bias=False)
+        assert torch.allclose(part, out[..., 16:32] - linear.bias[16:32].detach(), atol=1e-5)
+
+    def test_quantized_embedding(self):
+        torch.manual_seed(1234)
+        emb = nn.Embedding(10, 16)
+        quantized = QuantizedEmbedding.from_embedding(emb)
+        indices = torch.randint(10, (3, 7))
+        with torch.no_grad():
+            ref = emb(indices)
+        assert (quantized(indices) - ref).norm() / ref.norm() < 0.01
+
+    def test_lm_token_agreement(self):
+        torch.manual_seed(1234)
+        lm = get_debug_lm_model()
+        codes = torch.randint(lm.card, (2, lm.num_codebooks, 20))
+        conditions = [ConditioningAttributes(text={'description': 'some text'}) for _ in range(2)]
+        with torch.no_grad():
+            ref = lm(codes, conditions)
+            assert lm.quantize_weights(bits=8) > 0
+            assert not any(isinstance(m, nn.Linear) for m in lm.transformer.modules())
+            out = lm(codes, conditions)
+        assert (out - ref).norm() / ref.norm() < 0.05
+        assert (out.argmax(-1) == ref.argmax(-1)).float().mean() > 0.9
@@ -0,0 +1,48 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+from pathlib import Path
+
+import torch
+
+from audiocraft.utils.cache import EmbeddingCache
+
+from ..common_utils import TempDirMixin
+
+
+class TestEmbeddingCache(TempDirMixin):
+
+    def test_precompute_embed(self):
+        calls = []
+
+        def compute_embed_fn(path, x, idx):
+            calls.append(path)
+            return torch.full((4, 3), float(len(str(path))))
+
+        cache = EmbeddingCache(Path(self.get_temp_dir('cache')), 'cpu', compute_embed_fn=compute_embed_fn)
+        paths = [Path('/data/a.wav'), Path('/data/bb.wav')]
+        for path in paths:
+            assert not cache.is_cached(path)
+            assert cache.precompute_embed(path)
+            assert cache.is_cached(path)
+        # already cached embeddings are not computed again
+        assert not cache.precompute_embed(paths[0])
+        assert len(calls) == 2
+
+        cache.populate_embed_cache(paths, None)
+        embed = cache.get_embed_from_cache(paths, None)
+        assert len(calls) == 2
+        assert list(embed.shape) == [2, 4, 3]
+        assert torch.allclose(embed[1], torch.full((4, 3), float(len(str(paths[1])))))
+
+    def test_normalized_paths(self):
+        cache = EmbeddingCache(Path(self.get_temp_dir('cache')), 'cpu',
+                               compute_embed_fn=lambda path, x, idx: torch.zeros(4, 3))
+        # paths as written in a manifest match the ones looked up by the conditioners.
+        assert cache.precompute_embed('./data//a.wav')
+        assert cache.is_cached(Path('data/a.wav'))
+        assert cache.is_cached('data/./a.wav')
+        assert not cache.precompute_embed(Path('data/a.wav'))
@@ -0,0 +1,95 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import json
+
+from audiocraft.models import MusicGen
+from audiocraft.utils.profiler import Span, Tracer, trace_count, trace_span
+
+from ..common_utils import TempDirMixin
+
+
+class _FakeEvent:
+    # stands for a CUDA event, so that the flush of the pending spans can be tested on CPU.
+    def __init__(self, time: float, completed: bool = True):
+        self.time = time
+        self.completed = completed
+
+    def query(self):
+        return self.completed
+
+    def synchronize(self):
+        self.completed = True
+
+    def elapsed_time(self, end: '_FakeEvent') -> float:
+        return 1000 * (end.time - self.time)
+
+
+class TestTracer(TempDirMixin):
+
+    def test_spans_and_counters(self):
+        tracer = Tracer()
+        spans, counts = [], []
+        tracer.add_sink(on_span=spans.append, on_count=lambda name, value: counts.append((name, value)))
+        with trace_span('ignored'):
+            trace_count('ignored')
+        with tracer.activate():
+            with trace_span('outer', batch_size=2):
+                for _ in range(3):
+                    with trace_span('inner'):
+                        trace_count('tokens', 4)
+        summary = tracer.summary()
+        assert summary['spans']['outer']['calls'] == 1
+        assert summary['spans']['inner']['calls'] == 3
+        assert summary['spans']['outer']['total_ms'] >= summary['spans']['inner']['total_ms']
+        assert summary['counters'] == {'tokens': 12}
+        assert [span.name for span in spans] == ['inner'] * 3 + ['outer']
+        assert spans[-1].args == {'batch_size': 2}
+        assert counts == [('tokens', 4)] * 3
+
+        path = self.get_temp_path('trace.json')
+        tracer.export_chrome_trace(path)
+        with open(path) as f:
+            trace = json.load(f)
+        assert len(trace['traceEvents']) == 4
+        assert all(event['ph'] == 'X' for event in trace['traceEvents'])
+        assert trace['otherData']['counters'] == {'tokens': 12}
+
+        tracer.reset()
+        assert tracer.summary() == {'spans': {}, 'counters': {}}
+
+    def test_flush_completed_spans(self):
+        tracer = Tracer()
+        spans = []
+        tracer.add_sink(on_span=spans.append)
+        for idx, completed in enumerate([True, False, True]):
+            span = Span(f'span{idx}', start=0., thread=0)
+            span._events = (_FakeEvent(0.), _FakeEvent(idx + 1., completed))
+            tracer._pending.append(span)
+        tracer.flush(wait=False)
+        assert [span.name for span in spans] == ['span0', 'span2']
+        assert [span.name for span in tracer._pending] == ['span1']
+        tracer.flush()
+        assert [span.name for span in spans] == ['span0', 'span2', 'span1']
+        assert [span.duration for span in spans] == [1., 3., 2.]
+        assert not tracer._pending
+
+    def test_musicgen(self):
+        mg = MusicGen.get_pretrained(name='debug', device='cpu')
+        mg.set_generation_params(duration=1.0)
+        tracer = Tracer()
+        mg.set_tracer(tracer)
+        mg.generate(['youpi', 'lapin dort'])
+        summary = tracer.summary()
+        for name in ['generate', 'generate_tokens', 'conditioning', 'lm.prefill', 'lm.step', 'lm.sampling', 'decode']:
+            assert name in summary['spans'], name
+        steps = summary['spans']['lm.prefill']['calls'] + summary['spans']['lm.step']['calls']
+        assert summary['counters']['tokens'] == 2 * mg.lm.num_codebooks * steps
+        assert summary['counters']['cfg_rows'] == 2 * steps
+
+        mg.set_tracer(None)
+        mg.generate(['youpi'])
+        assert tracer.summary() == summary